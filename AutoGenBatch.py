@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import statistics
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from worker import generate_book
+from utils.engine_pool import engine_pool
+from utils.llm_batch import batch_collector
+from utils.resource_slots import resource_slots
+
+# JSONLの各行で指定できる項目 (wav は音声の話者IDで、0または省略で音声なし)
+REQUIRED_FIELDS = ("book_content", "target_readers", "n_pages")
+OPTIONAL_FIELDS = ("level", "wav", "audio_format", "provider", "model", "models")
+
+def load_entries(filename: str) -> list:
+    """
+    JSONLファイルから本の一覧を読み込みます。空行と#で始まる行は読み飛ばします。
+    各要素は (行番号, worker.generate_book に渡すリクエスト) です。
+    """
+    entries = []
+    with open(filename, encoding="UTF-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entry = json.loads(line)
+            missing = [field for field in REQUIRED_FIELDS if not entry.get(field)]
+            if missing:
+                raise ValueError(f"{filename}:{line_number}: missing {', '.join(missing)}")
+            unknown = set(entry) - set(REQUIRED_FIELDS) - set(OPTIONAL_FIELDS)
+            if unknown:
+                raise ValueError(f"{filename}:{line_number}: unknown field {', '.join(sorted(unknown))}")
+            request = {field: entry[field] for field in REQUIRED_FIELDS + OPTIONAL_FIELDS if field in entry and field != "wav"}
+            request["n_pages"] = int(request["n_pages"])
+            request["wav_output"] = int(entry.get("wav") or 0)
+            entries.append((line_number, request))
+    return entries
+
+def run_entry(line_number: int, request: dict) -> dict:
+    """1冊を生成し、成否と所要時間を含む結果を返します。失敗しても例外は送出しません。"""
+    start = time.monotonic()
+    outcome = {"line": line_number, "request": request, "ok": False, "error": None, "result": None}
+    output_dir = {}
+    try:
+        outcome["result"] = generate_book(request, lambda **fields: output_dir.update(fields))
+        outcome["ok"] = True
+    except Exception as e:
+        logging.exception(f"book on line {line_number} failed")
+        outcome["error"] = f"{type(e).__name__}: {e}"
+    outcome["output_dir"] = output_dir.get("output_dir")
+    outcome["seconds"] = round(time.monotonic() - start, 3)
+    return outcome
+
+def merge_tiers(outcomes: list) -> list:
+    """本ごとの llm_tiers を、プロンプトの種類とモデルごとに合計します。"""
+    tiers = {}
+    for outcome in outcomes:
+        for tier in (outcome["result"] or {}).get("llm_tiers") or []:
+            total = tiers.setdefault((tier["kind"], tier["model"]), {
+                "kind": tier["kind"], "model": tier["model"], "calls": 0, "failures": 0, "seconds": 0.0,
+                "input_tokens": 0, "output_tokens": 0, "cost_usd": None,
+            })
+            for key in ("calls", "failures", "seconds", "input_tokens", "output_tokens"):
+                total[key] += tier[key]
+            if tier["cost_usd"] is not None:
+                total["cost_usd"] = (total["cost_usd"] or 0.0) + tier["cost_usd"]
+    for total in tiers.values():
+        total["seconds"] = round(total["seconds"], 3)
+        total["mean_seconds"] = round(total["seconds"] / total["calls"], 3) if total["calls"] else 0.0
+        if total["cost_usd"] is not None:
+            total["cost_usd"] = round(total["cost_usd"], 6)
+    return list(tiers.values())
+
+def summarize(outcomes: list, wall_seconds: float, books: int) -> dict:
+    """全体のスループットと、共有した資源(LLM・LaTeX・TTS)の利用状況をまとめます。"""
+    succeeded = [outcome for outcome in outcomes if outcome["ok"]]
+    seconds = [outcome["seconds"] for outcome in outcomes]
+    pages = sum(outcome["request"]["n_pages"] for outcome in succeeded)
+    tiers = merge_tiers(outcomes)
+    costs = [tier["cost_usd"] for tier in tiers if tier["cost_usd"] is not None]
+    hours = max(wall_seconds, 1e-9) / 3600
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "books": len(outcomes),
+        "succeeded": len(succeeded),
+        "failed": len(outcomes) - len(succeeded),
+        "concurrent_books": books,
+        "wall_seconds": round(wall_seconds, 3),
+        "pages": pages,
+        "books_per_hour": round(len(succeeded) / hours, 2),
+        "pages_per_hour": round(pages / hours, 2),
+        "book_seconds": {
+            "mean": round(statistics.mean(seconds), 3) if seconds else 0.0,
+            "median": round(statistics.median(seconds), 3) if seconds else 0.0,
+            "max": round(max(seconds), 3) if seconds else 0.0,
+            # 本ごとの所要時間の合計に対する経過時間の比 (並行して進めた効果)
+            "overlap": round(sum(seconds) / wall_seconds, 2) if wall_seconds else 0.0,
+        },
+        "llm_calls": sum(tier["calls"] for tier in tiers),
+        "llm_cost_usd": round(sum(costs), 6) if costs else None,
+        "llm_tiers": tiers,
+        "resources": {
+            "llm": resource_slots.shared("llm", "LLM_GLOBAL_CONCURRENCY").stats(),
+            "latex": resource_slots.shared("latex", "LATEX_CONCURRENCY").stats(),
+            "tts": engine_pool.shared_stats(),
+        },
+    }
+    if os.environ.get("LLM_BATCH_MODE", "0") == "1":
+        report["llm_batch"] = batch_collector.shared().snapshot()
+    return report
+
+def run_batch(entries: list, output_dir: str, books: int) -> dict:
+    """
+    本の一覧を1つのプロセスで並行して生成します。
+    LLMの呼び出し・LaTeXのコンパイル・TTSエンジンはプロセス内の全ての本で上限を共有し、
+    ある本がコンパイルや音声の生成をしている間も、他の本の節の呼び出しで空いた枠を埋めます。
+    結果は1冊終わるごとに results.jsonl へ追記し、最後に report.json を書き出します。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results_path = os.path.join(output_dir, "results.jsonl")
+    lock = threading.Lock()
+    outcomes = []
+    start = time.monotonic()
+    with open(results_path, "w", encoding="UTF-8") as results_file:
+        with ThreadPoolExecutor(max_workers=max(1, books), thread_name_prefix="book") as executor:
+            futures = [executor.submit(run_entry, line_number, request) for line_number, request in entries]
+            for future in as_completed(futures):
+                outcome = future.result()
+                with lock:
+                    outcomes.append(outcome)
+                    results_file.write(json.dumps(outcome, ensure_ascii=False, default=str) + "\n")
+                    results_file.flush()
+                logging.info(
+                    f"book {len(outcomes)}/{len(entries)} (line {outcome['line']}) "
+                    + ("finished" if outcome["ok"] else f"failed: {outcome['error']}")
+                    + f" in {outcome['seconds']:.1f}s"
+                )
+    report = summarize(sorted(outcomes, key=lambda outcome: outcome["line"]), time.monotonic() - start, books)
+    report["results_path"] = results_path
+    report_path = os.path.join(output_dir, "report.json")
+    with open(report_path, "w", encoding="UTF-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    report["report_path"] = report_path
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate many books from a JSONL file in one process with shared LLM, LaTeX and TTS limits.")
+    parser.add_argument('books_file', type=str, help='1行に1冊 (book_content, target_readers, n_pages, level, wav) のJSONLファイル')
+    parser.add_argument('--books', type=int, help='並行して生成する本の数', default=int(os.environ.get("BATCH_BOOKS", "4")))
+    parser.add_argument('--llm-concurrency', type=int, help='全ての本で共有するLLMの同時呼び出し数 (0は無制限)', default=int(os.environ.get("LLM_GLOBAL_CONCURRENCY", "16")))
+    parser.add_argument('--latex-workers', type=int, help='全ての本で共有するLaTeXの同時コンパイル数 (0は無制限)', default=int(os.environ.get("LATEX_CONCURRENCY", str(max(1, (os.cpu_count() or 2) // 2)))))
+    parser.add_argument('--tts-concurrency', type=int, help='TTSエンジン1台あたりの同時リクエスト数 (省略時は VOICE_ENGINE_MAX_CONCURRENCY)', default=None)
+    parser.add_argument('--batch', action='store_true', help='章・節の生成をバッチAPIで送る (LLM_BATCH_MODE=1)')
+    parser.add_argument('--output-dir', type=str, help='results.jsonl と report.json の出力先', default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+    entries = load_entries(args.books_file)
+
+    # 共有する上限は最初の本で作られるため、本を始める前に環境変数へ反映する
+    os.environ["LLM_GLOBAL_CONCURRENCY"] = str(args.llm_concurrency)
+    os.environ["LATEX_CONCURRENCY"] = str(args.latex_workers)
+    if args.tts_concurrency is not None:
+        os.environ["VOICE_ENGINE_MAX_CONCURRENCY"] = str(args.tts_concurrency)
+    if args.batch:
+        os.environ["LLM_BATCH_MODE"] = "1"
+
+    output_dir = args.output_dir or os.path.join(
+        os.path.expanduser(os.environ.get("BOOK_OUTPUT_DIR", "output")), "batches", f"{datetime.now():%Y%m%d-%H%M%S}"
+    )
+    logging.info(f"generating {len(entries)} books, {args.books} at a time")
+    report = run_batch(entries, output_dir, args.books)
+
+    print(f"{report['succeeded']}/{report['books']} books in {report['wall_seconds']:.1f}s "
+          f"({report['books_per_hour']} books/h, {report['pages_per_hour']} pages/h)")
+    for name in ("llm", "latex"):
+        slots = report["resources"][name]
+        print(f"{name}: {slots['acquired']} uses, utilization {slots['utilization']}, mean wait {slots['mean_wait_seconds']}s")
+    print(f"report written to {report['report_path']}")
+
+if __name__ == "__main__":
+    main()
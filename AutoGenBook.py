@@ -12,11 +12,21 @@ from pylatex.utils import NoEscape
 from typing import List
 from pydantic import BaseModel
 import argparse
-from utils.models import llms
+import time
+from utils.models import llms, PROVIDERS, PROMPT_KINDS
 from utils.cover_image import cover_image
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from utils.convert_wav import convert_wav
+from utils.audio_encoder import AUDIO_FORMATS
+from utils.artifact_manifest import artifact_manifest
+from utils.tracing import tracer, traced, submit
+from utils.profiler import sampling_profiler
+from utils.llm_batch import batch_collector
+from utils.resource_slots import resource_slots
+
+# latexmkの各パスの記録 (本のディレクトリに、.latexmkrcの traced_rule が書き出す)
+LATEX_PASSES_FILENAME = "latex_passes.tsv"
 
 class DirName(BaseModel):
     dirname: str
@@ -39,23 +49,34 @@ class BookCover(BaseModel):
     title: str
     subtitle: str
 
-# LLM
-llms=llms()
-
 class BookGenerator:
-    def __init__(self):
+    def __init__(self, provider: str = None, model: str = None, models: dict = None, batch: bool = None):
+        # LLMのクライアント。本ごとにプロバイダ・モデルと、プロンプトの種類ごとのモデルを選べる (省略時は環境変数)
+        self.llm = llms(provider, model, models)
+        # バッチモードでは、章・節の呼び出しをプロセス内で共有するコレクター経由でバッチAPIに送る (省略時は LLM_BATCH_MODE)
+        if batch is None:
+            batch = os.environ.get("LLM_BATCH_MODE", "0") == "1"
+        self.llm_batch = batch_collector.shared() if batch else None
         self._initialize_constants()
         self._create_output_directory()
         self._setup_logging()
+        self.on_event = None
+        # 各工程・各節のLLM呼び出しなどの区間を記録する (TRACE_EXPORTで書き出す)
+        self.tracer = tracer()
 
     def _initialize_constants(self):
         """クラス内で使用する定数を初期化します。"""
         self.book_node_name = "book"
         self.max_depth = 5
         self.max_output_pages = 1.5
-        self.base_dir = os.path.expanduser("output")
+        self.base_dir = os.path.expanduser(os.environ.get("BOOK_OUTPUT_DIR", "output"))
         self.equation_frequency_level = 1
         self.additional_requirements = ""
+        # 同時に呼び出すLLMリクエストの上限 (0はThreadPoolExecutorの既定値)
+        self.llm_concurrency = int(os.environ.get("LLM_CONCURRENCY", "0"))
+        # プロセス内の全ての本で共有するLaTeXのコンパイル数の上限 (LATEX_CONCURRENCY、0は無制限)
+        self.latex_slots = resource_slots.shared("latex", "LATEX_CONCURRENCY")
+        self.llm_seconds = []
 
     def _create_output_directory(self):
         """出力ディレクトリが存在しない場合は作成します。"""
@@ -64,6 +85,20 @@ class BookGenerator:
     def _setup_logging(self):
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+    def set_event_callback(self, callback):
+        """進捗イベントを受け取る callback(event, data) を設定します。"""
+        self.on_event = callback
+        return True
+
+    def emit_event(self, event: str, **data):
+        if not self.on_event:
+            return
+        try:
+            self.on_event(event, data)
+        except Exception as e:
+            # 進捗の通知に失敗しても生成は続ける
+            logging.error(f"Error emitting event {event}: {e}")
+
     def list_directories(self,base_directory: str) -> str:
         try:
             directories = [name for name in os.listdir(base_directory) if os.path.isdir(os.path.join(base_directory, name))]
@@ -92,15 +127,17 @@ class BookGenerator:
                 f"        被らないように生成すること。\n"
                 f"タイトル：\n{title}\n"
             )
-            completion = llms._call_api(
-                messages=[
-                    {"role": "system", "content": "あなたは誠実で優秀なPythonプログラマです"},
-                    {"role": "user", "content": user_input}
-                ],
-                response_format=DirName
-            )
+            with self.tracer.span("llm", node="dirname", response_format="DirName", kind="dirname", model=self.llm.model_for("dirname")):
+                completion = self.llm._call_api(
+                    messages=[
+                        {"role": "system", "content": "あなたは誠実で優秀なPythonプログラマです"},
+                        {"role": "user", "content": user_input}
+                    ],
+                    response_format=DirName,
+                    kind="dirname"
+                )
             if completion:
-                json_data=llms._reponse_api(completion,"json")
+                json_data=self.llm._reponse_api(completion,"json")
                 data = json.loads(json_data)
                 if not data:
                     dirname_buff = self.generate_random_folder_name(20)
@@ -118,6 +155,9 @@ class BookGenerator:
             self.home_dir = self.generate_dirname(title)
             os.makedirs(self.home_dir, exist_ok=True)
             self.latexmkrc_path = os.path.join(self.home_dir, ".latexmkrc")
+            # 各工程の成果物をmanifest.jsonに記録する
+            self.manifest = artifact_manifest(self.home_dir)
+            self.manifest.set(title=title)
         except Exception as e:
             logging.error(f"Error create directory at {self.home_dir}: {e}")
         return True
@@ -352,6 +392,7 @@ class BookGenerator:
         )
 
 
+    @traced()
     def initialize(self,book_content:str,target_readers:str,n_pages:int):
         logging.info("1. 初期化しています")
         self.validate_inputs(book_content,target_readers,n_pages)
@@ -363,6 +404,7 @@ class BookGenerator:
         self.equation_frequency_level=equation_frequency_level
         return True
     
+    @traced()
     def generate_book_title_and_summary(self):
         logging.info("2. 本のタイトルと概要を生成を開始します")
         messages=[
@@ -370,12 +412,16 @@ class BookGenerator:
             {"role": "user", "content": self.prompt_book_title}
         ]
 
-        completion = llms._call_api(
-             messages=messages,
-            response_format=BookSummary
-        )
+        title_start = time.monotonic()
+        with self.tracer.span("llm", node=self.book_node_name, response_format="BookSummary", kind="outline", model=self.llm.model_for("outline")):
+            completion = self.llm._call_api(
+                 messages=messages,
+                response_format=BookSummary,
+                kind="outline"
+            )
+        title_seconds = time.monotonic() - title_start
         
-        result=llms._reponse_api(completion,"json")
+        result=self.llm._reponse_api(completion,"json")
         book_json=json.loads(result)
         
         logging.info("本のタイトル：" + book_json["title"])
@@ -391,14 +437,25 @@ class BookGenerator:
             title=book_json["title"],
             summary=book_json["summary"],
             n_pages=self.n_pages,
-            needsSubdivision=True
+            needsSubdivision=True,
+            llm_seconds=round(title_seconds, 3)
         )
 
         self.book_graph.add_nodes_from([(str(idx+1), child) for idx, child in enumerate(book_json["childs"])])
         self.book_graph.add_edges_from([(self.book_node_name, str(idx+1)) for idx in range(len(book_json["childs"]))])
 
+        self.emit_event("title", title=book_json["title"], summary=book_json["summary"], output_dir=self.home_dir)
+        self.emit_outline(self.book_node_name)
         return True
 
+    def emit_outline(self, parent_node_name: str):
+        """parent_node_name の下に追加された節をイベントとして通知します。"""
+        nodes = [
+            {"id": name, "title": self.book_graph.nodes[name].get("title"), "n_pages": self.book_graph.nodes[name].get("n_pages")}
+            for name in self.book_graph.successors(parent_node_name)
+        ]
+        self.emit_event("outline", parent=parent_node_name, nodes=nodes)
+
     def extract_section_content(self,markdown_text):
 
         pattern = r'```tex\s*(.*?)\s*```'
@@ -424,96 +481,159 @@ class BookGenerator:
             return "数式を最大限に活用してください。可能な限り多くの概念や関係性を数式で表現してください．"
 
 
-    def get_llm_response(self,prompt:str,response_format:type):
-        messages=[
+    def llm_messages(self,prompt:str):
+        return [
             {"role": "system", "content": "あなたは誠実で優秀な日本人の作家です"},
             {"role": "user", "content": prompt}
         ]
 
-        completion = llms._call_api(
-            messages=messages,
-            response_format=response_format
+    def get_llm_response(self,prompt:str,response_format:type,kind:str=None):
+        completion = self.llm._call_api(
+            messages=self.llm_messages(prompt),
+            response_format=response_format,
+            kind=kind
         )
 
         return completion
 
-    def async_gpt_responses(self, prompts, response_formats):                       
+    def timed_llm_response(self, prompt: str, response_format: type, node: str = None):
+        start = time.monotonic()
+        # 節の分割(SectionList)は目次、形式のない応答は本文の生成
+        kind = "outline" if response_format else "content"
+        with self.tracer.span("llm", node=node, response_format=getattr(response_format, "__name__", None) or "text", kind=kind, model=self.llm.model_for(kind)):
+            completion = self.get_llm_response(prompt, response_format, kind)
+        return completion, time.monotonic() - start
+
+    def async_gpt_responses(self, prompts, response_formats, nodes=None):
         try:
             responses = []
             # ThreadPoolExecutorで非同期にAPI呼び出し
-            with ThreadPoolExecutor() as executor:
+            with ThreadPoolExecutor(max_workers=self.llm_concurrency or None) as executor:
                 # 各プロンプトに対して同期的にAPIを呼び出す
                 futures = [
-                    executor.submit(self.get_llm_response, prompt, response_formats[index])
+                    submit(executor, self.timed_llm_response, prompt, response_formats[index], nodes[index] if nodes else None)
                     for index, prompt in enumerate(prompts)
                 ]
                 # 結果を収集
-                responses = [future.result() for future in futures]
-            
+                results = [future.result() for future in futures]
+
+            # 各呼び出しの所要時間は、直後に結果を格納するノードへ記録する
+            responses = [completion for completion, _ in results]
+            self.llm_seconds = [seconds for _, seconds in results]
             return responses
         except Exception as e:
             # エラーロギング
             logging.error(f"エラー: {str(e)}")
             raise ValueError(f"エラーが発生しました。{str(e)}")
 
+    def batch_gpt_responses(self, prompts, response_formats, nodes=None):
+        """プロンプトをバッチAPIへまとめて送り、async_gpt_responses と同じ順で応答を返します。"""
+        try:
+            start = time.monotonic()
+            finished = [None] * len(prompts)
+            futures = []
+            for index, prompt in enumerate(prompts):
+                kind = "outline" if response_formats[index] else "content"
+                future = self.llm_batch.submit(self.llm, self.llm_messages(prompt), response_formats[index], kind)
+                future.add_done_callback(lambda _, index=index: finished.__setitem__(index, time.monotonic()))
+                futures.append(future)
+            responses = [future.result() for future in futures]
+
+            # 各呼び出しの所要時間は、バッチの待ち時間を含めて送信から応答までとする
+            self.llm_seconds = [(finished_at or time.monotonic()) - start for finished_at in finished]
+            return responses
+        except Exception as e:
+            logging.error(f"エラー: {str(e)}")
+            raise ValueError(f"エラーが発生しました。{str(e)}")
+
+    def section_prompt(self, child_node_name, depth):
+        """節を分割するか本文を書くかを決め、(プロンプト, 応答形式, 種別) を返します。"""
+        child_node = self.book_graph.nodes[child_node_name]
+        if (child_node["needsSubdivision"] or child_node["n_pages"] >= self.max_output_pages) and depth < self.max_depth-1:
+
+            # LLMによる出力
+            prompt = self.create_prompt_section_list_creation(
+                str(self.book_node["title"]),
+                str(self.book_node["summary"]),
+                str(child_node["title"]),
+                str(child_node["n_pages"]),
+                str(child_node["summary"])
+            )
+            return prompt, SectionList, "json"
+
+        elif not child_node["needsSubdivision"] or depth == self.max_depth-1:
+            prompt=self.create_prompt_content_creation(
+                str(self.book_node["title"]),
+                str(self.book_node["summary"]),
+                str(child_node["title"]),
+                str(child_node["n_pages"]),
+                str(child_node["summary"]),
+                str(self.get_equation_frequency(self.book_graph.graph["equation_frequency_level"]))
+            )
+            return prompt, "", "plain"
+        else:
+            logging.error("Error: needsSubdivision attribute is not set")
+            return None
+
+    @traced()
     def generate_book_detail(self):
         logging.info("3. 章・節の内容を生成しています")
+        detail_start = time.monotonic()
         self.book_node = self.book_graph.nodes[self.book_node_name]
         next_parent_list = [self.book_node_name]
-
-        prompts_list=[]
-        response_format_list=[]
-        index_list=[]
+        leaves_written=0
 
         for depth in range(self.max_depth):
             parent_list = next_parent_list
             next_parent_list = []
+
+            # 同じ深さの全ての節のプロンプトを先に作る (バッチモードでは1つの波としてまとめて送る)
+            wave = []
             for parent_node_name in parent_list:
                 prompts_list = []
                 response_format_list=[]
                 index_list=[]
-                            
-                for _, child_node_name in enumerate(self.book_graph.successors(parent_node_name)):
-                    child_node = self.book_graph.nodes[child_node_name]
-                    if (child_node["needsSubdivision"] or child_node["n_pages"] >= self.max_output_pages) and depth < self.max_depth-1:
-                        
-                        # LLMによる出力
-                        prompt = self.create_prompt_section_list_creation(
-                            str(self.book_node["title"]),
-                            str(self.book_node["summary"]),
-                            str(child_node["title"]),
-                            str(child_node["n_pages"]),
-                            str(child_node["summary"])
-                        )
-
-                        prompts_list.append(prompt)
-                        response_format_list.append(SectionList)
-                        index_list.append("json")
-
-                    elif not child_node["needsSubdivision"] or depth == self.max_depth-1:
-                        prompt=self.create_prompt_content_creation(
-                            str(self.book_node["title"]),
-                            str(self.book_node["summary"]),
-                            str(child_node["title"]),
-                            str(child_node["n_pages"]),
-                            str(child_node["summary"]),
-                            str(self.get_equation_frequency(self.book_graph.graph["equation_frequency_level"]))
-                        )
-                        prompts_list.append(prompt)
-                        response_format_list.append("")
-                        index_list.append("plain")
-                    else:
-                        logging.error("Error: needsSubdivision attribute is not set")
-            
-                # 並列でAPIを呼び出すぞ
-                completions=self.async_gpt_responses(prompts_list,response_format_list)
+                child_node_names = []
+                for child_node_name in self.book_graph.successors(parent_node_name):
+                    section = self.section_prompt(child_node_name, depth)
+                    if section is None:
+                        continue
+                    prompt, response_format, index_str = section
+                    prompts_list.append(prompt)
+                    response_format_list.append(response_format)
+                    index_list.append(index_str)
+                    child_node_names.append(child_node_name)
+                wave.append((parent_node_name, prompts_list, response_format_list, index_list, child_node_names))
+
+            if self.llm_batch and wave:
+                prompts = [prompt for _, prompts_list, _, _, _ in wave for prompt in prompts_list]
+                with self.tracer.span("llm_wave", depth=depth, parents=len(wave), calls=len(prompts)):
+                    wave_completions = self.batch_gpt_responses(
+                        prompts,
+                        [response_format for _, _, response_format_list, _, _ in wave for response_format in response_format_list],
+                        [name for _, _, _, _, child_node_names in wave for name in child_node_names],
+                    )
+                wave_seconds = self.llm_seconds
+
+            offset = 0
+            for parent_node_name, prompts_list, response_format_list, index_list, child_node_names in wave:
+                if self.llm_batch:
+                    # 波の応答を親ごとに分ける
+                    completions = wave_completions[offset:offset + len(prompts_list)]
+                    self.llm_seconds = wave_seconds[offset:offset + len(prompts_list)]
+                    offset += len(prompts_list)
+                else:
+                    # 並列でAPIを呼び出すぞ
+                    with self.tracer.span("llm_batch", node=parent_node_name, depth=depth, calls=len(prompts_list)):
+                        completions=self.async_gpt_responses(prompts_list,response_format_list,child_node_names)
 
-                for index, child_node_name in enumerate(self.book_graph.successors(parent_node_name)):
+                for index, child_node_name in enumerate(child_node_names):
                     index_str=index_list[index]
                     completion=completions[index]
+                    self.book_graph.nodes[child_node_name]["llm_seconds"] = round(self.llm_seconds[index], 3)
 
                     if index_str=="json":
-                        result=llms._reponse_api(completion,"json") 
+                        result=self.llm._reponse_api(completion,"json") 
                         data=json.loads(result)
                         section_json = data.get("sectionlist", [])
                         
@@ -523,34 +643,81 @@ class BookGenerator:
 
                         # 分節化した場合のみ次の親になる
                         next_parent_list.append(child_node_name)
+                        self.emit_outline(child_node_name)
                     else:
-                        result=llms._reponse_api(completion,"")
+                        result=self.llm._reponse_api(completion,"")
                         # 出力をファイルに保存
                         contents_tex = self.extract_section_content(result)
                         contents_filename=os.path.join(self.home_dir,str(child_node_name)+"-p.tex")
-                        with open(contents_filename, mode='w', encoding='UTF-8') as f:
-                            f.write(contents_tex)
+                        with self.tracer.span("tex_write", node=child_node_name):
+                            with open(contents_filename, mode='w', encoding='UTF-8') as f:
+                                f.write(contents_tex)
+                            self.manifest.record("tex/" + os.path.basename(contents_filename), contents_filename, node=child_node_name)
 
                         # グラフノードの作成・結果の格納
                         self.book_graph.add_nodes_from([(child_node_name + "-p", {"content_file_path": contents_filename})])
                         self.book_graph.add_edges_from([(child_node_name, child_node_name + "-p")])
+                        leaves_written += 1
+                        self.emit_event("leaf", node=child_node_name, title=self.book_graph.nodes[child_node_name].get("title"), leaves_written=leaves_written)
+
+        self.manifest.timing("generate_book_detail", time.monotonic() - detail_start)
+        self.write_outline()
+
+    @traced()
+    def write_outline(self):
+        """章・節の構成(グラフ)をJSONとして出力し、manifestに記録します。"""
+        outline_path = os.path.join(self.home_dir, "outline.json")
+        with open(outline_path, "w", encoding="UTF-8") as f:
+            json.dump(nx.node_link_data(self.book_graph), f, ensure_ascii=False, indent=2, default=str)
+        self.manifest.record("outline", outline_path)
+        return outline_path
 
 
     # ここからPDFの整形に関わる処理
 
     def create_latexmkrc(self):
-        content = """$latex = 'platex -synctex=1 -halt-on-error -interaction=nonstopmode -file-line-error %O %S';
-                    $bibtex = 'pbibtex %O %S';
+        # 各パスの開始・終了時刻をトレース用に記録するため、コマンドはPerlの関数を経由して実行する
+        # latexmkは本のディレクトリで実行される(.latexmkrcもそこから読む)ため、記録先は相対パスで指定し、
+        # LLMが決めたディレクトリ名をPerlの文字列に埋め込まないようにする
+        content = """sub traced_rule {
+                        my ($rule, @command) = @_;
+                        require Time::HiRes;
+                        my $start = Time::HiRes::time();
+                        my $status = system(@command);
+                        if (open(my $fh, '>>', '__PASSES_FILENAME__')) {
+                            printf $fh "%s\\t%.6f\\t%.6f\\t%d\\n", $rule, $start, Time::HiRes::time(), $status >> 8;
+                            close($fh);
+                        }
+                        return $status;
+                    }
+                    $latex = 'internal traced_rule platex platex -synctex=1 -halt-on-error -interaction=nonstopmode -file-line-error %O %S';
+                    $bibtex = 'internal traced_rule pbibtex pbibtex %O %S';
                     $biber = 'biber --bblencoding=utf8 -u -U --output_safechars %O %S';
-                    $makeindex = 'mendex %O -o %D %S';
-                    $dvipdf = 'dvipdfmx %O -o %D %S';
+                    $makeindex = 'internal traced_rule mendex mendex %O -o %D %S';
+                    $dvipdf = 'internal traced_rule dvipdfmx dvipdfmx %O -o %D %S';
                     $max_repeat = 5;
-                    $pdf_mode = 3;"""
+                    $pdf_mode = 3;""".replace("__PASSES_FILENAME__", LATEX_PASSES_FILENAME)
         
         # .latexmkrcを出力
         with open(self.latexmkrc_path, "w") as file:
             file.write(content)
 
+    def latex_passes_path(self):
+        return os.path.abspath(os.path.join(self.home_dir, LATEX_PASSES_FILENAME))
+
+    def trace_latex_passes(self):
+        """latexmkが記録した各パス(platex・dvipdfmxなど)の区間をスパンとして追加します。"""
+        try:
+            with open(self.latex_passes_path(), encoding="UTF-8") as f:
+                rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+        counts = {}
+        for rule, start, end, status in rows:
+            counts[rule] = counts.get(rule, 0) + 1
+            self.tracer.add_span("latex_pass", float(start), float(end), rule=rule, run=counts[rule], exit_code=int(status))
+        return rows
+
     def extract_content_list(self,string_list):
         # この関数は、入力されたstring_listから特定のパターン（数字とハイフンの組み合わせで'-p'で終わる）
         # にマッチする文字列のみを抽出し、新しいリストとして返す
@@ -569,7 +736,9 @@ class BookGenerator:
         sorted_strings = sorted(string_list, key=self.custom_sort_key)
         return sorted_strings
 
+    @traced("create_cover_image")
     def create_cover_iamge(self,title:str,summary:str):
+        cover_start = time.monotonic()
         # LLMによる出力
         prompt = (
             f"目的：下記のタイトルと概要をベースとして英名のタイトルと、サブタイトルを生成して下さい。\n"
@@ -578,29 +747,39 @@ class BookGenerator:
             f"概要：\n{summary}\n"
             )
         
-        completion=self.get_llm_response(prompt,BookCover)
-        result=llms._reponse_api(completion,"json") 
+        with self.tracer.span("llm", node="cover", response_format="BookCover", kind="cover", model=self.llm.model_for("cover")):
+            completion=self.get_llm_response(prompt,BookCover,"cover")
+        result=self.llm._reponse_api(completion,"json") 
 
         data=json.loads(result)
         en_title = data.get("title")
         en_subtitle=""
-        author=llms.get_provider_name()+":"+llms.get_model_name()
+        author=self.llm.get_provider_name()+":"+self.llm.get_model_name()
         image_Number=str(random.randint(1,40))
         theme = str(random.randint(0, 16))
 
         ci = cover_image()
-        image_path=ci.generate_image(
-            self.home_dir,
-            en_title,
-            en_subtitle, 
-            author,  
-            image_Number, 
-            theme, 
-            'bottom_right', 
-            'The Definitive Guide'
-        )
-        return image_path
-
+        with self.tracer.span("cover_render", image=image_Number, theme=theme):
+            image_paths=ci.generate_image(
+                self.home_dir,
+                en_title,
+                en_subtitle, 
+                author,  
+                image_Number, 
+                theme, 
+                'bottom_right', 
+                'The Definitive Guide'
+            )
+        # 本文への埋め込みにはEPS、配布用にはPNGを使う
+        self.cover_image_paths=image_paths
+        seconds = time.monotonic() - cover_start
+        for image_format, image_path in image_paths.items():
+            self.manifest.record("cover_" + image_format, image_path, seconds)
+        self.manifest.timing("create_cover_image", seconds)
+        self.emit_event("cover", paths=image_paths)
+        return image_paths
+
+    @traced()
     def create_pdf(self):
         logging.info("4. PDFの生成を開始します")
         self.create_latexmkrc()
@@ -608,7 +787,7 @@ class BookGenerator:
         cover_image_path=self.create_cover_iamge(
             self.book_node["title"],
             self.book_node["summary"]
-        )
+        )["eps"]
 
         logging.info("カバー画像:" + cover_image_path)
         try:
@@ -668,47 +847,119 @@ class BookGenerator:
 
             # 日本語はエラーになる場合があるので英名で作成してからリネームする
             output_path= os.path.join(self.home_dir,os.path.basename(self.home_dir))
-            # doc.generate_pdf(self.book_node["title"], compiler="latexmk", clean_tex=False) 
-            doc.generate_pdf(output_path, compiler="latexmk", clean_tex=False) 
+            if os.path.exists(self.latex_passes_path()):
+                os.remove(self.latex_passes_path())
+            # 他の本のコンパイルで上限に達している場合は、空くまで待ってから始める
+            with self.latex_slots.hold():
+                self.emit_event("compile_started")
+                compile_start = time.monotonic()
+                # doc.generate_pdf(self.book_node["title"], compiler="latexmk", clean_tex=False) 
+                with self.tracer.span("latex_compile"):
+                    try:
+                        doc.generate_pdf(output_path, compiler="latexmk", clean_tex=False) 
+                    finally:
+                        self.trace_latex_passes()
+                compile_seconds = time.monotonic() - compile_start
+            self.emit_event("compile_finished", seconds=round(compile_seconds, 3))
 
             rename_path=os.path.join(self.home_dir,self.book_node['title'])
             os.rename(output_path+".pdf",rename_path+".pdf")
             full_path = os.path.abspath(rename_path + ".pdf")
+            self.manifest.record("tex/" + os.path.basename(output_path) + ".tex", output_path + ".tex")
+            self.manifest.record("pdf", full_path, compile_seconds)
+            self.manifest.timing("latex_compile", compile_seconds)
 
         except Exception as e:
             logging.error(f"Can't Create PDF File :  {e}")
+            self.emit_event("compile_failed", error=str(e))
             return False
 
         logging.info(f"{rename_path}.pdfの出力が完了しました")      
         return full_path
 
-    def create_wav(self,filename:str,speaker:int):
-        logging.info("5. wavファイルの生成を開始します")
+    @traced()
+    def create_wav(self,filename:str,speaker:int,audio_format:str="wav"):
+        logging.info("5. 音声ファイルの生成を開始します")
+        wav_start = time.monotonic()
         cw = convert_wav()
+        cw.set_llm(self.llm)
         cw.set_voice_speaker_id(speaker)
+        cw.set_audio_format(audio_format)
+        cw.set_progress_callback(self.emit_event)
         wav_filename=cw.generate_wav(filename)
+        # サイズやエンコード時間などを呼び出し元から参照できるようにする
+        self.audio_metrics=cw.encode_metrics
+        seconds = time.monotonic() - wav_start
+        self.manifest.record("audio", wav_filename, seconds, format=audio_format, metrics=self.audio_metrics)
+        self.manifest.timing("create_wav", seconds)
         logging.info(f" {wav_filename}の出力が完了しました")
         return wav_filename
 
-# Define other functionalities as functions (skipped for brevity)
-
-def main(book_content, target_readers, n_pages,level,wav):
-    bookgenerator = BookGenerator()
-    # 初期化
-    bookgenerator.initialize(book_content, target_readers, n_pages)
+    def export_trace(self, formats=None):
+        """記録した区間を本のディレクトリに書き出し(既定は環境変数 TRACE_EXPORT の形式)、manifestに記録します。"""
+        if not getattr(self, "home_dir", None):
+            return {}
+        paths = self.tracer.export(self.home_dir, formats)
+        for name, path in paths.items():
+            self.manifest.record("trace_" + name, path)
+        return paths
+
+    def record_llm_metrics(self):
+        """プロンプトの種類・モデルごとのレイテンシと費用をmanifestに記録します。"""
+        if not getattr(self, "home_dir", None):
+            return None
+        metrics = self.llm.tier_metrics()
+        self.manifest.set(llm_tiers=metrics)
+        if self.llm_batch:
+            # コレクターはプロセスで共有するため、他の本の分も含めた累計になる
+            self.manifest.set(llm_batch=self.llm_batch.snapshot())
+        return metrics
+
+    def export_profile(self, profiler: sampling_profiler):
+        """プロファイラを止め、折りたたみ形式のスタックと集計を本のディレクトリに書き出し、manifestに記録します。"""
+        profiler.stop()
+        if not getattr(self, "home_dir", None):
+            return {}
+        paths = profiler.write(self.home_dir)
+        for name, path in paths.items():
+            self.manifest.record(name, path)
+        return paths
 
-    if level:
-        bookgenerator.set_equation_frequency_level(level)
+# Define other functionalities as functions (skipped for brevity)
 
-    # 本の概要を生成
-    bookgenerator.generate_book_title_and_summary()
-    # 本の中身を生成
-    bookgenerator.generate_book_detail()
-    # PDFを生成
-    result = bookgenerator.create_pdf()
-    
-    if wav:
-        bookgenerator.create_wav(result,wav)
+def main(book_content, target_readers, n_pages,level,wav,audio_format="wav",trace=None,profile=False,provider=None,model=None,models=None,batch=None):
+    bookgenerator = BookGenerator(provider, model, models, batch)
+    profiler = sampling_profiler().start() if profile else None
+    try:
+        # 初期化
+        bookgenerator.initialize(book_content, target_readers, n_pages)
+
+        if level:
+            bookgenerator.set_equation_frequency_level(level)
+
+        # 本の概要を生成
+        bookgenerator.generate_book_title_and_summary()
+        # 本の中身を生成
+        bookgenerator.generate_book_detail()
+        # PDFを生成
+        result = bookgenerator.create_pdf()
+        
+        if wav:
+            bookgenerator.create_wav(result,wav,audio_format)
+    finally:
+        # 途中で失敗した場合も、そこまでの区間と計測を書き出す
+        bookgenerator.record_llm_metrics()
+        bookgenerator.export_trace(trace.split(",") if trace else None)
+        if profiler:
+            bookgenerator.export_profile(profiler)
+        bookgenerator.llm.close()
+
+def parse_models(text: str) -> dict:
+    models = dict(item.split("=", 1) for item in text.split(",") if "=" in item)
+    unknown = set(models) - set(PROMPT_KINDS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown prompt kind: {', '.join(sorted(unknown))} (choose from {', '.join(PROMPT_KINDS)})")
+    return models
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a book using provided details.")
@@ -717,8 +968,15 @@ if __name__ == "__main__":
     parser.add_argument('n_pages', type=int, help='ページ数')
     parser.add_argument('--level', type=str, help='数式の利用頻度', default=None)
     parser.add_argument('--wav', type=str, help='wavファイルの出力', default=None)
+    parser.add_argument('--audio-format', type=str, help='音声ファイルの形式', default="wav", choices=list(AUDIO_FORMATS))
+    parser.add_argument('--trace', type=str, help='トレースの出力形式 (chrome,otlp のカンマ区切り)', default=None)
+    parser.add_argument('--profile', action='store_true', help='サンプリングプロファイラの結果を本のディレクトリに出力')
+    parser.add_argument('--provider', type=str, help='LLMのプロバイダ (省略時は環境変数 PROVIDER)', default=None, choices=list(PROVIDERS))
+    parser.add_argument('--model', type=str, help='LLMのモデル (省略時は環境変数 MODEL)', default=None)
+    parser.add_argument('--models', type=parse_models, help='プロンプトの種類ごとのモデル (例: dirname=gpt-4o-mini,content=gpt-4o)', default=None)
+    parser.add_argument('--batch', action='store_true', default=None, help='章・節の生成をバッチAPIで送る (省略時は環境変数 LLM_BATCH_MODE)')
 
     args = parser.parse_args()
 
-    main(args.book_content, args.target_readers, args.n_pages,args.level,args.wav)
+    main(args.book_content, args.target_readers, args.n_pages,args.level,args.wav,args.audio_format,args.trace,args.profile,args.provider,args.model,args.models,args.batch)
 
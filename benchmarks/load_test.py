@@ -0,0 +1,420 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from datetime import datetime
+from collections import Counter
+import httpx
+
+from benchmarks.run_benchmark import REPO_DIR, git_revision, parse_list
+from benchmarks.tts_stub import tts_stub
+from utils.job_queue import job_queue
+
+DEFAULT_RESULTS_DIR = os.path.join(REPO_DIR, "output", "loadtests")
+
+# ダウンロードする成果物と、そのエンドポイント
+DOWNLOADS = {
+    "pdf": "/download/{}",
+    "cover": "/download-cover/{}",
+    "audio": "/download-audio/{}",
+    "bundle": "/download-bundle/{}",
+}
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+    return {
+        "mean": round(statistics.mean(values), 4),
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(values[-1], 4),
+    }
+
+class process_sampler:
+    """
+    サーバープロセスとその子プロセス(ワーカー)のCPU使用率・RSSと、キューの件数を一定間隔で記録します。
+    /proc を読むため、Linux以外ではキューの件数だけを記録します。
+    """
+
+    def __init__(self, pid: int, db_path: str = None, interval: float = 1.0):
+        self.pid = pid
+        self.queue = job_queue(db_path) if db_path else None
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _read_processes(self) -> dict:
+        """/proc から {pid: (ppid, CPU時間(ティック), RSS(バイト))} を読みます。"""
+        processes = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    # 2番目の項目(コマンド名)は空白や括弧を含みうるので、最後の ')' 以降を分割する
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{name}/statm") as f:
+                    rss_pages = int(f.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            processes[int(name)] = (int(fields[1]), int(fields[11]) + int(fields[12]), rss_pages * self._page_size)
+        return processes
+
+    def _tree(self, processes: dict) -> list:
+        tree = [self.pid] if self.pid in processes else []
+        for pid in tree:
+            tree.extend(child for child, (ppid, _, _) in processes.items() if ppid == pid)
+        return tree
+
+    def _run(self):
+        has_proc = os.path.isdir("/proc")
+        previous = None
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            sample = {"t": now}
+            if has_proc:
+                processes = self._read_processes()
+                tree = self._tree(processes)
+                cpu_ticks = sum(processes[pid][1] for pid in tree)
+                sample["processes"] = len(tree)
+                sample["rss_bytes"] = sum(processes[pid][2] for pid in tree)
+                if previous is not None:
+                    sample["cpu_percent"] = round(100 * max(0, cpu_ticks - previous[1]) / self._ticks / (now - previous[0]), 1)
+                previous = (now, cpu_ticks)
+            if self.queue:
+                try:
+                    sample["queue"] = self.queue.counts()
+                except Exception as e:
+                    logging.debug(f"queue counts unavailable: {e}")
+            self.samples.append(sample)
+
+    def summary(self) -> dict:
+        cpu = [s["cpu_percent"] for s in self.samples if "cpu_percent" in s]
+        rss = [s["rss_bytes"] for s in self.samples if "rss_bytes" in s]
+        queued = [s["queue"].get("queued", 0) for s in self.samples if "queue" in s]
+        processing = [s["queue"].get("processing", 0) for s in self.samples if "queue" in s]
+        return {
+            "samples": len(self.samples),
+            "cpu_percent_mean": round(statistics.mean(cpu), 1) if cpu else None,
+            "cpu_percent_peak": max(cpu) if cpu else None,
+            "rss_bytes_peak": max(rss) if rss else None,
+            "processes_peak": max((s.get("processes", 0) for s in self.samples), default=None),
+            "queued_peak": max(queued) if queued else None,
+            "processing_peak": max(processing) if processing else None,
+        }
+
+class load_run:
+    """1回の負荷試験。リクエストごとの結果とタスクごとの結果を記録します。"""
+
+    def __init__(self, args, base_url: str):
+        self.args = args
+        self.base_url = base_url
+        self.requests = []
+        self.jobs = []
+        self.rng = random.Random(args.seed)
+
+    async def call(self, client: httpx.AsyncClient, endpoint: str, method: str, path: str, **kwargs):
+        start = time.monotonic()
+        size = 0
+        try:
+            async with client.stream(method, path, **kwargs) as response:
+                # 成果物は読み捨て、JSONの応答だけを保持する
+                is_json = "json" in response.headers.get("content-type", "")
+                chunks = []
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if is_json:
+                        chunks.append(chunk)
+                status = response.status_code
+                body = json.loads(b"".join(chunks)) if is_json and chunks else None
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            status, body = type(e).__name__, None
+        self.requests.append({"endpoint": endpoint, "status": status, "seconds": time.monotonic() - start, "bytes": size, "t": start})
+        return status, body
+
+    async def session(self, client: httpx.AsyncClient, index: int):
+        """1冊分のクライアント: 生成を依頼し、完了までポーリングし、成果物をダウンロードします。"""
+        args = self.args
+        duplicate = index > 0 and self.rng.random() < args.duplicate_ratio
+        wav_output = args.speaker if self.rng.random() < args.audio_ratio else 0
+        request = {
+            "book_content": args.book_content if duplicate else f"{args.book_content} ({index})",
+            "target_readers": args.target_readers,
+            "n_pages": self.rng.choice(args.pages),
+            "wav_output": wav_output,
+            "audio_format": args.audio_format,
+        }
+        job = {"index": index, "n_pages": request["n_pages"], "audio": bool(wav_output), "submitted_at": time.monotonic()}
+        self.jobs.append(job)
+        status, body = await self.call(client, "generate-book", "POST", "/generate-book", json=request)
+        if status != 200:
+            job["status"] = "rejected" if status == 429 else "error"
+            return
+        task_id = body["task_id"]
+        job["deduplicated"] = body.get("deduplicated", False)
+
+        deadline = job["submitted_at"] + args.job_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(args.poll_interval)
+            status, body = await self.call(client, "task", "GET", f"/task/{task_id}")
+            if status != 200 or body is None:
+                continue
+            if body.get("status") == "processing" and "started_at" not in job:
+                job["started_at"] = time.monotonic()
+            if body.get("status") in ("completed", "failed"):
+                job["status"] = body["status"]
+                job["finished_at"] = time.monotonic()
+                break
+        else:
+            job["status"] = "timed_out"
+            return
+
+        if job["status"] != "completed":
+            return
+        for name in args.downloads:
+            if name == "audio" and not wav_output:
+                continue
+            await self.call(client, "download-" + name, "GET", DOWNLOADS[name].format(task_id))
+
+    async def drive(self):
+        """到着間隔(一定またはポアソン過程)に従って依頼を送り、全てのクライアントの終了を待ちます。"""
+        args = self.args
+        limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=args.request_timeout, limits=limits) as client:
+            sessions = []
+            start = time.monotonic()
+            index = 0
+            while index < args.books and time.monotonic() - start < args.duration:
+                sessions.append(asyncio.create_task(self.session(client, index)))
+                index += 1
+                interval = 1 / args.rate if args.arrival == "constant" else self.rng.expovariate(args.rate)
+                await asyncio.sleep(interval)
+            self.submit_seconds = time.monotonic() - start
+            await asyncio.gather(*sessions)
+            self.total_seconds = time.monotonic() - start
+
+    def report(self) -> dict:
+        endpoints = {}
+        for name in dict.fromkeys(r["endpoint"] for r in self.requests):
+            records = [r for r in self.requests if r["endpoint"] == name]
+            statuses = Counter(str(r["status"]) for r in records)
+            # 429は受け付けの上限による拒否として、エラーとは分けて数える
+            errors = sum(count for status, count in statuses.items() if status != "429" and not status.startswith("2"))
+            endpoints[name] = {
+                "count": len(records),
+                "rps": round(len(records) / self.total_seconds, 3),
+                "status": dict(statuses),
+                "error_rate": round(errors / len(records), 4),
+                "rejected_rate": round(statuses.get("429", 0) / len(records), 4),
+                "latency": percentiles([r["seconds"] for r in records]),
+                "bytes": sum(r["bytes"] for r in records),
+            }
+        completed = [job for job in self.jobs if job.get("status") == "completed"]
+        statuses = Counter(job.get("status", "unknown") for job in self.jobs)
+        return {
+            "submit_seconds": round(self.submit_seconds, 3),
+            "total_seconds": round(self.total_seconds, 3),
+            "requests": len(self.requests),
+            "requests_per_second": round(len(self.requests) / self.total_seconds, 3),
+            "jobs": {
+                "submitted": len(self.jobs),
+                "status": dict(statuses),
+                "deduplicated": sum(1 for job in self.jobs if job.get("deduplicated")),
+                "completed_per_minute": round(len(completed) * 60 / self.total_seconds, 3),
+                "pages_per_minute": round(sum(job["n_pages"] for job in completed) * 60 / self.total_seconds, 3),
+                "turnaround_seconds": percentiles([job["finished_at"] - job["submitted_at"] for job in completed]),
+                "queue_wait_seconds": percentiles([job["started_at"] - job["submitted_at"] for job in self.jobs if "started_at" in job]),
+            },
+            "endpoints": endpoints,
+        }
+
+def start_server(args, workers: int, work_dir: str, tts_url: str, port: int, log_path: str) -> subprocess.Popen:
+    """モックのLLMとスタブのTTSエンジンにつないだAPIサーバーを起動します。"""
+    env = dict(os.environ)
+    env.update({
+        "PROVIDER": "MOCK",
+        "MOCK_LATENCY_MS": str(args.llm_latency_ms),
+        "MOCK_LATENCY_JITTER": str(args.llm_jitter),
+        "MOCK_SEED": str(args.seed),
+        "VOICE_KIND": "VOICEVOX",
+        "VOICEVOX_API_URLS": tts_url,
+        "JOB_EMBEDDED_WORKERS": str(workers),
+        "JOB_DB_PATH": os.path.join(work_dir, "jobs.sqlite3"),
+        "BOOK_OUTPUT_DIR": os.path.join(work_dir, "output"),
+        "AUDIO_CACHE_DIR": os.path.join(work_dir, "cache"),
+    })
+    env.pop("LLM_CASSETTE_MODE", None)
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    log = open(log_path, "w", encoding="UTF-8")
+    return subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_healthy(url: str, process: subprocess.Popen = None, timeout: float = 60) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            if httpx.get(url + "/health", timeout=2).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    return False
+
+def stop_server(process: subprocess.Popen, timeout: float = 30):
+    # SIGTERMでlifespanの終了処理(ワーカーの停止)を走らせる
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run_load(args, workers: int, tts: tts_stub) -> dict:
+    """ワーカー数を1つ決めてサーバーを起動し、負荷をかけて結果を返します。"""
+    work_dir = tempfile.mkdtemp(prefix="autogenbook-load-")
+    if args.url:
+        process, base_url, db_path = None, args.url.rstrip("/"), None
+    else:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        db_path = os.path.join(work_dir, "jobs.sqlite3")
+        process = start_server(args, workers, work_dir, tts.url, port, os.path.join(work_dir, "server.log"))
+    try:
+        if not wait_healthy(base_url, process):
+            raise RuntimeError(f"server did not become healthy (see {os.path.join(work_dir, 'server.log')})")
+        sampler = process_sampler(process.pid if process else args.server_pid, db_path, args.sample_interval)
+        if process or args.server_pid:
+            sampler.start()
+        run = load_run(args, base_url)
+        asyncio.run(run.drive())
+        sampler.stop()
+        return {"workers": workers, **run.report(), "server": sampler.summary()}
+    finally:
+        if process:
+            stop_server(process)
+        if args.keep_output:
+            logging.info(f"server output and logs are kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_report(results: dict):
+    for run in results["runs"]:
+        jobs = run["jobs"]
+        server = run["server"]
+        print(
+            f"workers={run['workers']}: {jobs['submitted']} books in {run['total_seconds']:.1f}s, "
+            f"{jobs['completed_per_minute']:.2f} books/min, {run['requests_per_second']:.1f} req/s, status {jobs['status']}"
+        )
+        turnaround = jobs["turnaround_seconds"]
+        if turnaround:
+            print(f"  turnaround p50={turnaround['p50']:.2f}s p95={turnaround['p95']:.2f}s max={turnaround['max']:.2f}s")
+        if server.get("cpu_percent_peak") is not None:
+            print(
+                f"  server cpu mean={server['cpu_percent_mean']}% peak={server['cpu_percent_peak']}% "
+                f"rss peak={server['rss_bytes_peak'] / 2**20:.0f}MB queued peak={server['queued_peak']}"
+            )
+        print(f"  {'endpoint':<22} {'count':>6} {'rps':>7} {'err%':>6} {'429%':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for name, endpoint in run["endpoints"].items():
+            latency = endpoint["latency"]
+            print(
+                f"  {name:<22} {endpoint['count']:>6} {endpoint['rps']:>7.2f} {endpoint['error_rate'] * 100:>6.1f} "
+                f"{endpoint['rejected_rate'] * 100:>6.1f} {latency['p50']:>8.3f} {latency['p95']:>8.3f} {latency['p99']:>8.3f}"
+            )
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the AutoGenBook API with a mock LLM and a stub TTS engine.")
+    parser.add_argument('--workers', type=parse_list, help='ワーカー数 (カンマ区切りで複数を順に試す)', default=[1])
+    parser.add_argument('--rate', type=float, help='1秒あたりの依頼数', default=0.5)
+    parser.add_argument('--arrival', type=str, help='到着間隔', default="poisson", choices=["poisson", "constant"])
+    parser.add_argument('--duration', type=float, help='依頼を送り続ける秒数', default=60)
+    parser.add_argument('--books', type=int, help='依頼する本の上限', default=1000)
+    parser.add_argument('--pages', type=parse_list, help='ページ数の候補 (カンマ区切り)', default=[4, 8])
+    parser.add_argument('--audio-ratio', type=float, help='音声の生成を依頼する割合', default=0.0)
+    parser.add_argument('--audio-format', type=str, default="wav")
+    parser.add_argument('--speaker', type=int, default=1)
+    parser.add_argument('--duplicate-ratio', type=float, help='同じ内容で依頼する割合', default=0.0)
+    parser.add_argument('--poll-interval', type=float, help='/task をポーリングする間隔(秒)', default=1.0)
+    parser.add_argument('--downloads', type=lambda text: [name for name in text.split(",") if name], help=f'完了後にダウンロードする成果物 ({",".join(DOWNLOADS)})', default=list(DOWNLOADS))
+    parser.add_argument('--job-timeout', type=float, help='1冊の完了を待つ上限(秒)', default=600)
+    parser.add_argument('--request-timeout', type=float, default=60)
+    parser.add_argument('--max-connections', type=int, default=100)
+    parser.add_argument('--book-content', type=str, default="Pythonプログラミング入門")
+    parser.add_argument('--target-readers', type=str, default="プログラミング初心者")
+    parser.add_argument('--llm-latency-ms', type=float, help='モックのLLMの応答時間(ミリ秒)', default=200)
+    parser.add_argument('--llm-jitter', type=float, default=0.2)
+    parser.add_argument('--tts-latency-ms', type=float, help='スタブのTTSエンジンの合成1回あたりの遅延(ミリ秒)', default=50)
+    parser.add_argument('--tts-realtime-factor', type=float, help='音声1秒あたりの合成時間(秒)', default=0.05)
+    parser.add_argument('--tts-concurrency', type=int, default=1)
+    parser.add_argument('--sample-interval', type=float, help='サーバーの資源使用量を記録する間隔(秒)', default=1.0)
+    parser.add_argument('--url', type=str, help='起動済みのサーバーに負荷をかける場合のURL', default=None)
+    parser.add_argument('--server-pid', type=int, help='--url のサーバーのPID (資源使用量の記録用)', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help='結果のJSONファイル', default=None)
+    parser.add_argument('--keep-output', action='store_true', help='生成した本とサーバーのログを残す')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.downloads if name not in DOWNLOADS]
+    if unknown:
+        parser.error(f"unknown downloads: {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    tts = tts_stub(latency_ms=args.tts_latency_ms, realtime_factor=args.tts_realtime_factor, max_concurrency=args.tts_concurrency).start()
+    runs = []
+    try:
+        for workers in args.workers:
+            logging.info(f"load test with {workers} worker(s): {args.rate}/s for {args.duration}s")
+            runs.append(run_load(args, workers, tts))
+    finally:
+        tts.stop()
+
+    results = {
+        **git_revision(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "keep_output")},
+        "tts": {**tts.settings, **tts.stats},
+        "runs": runs,
+    }
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"{results['commit'][:10] or 'unknown'}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="UTF-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print_report(results)
+    print(f"results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.mock_llm import mock_llm
+
+# OLLAMA/ANTHROPIC向けの呼び出しは、応答形式のJSONスキーマをsystemメッセージに埋め込む
+SCHEMA_MARKERS = ("レスポンスは以下の形式に従ってください。:", "レスポンスは以下の形式に従ってください:")
+
+class openai_stub:
+    """
+    OpenAI互換の /v1/chat/completions を返すローカルサーバー (ベンチマーク用)。
+    応答は mock_llm と同じ方法で合成し、遅延・揺らぎ・エラー率・レート制限を設定できます。
+    同じリクエストには同じ応答を返すため、設定を変えても本の構成は変わりません。
+    バッチモードの確認用に、OpenAIの Files・Batches と、Anthropicの Messages・Message Batches にも対応します。
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0, latency_per_token_ms: float = 0,
+                 jitter: float = 0, error_rate: float = 0, rate_limit_rpm: int = 0, max_inflight: int = 0,
+                 output_tokens: int = 400, subdivide_probability: float = 0.3, seed: str = "0",
+                 batch_latency_ms: float = 0, batch_straggler_rate: float = 0, batch_expire_ms: float = 0):
+        self.synth = mock_llm()
+        self.synth.latency_ms = latency_ms
+        self.synth.latency_per_token_ms = latency_per_token_ms
+        self.synth.latency_jitter = jitter
+        self.synth.output_tokens = output_tokens
+        self.synth.subdivide_probability = subdivide_probability
+        self.synth.seed = seed
+        self.error_rate = error_rate
+        self.rate_limit_rpm = rate_limit_rpm
+        self.max_inflight = max_inflight
+        # バッチは受け付けてから batch_latency_ms 後に処理し、batch_straggler_rate の割合は取り消されるまで終わらない
+        self.batch_latency_ms = batch_latency_ms
+        self.batch_straggler_rate = batch_straggler_rate
+        # 0以外の場合は、受け付けてから batch_expire_ms 後に終わっていないリクエストを期限切れ(expired)にする
+        self.batch_expire_ms = batch_expire_ms
+        self.files = {}
+        self.batches = {}
+        self.settings = {
+            "latency_ms": latency_ms,
+            "latency_per_token_ms": latency_per_token_ms,
+            "jitter": jitter,
+            "error_rate": error_rate,
+            "rate_limit_rpm": rate_limit_rpm,
+            "max_inflight": max_inflight,
+            "output_tokens": output_tokens,
+            "subdivide_probability": subdivide_probability,
+            "seed": seed,
+            "batch_latency_ms": batch_latency_ms,
+            "batch_straggler_rate": batch_straggler_rate,
+            "batch_expire_ms": batch_expire_ms,
+        }
+        self._lock = threading.Lock()
+        self._errors = random.Random(f"{seed}:errors")
+        self._tokens = float(rate_limit_rpm)
+        self._refilled_at = time.monotonic()
+        self.reset_stats()
+
+        stub = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split("?", 1)[0].rstrip("/")
+                if path.endswith("/models"):
+                    self._send(200, {"object": "list", "data": [{"id": "stub", "object": "model", "owned_by": "stub"}]})
+                elif path == "/stats":
+                    self._send(200, stub.snapshot())
+                elif match := re.fullmatch(r"/v1/files/([\w-]+)/content", path):
+                    data = stub.files.get(match[1], {}).get("data")
+                    if data is None:
+                        self._send(404, {"error": {"message": "file not found", "type": "invalid_request_error"}})
+                    else:
+                        self._send_bytes(200, data, "application/octet-stream")
+                elif match := re.fullmatch(r"/v1/batches/([\w-]+)", path):
+                    self._send_batch(stub.openai_batch(match[1]))
+                elif match := re.fullmatch(r"/v1/messages/batches/([\w-]+)/results", path):
+                    data = stub.anthropic_results(match[1])
+                    if data is None:
+                        self._send(404, {"type": "error", "error": {"type": "not_found_error", "message": "batch not found"}})
+                    else:
+                        self._send_bytes(200, data, "application/binary")
+                elif match := re.fullmatch(r"/v1/messages/batches/([\w-]+)", path):
+                    self._send_batch(stub.anthropic_batch(match[1]))
+                else:
+                    self._send(404, {"error": {"message": f"unknown path {self.path}", "type": "invalid_request_error"}})
+
+            def do_POST(self):
+                path = self.path.split("?", 1)[0].rstrip("/")
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if path.endswith("/chat/completions"):
+                    status, payload, headers = stub.handle(json.loads(body or b"{}"))
+                    self._send(status, payload, headers)
+                elif path == "/v1/messages":
+                    status, payload, headers = stub.handle(json.loads(body or b"{}"), anthropic=True)
+                    self._send(status, payload, headers)
+                elif path == "/v1/files":
+                    self._send(200, stub.create_file(self.headers.get("Content-Type", ""), body))
+                elif path == "/v1/batches":
+                    self._send_batch(stub.create_openai_batch(json.loads(body or b"{}")))
+                elif match := re.fullmatch(r"/v1/batches/([\w-]+)/cancel", path):
+                    self._send_batch(stub.cancel_batch(match[1], stub.openai_batch))
+                elif path == "/v1/messages/batches":
+                    self._send_batch(stub.create_anthropic_batch(json.loads(body or b"{}")))
+                elif match := re.fullmatch(r"/v1/messages/batches/([\w-]+)/cancel", path):
+                    self._send_batch(stub.cancel_batch(match[1], stub.anthropic_batch))
+                else:
+                    self._send(404, {"error": {"message": f"unknown path {self.path}", "type": "invalid_request_error"}})
+
+            def _send_batch(self, batch: dict):
+                if batch is None:
+                    self._send(404, {"error": {"message": "batch not found", "type": "invalid_request_error"}})
+                else:
+                    self._send(200, batch)
+
+            def _send(self, status: int, payload: dict, headers: dict = None):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self._send_bytes(status, data, "application/json", headers)
+
+            def _send_bytes(self, status: int, data: bytes, content_type: str, headers: dict = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {
+                "requests": 0,
+                "completed": 0,
+                "rate_limited": 0,
+                "errors": 0,
+                "inflight": 0,
+                "peak_inflight": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "latency_seconds": 0.0,
+                "batches": 0,
+                "batch_requests": 0,
+            }
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+    def _take_token(self, now: float) -> float:
+        """トークンバケットから1つ取り出します。足りない場合は次に取り出せるまでの秒数を返します。"""
+        rate = self.rate_limit_rpm / 60
+        self._tokens = min(self.rate_limit_rpm, self._tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / rate
+
+    def handle(self, request: dict, anthropic: bool = False):
+        """リクエストを処理し、(ステータス, 本文, ヘッダ) を返します。anthropic=True の場合はMessages APIの形式で返します。"""
+        with self._lock:
+            self.stats["requests"] += 1
+            busy = self.max_inflight > 0 and self.stats["inflight"] >= self.max_inflight
+            wait = self._take_token(time.monotonic()) if self.rate_limit_rpm > 0 and not busy else 0
+            if wait > 0 or busy:
+                self.stats["rate_limited"] += 1
+                retry_after = max(1, round(wait)) if wait > 0 else 1
+                return 429, {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}}, {"Retry-After": str(retry_after)}
+            failed = self.error_rate > 0 and self._errors.random() < self.error_rate
+            if failed:
+                self.stats["errors"] += 1
+            else:
+                self.stats["inflight"] += 1
+                self.stats["peak_inflight"] = max(self.stats["peak_inflight"], self.stats["inflight"])
+        if failed:
+            return 500, {"error": {"message": "The server had an error while processing your request", "type": "server_error"}}, {}
+
+        start = time.monotonic()
+        try:
+            content, prompt_tokens, completion_tokens = self.complete(request)
+        finally:
+            with self._lock:
+                self.stats["inflight"] -= 1
+        with self._lock:
+            self.stats["completed"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+            self.stats["latency_seconds"] += time.monotonic() - start
+        if anthropic:
+            return 200, self.message_body(request, content, prompt_tokens, completion_tokens), {}
+        return 200, self.completion_body(request, content, prompt_tokens, completion_tokens), {}
+
+    def completion_body(self, request: dict, content: str, prompt_tokens: int, completion_tokens: int) -> dict:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model") or "stub",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def message_body(self, request: dict, content: str, prompt_tokens: int, completion_tokens: int) -> dict:
+        return {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": request.get("model") or "stub",
+            "content": [{"type": "text", "text": content}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens},
+        }
+
+    def complete(self, request: dict):
+        messages = request.get("messages") or []
+        schema = self.response_schema(request)
+        key = hashlib.sha256(json.dumps([messages, schema], ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        rng = random.Random(f"{self.synth.seed}:{key}")
+        if schema is not None:
+            content = json.dumps(self.synth.synthesize_schema(schema, rng), ensure_ascii=False)
+            tokens = len(content) // 2
+        else:
+            tokens = self.synth.sample_tokens(rng)
+            text = self.synth.synthesize_text(tokens, rng)
+            prompt = messages[-1].get("content", "") if messages else ""
+            content = f"```tex\n{text}\n```" if "```tex" in prompt else text
+        self.synth.sleep(tokens, rng)
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages)
+        return content, prompt_tokens, tokens
+
+    def response_schema(self, request: dict):
+        """response_format か、systemメッセージに埋め込まれたJSONスキーマを返します。"""
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            return response_format["json_schema"]["schema"]
+        messages = request.get("messages") or []
+        # Messages APIでは system はメッセージとは別に渡される
+        system = request.get("system") or (messages[0].get("content", "") if messages else "")
+        if isinstance(system, list):
+            system = "".join(block.get("text", "") for block in system)
+        for marker in SCHEMA_MARKERS:
+            if marker in system:
+                text = system.split(marker, 1)[1]
+                try:
+                    schema, _ = json.JSONDecoder().raw_decode(text[text.index("{"):])
+                    return schema
+                except ValueError:
+                    return None
+        return None
+
+    def create_file(self, content_type: str, body: bytes) -> dict:
+        """multipart/form-data で送られたファイル(バッチの入力)を保存します。"""
+        message = BytesParser(policy=policy.default).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+        part = fields.get("file")
+        data = part.get_payload(decode=True) if part else b""
+        purpose = fields["purpose"].get_payload(decode=True).decode("utf-8") if "purpose" in fields else "batch"
+        return self._store_file(data, part.get_filename() if part else "upload.jsonl", purpose)
+
+    def _store_file(self, data: bytes, filename: str, purpose: str) -> dict:
+        file = {
+            "id": f"file-{uuid.uuid4().hex}",
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self._lock:
+            self.files[file["id"]] = {**file, "data": data}
+        return file
+
+    def create_openai_batch(self, request: dict) -> dict:
+        data = self.files.get(request.get("input_file_id"), {}).get("data", b"")
+        lines = [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
+        items = [(line["custom_id"], line.get("body") or {}) for line in lines]
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": request.get("endpoint", "/v1/chat/completions"),
+            "input_file_id": request.get("input_file_id"),
+            "completion_window": request.get("completion_window", "24h"),
+            "created_at": int(time.time()),
+            "status": "in_progress",
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": len(items), "completed": 0, "failed": 0},
+        }
+        return self._start_batch(batch, items, anthropic=False)
+
+    def create_anthropic_batch(self, request: dict) -> dict:
+        items = [(item["custom_id"], item.get("params") or {}) for item in request.get("requests") or []]
+        batch = {
+            "id": f"msgbatch_{uuid.uuid4().hex}",
+            "type": "message_batch",
+            "processing_status": "in_progress",
+            "request_counts": {"processing": len(items), "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": _now_iso(),
+            "expires_at": _now_iso(24 * 3600),
+            "ended_at": None,
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": None,
+        }
+        return self._start_batch(batch, items, anthropic=True)
+
+    def _start_batch(self, batch: dict, items: list, anthropic: bool) -> dict:
+        state = {"batch": batch, "items": items, "results": {}, "anthropic": anthropic, "cancel": threading.Event(),
+                 "expires_at": time.monotonic() + self.batch_expire_ms / 1000 if self.batch_expire_ms else None}
+        with self._lock:
+            self.batches[batch["id"]] = state
+            self.stats["batches"] += 1
+            self.stats["batch_requests"] += len(items)
+        threading.Thread(target=self._process_batch, args=(state,), daemon=True).start()
+        return dict(batch)
+
+    def _process_batch(self, state: dict):
+        """バッチの各リクエストを処理します。取り残される分(straggler)は取り消されるか期限が切れるまで待ちます。"""
+        if state["cancel"].wait(self.batch_latency_ms / 1000):
+            return self._finish_batch(state)
+        stragglers = random.Random(f"{self.synth.seed}:{state['batch']['id']}")
+        for custom_id, body in state["items"]:
+            if state["cancel"].is_set():
+                break
+            if self.batch_straggler_rate > 0 and stragglers.random() < self.batch_straggler_rate:
+                continue
+            content, prompt_tokens, completion_tokens = self.complete(body)
+            if state["anthropic"]:
+                result = {"type": "succeeded", "message": self.message_body(body, content, prompt_tokens, completion_tokens)}
+            else:
+                result = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self.completion_body(body, content, prompt_tokens, completion_tokens)}
+            with self._lock:
+                state["results"][custom_id] = result
+                counts = state["batch"]["request_counts"]
+                if state["anthropic"]:
+                    counts["processing"] -= 1
+                    counts["succeeded"] += 1
+                else:
+                    counts["completed"] += 1
+        if len(state["results"]) < len(state["items"]):
+            expires_at = state["expires_at"]
+            state["cancel"].wait(None if expires_at is None else max(0.0, expires_at - time.monotonic()))
+        self._finish_batch(state)
+
+    def _finish_batch(self, state: dict):
+        batch = state["batch"]
+        cancelled = state["cancel"].is_set()
+        expired = not cancelled and len(state["results"]) < len(state["items"])
+        lines = []
+        errors = []
+        for custom_id, _ in state["items"]:
+            result = state["results"].get(custom_id)
+            if state["anthropic"]:
+                lines.append({"custom_id": custom_id, "result": result or {"type": "expired" if expired else "canceled"}})
+            elif result:
+                lines.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "response": result, "error": None})
+            else:
+                error = (
+                    {"code": "batch_expired", "message": "This request could not be executed before the completion window expired."}
+                    if expired else
+                    {"code": "batch_cancelled", "message": "Batch was cancelled before this request was processed."}
+                )
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "response": None, "error": error})
+        data = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8")
+        with self._lock:
+            if state["anthropic"]:
+                counts = batch["request_counts"]
+                counts["expired" if expired else "canceled"] += counts["processing"]
+                counts["processing"] = 0
+                batch["processing_status"] = "ended"
+                batch["ended_at"] = _now_iso()
+                state["results_data"] = data
+                batch["results_url"] = f"{self.anthropic_base_url}/v1/messages/batches/{batch['id']}/results"
+        if not state["anthropic"]:
+            # 出力ファイルを作ってから状態を変え、終了した時点で結果を取れるようにする
+            output = self._store_file(data, "batch_output.jsonl", "batch_output")
+            error_data = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in errors).encode("utf-8")
+            error_file = self._store_file(error_data, "batch_errors.jsonl", "batch_output") if errors else None
+            with self._lock:
+                batch["output_file_id"] = output["id"]
+                batch["error_file_id"] = error_file["id"] if error_file else None
+                batch["request_counts"]["failed"] = len(errors)
+                batch["status"] = "cancelled" if cancelled else "expired" if expired else "completed"
+
+    def openai_batch(self, batch_id: str):
+        state = self.batches.get(batch_id)
+        with self._lock:
+            return dict(state["batch"]) if state and not state["anthropic"] else None
+
+    def anthropic_batch(self, batch_id: str):
+        state = self.batches.get(batch_id)
+        with self._lock:
+            return dict(state["batch"]) if state and state["anthropic"] else None
+
+    def anthropic_results(self, batch_id: str):
+        state = self.batches.get(batch_id)
+        return state.get("results_data") if state else None
+
+    def cancel_batch(self, batch_id: str, retrieve):
+        state = self.batches.get(batch_id)
+        if state is None:
+            return None
+        with self._lock:
+            if state["anthropic"] and state["batch"]["processing_status"] == "in_progress":
+                state["batch"]["processing_status"] = "canceling"
+                state["batch"]["cancel_initiated_at"] = _now_iso()
+            elif not state["anthropic"] and state["batch"]["status"] == "in_progress":
+                state["batch"]["status"] = "cancelling"
+        state["cancel"].set()
+        return retrieve(batch_id)
+
+    @property
+    def anthropic_base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+def _now_iso(offset: float = 0) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + offset))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local OpenAI-compatible stub server.")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--latency-ms', type=float, help='基本の遅延(ミリ秒)', default=0)
+    parser.add_argument('--latency-per-token-ms', type=float, help='出力トークンあたりの遅延(ミリ秒)', default=0)
+    parser.add_argument('--jitter', type=float, help='遅延の揺らぎ(対数正規分布のσ)', default=0)
+    parser.add_argument('--error-rate', type=float, help='500を返す割合', default=0)
+    parser.add_argument('--rpm', type=int, help='1分あたりのリクエスト上限 (超過時は429)', default=0)
+    parser.add_argument('--max-inflight', type=int, help='同時に処理するリクエストの上限 (超過時は429)', default=0)
+    parser.add_argument('--output-tokens', type=int, help='本文の長さ(トークン数)の中央値', default=400)
+    parser.add_argument('--subdivide', type=float, help='節を細分化する確率', default=0.3)
+    parser.add_argument('--seed', type=str, default="0")
+    parser.add_argument('--batch-latency-ms', type=float, help='バッチを受け付けてから処理を始めるまでの時間(ミリ秒)', default=0)
+    parser.add_argument('--batch-straggler-rate', type=float, help='取り消されるまで終わらないバッチ内のリクエストの割合', default=0)
+    parser.add_argument('--batch-expire-ms', type=float, help='バッチの終わっていないリクエストを期限切れにするまでの時間(ミリ秒、0で無効)', default=0)
+    args = parser.parse_args()
+
+    stub = openai_stub(
+        args.host, args.port, args.latency_ms, args.latency_per_token_ms, args.jitter, args.error_rate,
+        args.rpm, args.max_inflight, args.output_tokens, args.subdivide, args.seed,
+        args.batch_latency_ms, args.batch_straggler_rate, args.batch_expire_ms,
+    )
+    print(f"OpenAI-compatible stub listening on {stub.base_url}", flush=True)
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
+
+if __name__ == "__main__":
+    main()
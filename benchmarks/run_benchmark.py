@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import itertools
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RESULTS_DIR = os.path.join(REPO_DIR, "output", "benchmarks")
+
+def peak_rss_bytes() -> int:
+    import resource
+    # Linuxはキロバイト、macOSはバイト単位で返る
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def llm_critical_path(graph, root: str = "book") -> float:
+    """目次の根から各節までのLLM呼び出しの所要時間を足し合わせ、最も長い経路の秒数を返します(根は含めない)。"""
+    longest = 0.0
+    stack = [(child, 0.0) for child in graph.successors(root)]
+    while stack:
+        node, elapsed = stack.pop()
+        elapsed += graph.nodes[node].get("llm_seconds", 0.0)
+        longest = max(longest, elapsed)
+        stack.extend((child, elapsed) for child in graph.successors(node))
+    return longest
+
+def run_book(config: dict) -> dict:
+    """
+    子プロセス側で1冊生成し、計測結果を返します。
+    LLMの設定は環境変数から読むため、環境変数を設定した後にインポートします。
+    """
+    sys.path.insert(0, REPO_DIR)
+    from AutoGenBook import BookGenerator
+
+    bookgenerator = BookGenerator(models=config.get("models"))
+    bookgenerator.base_dir = config["output_dir"]
+    bookgenerator.max_depth = config["max_depth"]
+    bookgenerator.llm_concurrency = config["concurrency"]
+
+    stages = {}
+    result = {"ok": False, "error": None}
+    start = time.monotonic()
+    try:
+        for stage, run in (
+            ("initialize", lambda: bookgenerator.initialize(config["book_content"], config["target_readers"], config["n_pages"])),
+            ("title", bookgenerator.generate_book_title_and_summary),
+            ("detail", bookgenerator.generate_book_detail),
+            ("pdf", bookgenerator.create_pdf if config["pdf"] else None),
+        ):
+            if run is None:
+                continue
+            stage_start = time.monotonic()
+            output = run()
+            stages[stage] = round(time.monotonic() - stage_start, 3)
+        result["ok"] = True
+        # LaTeXがない環境でも他の工程は計測できるよう、PDFの成否は別に記録する
+        result["pdf_ok"] = bool(output) if config["pdf"] else None
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    wall_seconds = time.monotonic() - start
+
+    timings = bookgenerator.manifest.data["timings"] if hasattr(bookgenerator, "manifest") else {}
+    graph = getattr(bookgenerator, "book_graph", None)
+    has_outline = graph is not None and graph.has_node(bookgenerator.book_node_name)
+    leaves = [node for node in graph.nodes if node.endswith("-p")] if has_outline else []
+    llm_path = llm_critical_path(graph, bookgenerator.book_node_name) if has_outline else 0.0
+    llm_serial = sum(graph.nodes[node].get("llm_seconds", 0.0) for node in graph.nodes) if has_outline else 0.0
+    # 並列度が無制限の場合の下限: 概要の生成 → 最も長い目次の経路 → 表紙 → LaTeXのコンパイル
+    critical_path = stages.get("title", 0.0) + llm_path + timings.get("create_cover_image", 0.0) + timings.get("latex_compile", 0.0)
+
+    # 呼び出し回数は _record_call の記録から数える (バッチモードの呼び出しは _call_api を通らないため)
+    tiers = bookgenerator.llm.tier_metrics()
+    result.update({
+        "wall_seconds": round(wall_seconds, 3),
+        "stages": stages,
+        "timings": timings,
+        "critical_path_seconds": round(critical_path, 3),
+        "llm_critical_path_seconds": round(llm_path, 3),
+        "llm_serial_seconds": round(llm_serial, 3),
+        "llm_calls": sum(tier["calls"] for tier in tiers),
+        "llm_failures": sum(tier["failures"] for tier in tiers),
+        "latex_compile_seconds": timings.get("latex_compile"),
+        "sections": len(graph.nodes) - len(leaves) - 1 if has_outline else 0,
+        "leaves": len(leaves),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "llm_endpoints": bookgenerator.llm.endpoint_stats(),
+        "llm_tiers": tiers,
+        "llm_batch": bookgenerator.llm_batch.snapshot() if bookgenerator.llm_batch else None,
+    })
+    return result
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True, timeout=30).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+def config_key(config: dict) -> str:
+    return f"pages={config['n_pages']},depth={config['max_depth']},concurrency={config['concurrency']}"
+
+def run_matrix(args) -> dict:
+    from benchmarks.openai_stub import openai_stub
+
+    # --endpoints で複数のスタブを起動し、<PROVIDER>_ENDPOINTS で振り分ける
+    stubs = [openai_stub(
+        latency_ms=args.latency_ms,
+        latency_per_token_ms=args.latency_per_token_ms,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rpm=args.rpm,
+        max_inflight=args.max_inflight,
+        output_tokens=args.output_tokens,
+        subdivide_probability=args.subdivide,
+        seed=args.seed,
+        batch_latency_ms=args.batch_latency_ms,
+        batch_straggler_rate=args.batch_straggler_rate,
+    ).start() for _ in range(max(1, args.endpoints))]
+    work_dir = tempfile.mkdtemp(prefix="autogenbook-bench-")
+    env = dict(os.environ)
+    env.update({"PROVIDER": args.provider, "MODEL": "stub", "OPENAI_API_KEY": "stub", "ANTHROPIC_API_KEY": "stub"})
+    # AnthropicのSDKはURLに /v1 を付けるため、スタブのルートを渡す
+    stub_url = (lambda stub: stub.anthropic_base_url) if args.provider == "ANTHROPIC" else (lambda stub: stub.base_url)
+    env[f"{args.provider}_BASE_URL"] = stub_url(stubs[0])
+    if len(stubs) > 1:
+        capacity = f";capacity={args.max_inflight}" if args.max_inflight else ""
+        env[f"{args.provider}_ENDPOINTS"] = ",".join(stub_url(stub) + capacity for stub in stubs)
+    if args.batch:
+        # スタブのバッチはすぐ終わるため、待ち時間とポーリングの間隔を短くする
+        env.update({
+            "LLM_BATCH_MODE": "1",
+            "LLM_BATCH_WINDOW": str(args.batch_window),
+            "LLM_BATCH_POLL_INTERVAL": str(args.batch_poll_interval),
+            "LLM_BATCH_STRAGGLER_WAIT": str(args.batch_straggler_wait),
+            "LLM_BATCH_TIMEOUT": str(args.batch_timeout),
+        })
+
+    runs = []
+    matrix = list(itertools.product(args.pages, args.depth, args.concurrency))
+    try:
+        for n_pages, max_depth, concurrency in matrix:
+            for repeat in range(args.repeat):
+                config = {
+                    "book_content": args.book_content,
+                    "target_readers": args.target_readers,
+                    "n_pages": n_pages,
+                    "max_depth": max_depth,
+                    "concurrency": concurrency,
+                    "pdf": not args.no_pdf,
+                    "models": args.models,
+                }
+                label = f"p{n_pages}-d{max_depth}-c{concurrency}-r{repeat}"
+                config["output_dir"] = os.path.join(work_dir, label)
+                for stub in stubs:
+                    stub.reset_stats()
+                result = run_child(config, env, os.path.join(work_dir, label + ".log"), args.timeout)
+                snapshots = [stub.snapshot() for stub in stubs]
+                result["stub"] = {key: sum(snapshot[key] for snapshot in snapshots) for key in snapshots[0]}
+                if len(stubs) > 1:
+                    result["stub_endpoints"] = snapshots
+                runs.append({"key": config_key(config), "repeat": repeat, "config": config, **result})
+                logging.info(
+                    f"{config_key(config)} repeat={repeat}: "
+                    + (f"{result['wall_seconds']:.2f}s, {result['llm_calls']} LLM calls" if result.get("wall_seconds") is not None else "no result")
+                    + ("" if result["ok"] else f" ({result['error']})")
+                )
+    finally:
+        for stub in stubs:
+            stub.stop()
+        if args.keep_output:
+            logging.info(f"generated books and logs are kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        **git_revision(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "provider": args.provider,
+        "latexmk": shutil.which("latexmk") is not None,
+        "stub": stubs[0].settings,
+        "endpoints": len(stubs),
+        "batch": args.batch,
+        "runs": runs,
+        "summary": summarize(runs),
+    }
+
+def run_child(config: dict, env: dict, log_path: str, timeout: float) -> dict:
+    """1冊の生成を別プロセスで実行します。ピークRSSを構成ごとに測るため、毎回新しいプロセスを使います。"""
+    result_path = log_path[:-len(".log")] + ".json"
+    command = [sys.executable, "-m", "benchmarks.run_benchmark", "--child", json.dumps(config, ensure_ascii=False), "--child-output", result_path]
+    try:
+        with open(log_path, "w", encoding="UTF-8") as log:
+            process = subprocess.run(command, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"ok": False, "error": f"timed out after {timeout}s"}
+    if not os.path.exists(result_path):
+        return {"ok": False, "error": f"benchmark process exited with {process.returncode} (see {log_path})"}
+    with open(result_path, encoding="UTF-8") as f:
+        return json.load(f)
+
+def summarize(runs: list) -> dict:
+    """構成ごとに、繰り返した計測の中央値(RSSは最大値)をまとめます。"""
+    summary = {}
+    for key, group in itertools.groupby(runs, key=lambda run: run["key"]):
+        group = [run for run in group if run.get("ok")]
+        if not group:
+            summary[key] = {"ok": 0}
+            continue
+        def median(name):
+            values = [run[name] for run in group if run.get(name) is not None]
+            return round(statistics.median(values), 3) if values else None
+        summary[key] = {
+            "ok": len(group),
+            "wall_seconds": median("wall_seconds"),
+            "critical_path_seconds": median("critical_path_seconds"),
+            "llm_serial_seconds": median("llm_serial_seconds"),
+            "llm_calls": median("llm_calls"),
+            "latex_compile_seconds": median("latex_compile_seconds"),
+            "peak_rss_bytes": max(run["peak_rss_bytes"] for run in group),
+            "rate_limited": statistics.median(run["stub"]["rate_limited"] for run in group),
+        }
+    return summary
+
+def compare(results: dict, baseline: dict, max_regression: float = None) -> bool:
+    """基準の結果と構成ごとの実行時間を比べて表示します。max_regression を超えて遅くなった構成があれば False を返します。"""
+    ok = True
+    print(f"baseline {baseline.get('commit', '')[:10]} -> current {results.get('commit', '')[:10]}")
+    print(f"{'configuration':<40} {'wall':>18} {'critical path':>18} {'peak RSS MB':>16}")
+    for key, current in results["summary"].items():
+        previous = baseline.get("summary", {}).get(key)
+        if not previous or not previous.get("ok") or not current.get("ok"):
+            continue
+        ratio = current["wall_seconds"] / previous["wall_seconds"] if previous["wall_seconds"] else 1.0
+        regressed = max_regression is not None and ratio > 1 + max_regression
+        ok = ok and not regressed
+        print(
+            f"{key:<40} {previous['wall_seconds']:>7.2f} -> {current['wall_seconds']:>7.2f} "
+            f"{previous['critical_path_seconds']:>7.2f} -> {current['critical_path_seconds']:>7.2f} "
+            f"{previous['peak_rss_bytes'] / 2**20:>6.0f} -> {current['peak_rss_bytes'] / 2**20:>6.0f}"
+            f"{'  REGRESSION' if regressed else ''}"
+        )
+    return ok
+
+def print_summary(results: dict):
+    print(f"{'configuration':<40} {'ok':>3} {'wall':>8} {'critical':>9} {'LLM calls':>10} {'LaTeX':>7} {'RSS MB':>7}")
+    for key, row in results["summary"].items():
+        if not row.get("ok"):
+            print(f"{key:<40} {0:>3}")
+            continue
+        latex = f"{row['latex_compile_seconds']:.2f}" if row["latex_compile_seconds"] is not None else "-"
+        print(
+            f"{key:<40} {row['ok']:>3} {row['wall_seconds']:>8.2f} {row['critical_path_seconds']:>9.2f} "
+            f"{row['llm_calls']:>10.0f} {latex:>7} {row['peak_rss_bytes'] / 2**20:>7.0f}"
+        )
+
+def parse_models(text: str) -> dict:
+    return dict(item.split("=", 1) for item in text.split(",") if "=" in item)
+
+def parse_list(text: str) -> list:
+    return [int(value) for value in text.split(",") if value.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark book generation end to end against a local OpenAI-compatible stub.")
+    parser.add_argument('--pages', type=parse_list, help='ページ数 (カンマ区切り)', default=[4, 8])
+    parser.add_argument('--depth', type=parse_list, help='目次の最大の深さ (カンマ区切り)', default=[2, 3])
+    parser.add_argument('--concurrency', type=parse_list, help='LLMの同時呼び出し数 (カンマ区切り、0は既定値)', default=[1, 8])
+    parser.add_argument('--repeat', type=int, help='各構成を繰り返す回数', default=1)
+    parser.add_argument('--book-content', type=str, default="Pythonプログラミング入門")
+    parser.add_argument('--target-readers', type=str, default="プログラミング初心者")
+    parser.add_argument('--provider', type=str, help='スタブを呼び出すプロバイダの経路', default="OPENAI", choices=["OPENAI", "ANTHROPIC", "OLLAMA"])
+    parser.add_argument('--endpoints', type=int, help='起動するスタブの数 (2以上で <PROVIDER>_ENDPOINTS により振り分ける)', default=1)
+    parser.add_argument('--models', type=parse_models, help='プロンプトの種類ごとのモデル (例: dirname=small,content=large)', default=None)
+    parser.add_argument('--batch', action='store_true', help='章・節の生成をバッチAPIで送る (LLM_BATCH_MODE=1)')
+    parser.add_argument('--batch-window', type=float, help='バッチにまとめるまで待つ秒数', default=0.2)
+    parser.add_argument('--batch-poll-interval', type=float, help='バッチの状態を確認する間隔(秒)', default=0.2)
+    parser.add_argument('--batch-straggler-wait', type=float, help='残りのリクエストを同期呼び出しに切り替えるまで待つ秒数', default=1)
+    parser.add_argument('--batch-timeout', type=float, help='バッチを取り消して同期呼び出しに切り替えるまでの秒数', default=10)
+    parser.add_argument('--batch-latency-ms', type=float, help='スタブがバッチを処理し始めるまでの時間(ミリ秒)', default=0)
+    parser.add_argument('--batch-straggler-rate', type=float, help='スタブのバッチで取り消されるまで終わらないリクエストの割合', default=0)
+    parser.add_argument('--no-pdf', action='store_true', help='表紙とPDFの生成を省略する')
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--latency-per-token-ms', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rpm', type=int, default=0)
+    parser.add_argument('--max-inflight', type=int, default=0)
+    parser.add_argument('--output-tokens', type=int, default=400)
+    parser.add_argument('--subdivide', type=float, default=0.3)
+    parser.add_argument('--seed', type=str, default="0")
+    parser.add_argument('--timeout', type=float, help='1冊あたりの制限時間(秒)', default=1800)
+    parser.add_argument('--output', type=str, help='結果のJSONファイル', default=None)
+    parser.add_argument('--baseline', type=str, help='比較する過去の結果のJSONファイル', default=None)
+    parser.add_argument('--max-regression', type=float, help='基準よりこの割合を超えて遅くなったら終了コード1で終わる', default=None)
+    parser.add_argument('--keep-output', action='store_true', help='生成した本とログを残す')
+    parser.add_argument('--child', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--child-output', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_book(json.loads(args.child))
+        with open(args.child_output, "w", encoding="UTF-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    results = run_matrix(args)
+    output = args.output or os.path.join(
+        DEFAULT_RESULTS_DIR, f"{results['commit'][:10] or 'unknown'}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="UTF-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print_summary(results)
+    print(f"results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="UTF-8") as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import io
+import json
+import time
+import wave
+import zipfile
+import argparse
+import threading
+import numpy as np
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_RATE = 24000
+
+class tts_stub:
+    """
+    VOICEVOX互換のTTSエンジンの代わりに、テキストの長さに応じた音声(正弦波)を返すローカルサーバー。
+    /version・/audio_query・/synthesis・/multi_synthesis に対応します。
+    実際のエンジンと同じく、同時に合成できる数(max_concurrency)を超えたリクエストは順番待ちになります。
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0,
+                 realtime_factor: float = 0, seconds_per_char: float = 0.12, max_concurrency: int = 1,
+                 transfer_ms: float = 0, fail_status: int = 0, multi_synthesis: bool = True):
+        # 合成の所要時間 = 基本の遅延 + 生成する音声の長さ × realtime_factor
+        self.latency_ms = latency_ms
+        self.realtime_factor = realtime_factor
+        self.seconds_per_char = seconds_per_char
+        # 合成した音声の本体を送るのにかかる時間 (ヘッダーを送った後に待つ)
+        self.transfer_ms = transfer_ms
+        # 0以外の場合は、POSTに常にこのステータスを返す (フェイルオーバーの確認用)
+        self.fail_status = fail_status
+        # False の場合は /multi_synthesis に404を返す (対応していないエンジンの再現)
+        self.multi_synthesis_enabled = multi_synthesis
+        self.settings = {
+            "latency_ms": latency_ms,
+            "realtime_factor": realtime_factor,
+            "seconds_per_char": seconds_per_char,
+            "max_concurrency": max_concurrency,
+            "transfer_ms": transfer_ms,
+            "fail_status": fail_status,
+        }
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.stats = {"audio_query": 0, "synthesis": 0, "multi_synthesis": 0, "audio_seconds": 0.0,
+                      "errors": 0, "inflight": 0, "peak_inflight": 0}
+
+        stub = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if urlparse(self.path).path == "/version":
+                    self._send(200, json.dumps("0.0.0-stub").encode("utf-8"), "application/json")
+                else:
+                    self._send(404, b'{"detail": "Not Found"}', "application/json")
+
+            def do_POST(self):
+                # 受け付けてから本体を送り終えるまでを処理中として数える
+                stub._track(1)
+                try:
+                    self._post()
+                finally:
+                    stub._track(-1)
+
+            def _post(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if stub.fail_status:
+                    stub._count("errors")
+                    self._send(stub.fail_status, b'{"detail": "stub failure"}', "application/json")
+                elif url.path == "/audio_query":
+                    query = stub.audio_query(params.get("text", [""])[0])
+                    self._send(200, json.dumps(query, ensure_ascii=False).encode("utf-8"), "application/json")
+                elif url.path == "/synthesis":
+                    self._send(200, stub.synthesis(json.loads(body)), "audio/wav")
+                elif url.path == "/multi_synthesis" and stub.multi_synthesis_enabled:
+                    self._send(200, stub.multi_synthesis(json.loads(body)), "application/zip")
+                else:
+                    self._send(404, b'{"detail": "Not Found"}', "application/json")
+
+            def _send(self, status: int, data: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if stub.transfer_ms and content_type != "application/json":
+                    # 本体の前半を送ってから待ち、転送に時間がかかる状況を再現する
+                    self.wfile.write(data[:len(data) // 2])
+                    self.wfile.flush()
+                    time.sleep(stub.transfer_ms / 1000)
+                    data = data[len(data) // 2:]
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, name: str, audio_seconds: float = 0.0):
+        with self._lock:
+            self.stats[name] += 1
+            self.stats["audio_seconds"] += audio_seconds
+
+    def _track(self, delta: int):
+        with self._lock:
+            self.stats["inflight"] += delta
+            self.stats["peak_inflight"] = max(self.stats["peak_inflight"], self.stats["inflight"])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+    def audio_query(self, text: str) -> dict:
+        self._count("audio_query")
+        return {
+            "accent_phrases": [],
+            "speedScale": 1.0,
+            "pitchScale": 0.0,
+            "intonationScale": 1.0,
+            "volumeScale": 1.0,
+            "prePhonemeLength": 0.1,
+            "postPhonemeLength": 0.1,
+            "outputSamplingRate": SAMPLE_RATE,
+            "outputStereo": False,
+            "kana": text,
+        }
+
+    def render(self, query: dict):
+        """クエリのテキストの長さに比例した長さの音声を作ります。"""
+        seconds = max(0.2, len(query.get("kana", "")) * self.seconds_per_char / query.get("speedScale", 1.0))
+        t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+        # 無音として削られないよう、-20dBFS程度の正弦波にする
+        samples = (np.sin(2 * np.pi * 220 * t) * 3000).astype("<i2")
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(SAMPLE_RATE)
+            w.writeframes(samples.tobytes())
+        return buffer.getvalue(), seconds
+
+    def synthesize(self, queries: list):
+        with self._slots:
+            results = [self.render(query) for query in queries]
+            audio_seconds = sum(seconds for _, seconds in results)
+            time.sleep(self.latency_ms / 1000 + audio_seconds * self.realtime_factor)
+        return results, audio_seconds
+
+    def synthesis(self, query: dict) -> bytes:
+        results, audio_seconds = self.synthesize([query])
+        self._count("synthesis", audio_seconds)
+        return results[0][0]
+
+    def multi_synthesis(self, queries: list) -> bytes:
+        results, audio_seconds = self.synthesize(queries)
+        self._count("multi_synthesis", audio_seconds)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+            for i, (data, _) in enumerate(results):
+                zf.writestr(f"{i + 1:03}.wav", data)
+        return buffer.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local VOICEVOX-compatible stub TTS engine.")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=50021)
+    parser.add_argument('--latency-ms', type=float, help='合成1回あたりの遅延(ミリ秒)', default=0)
+    parser.add_argument('--realtime-factor', type=float, help='音声1秒あたりの合成時間(秒)', default=0)
+    parser.add_argument('--max-concurrency', type=int, help='同時に合成する数', default=1)
+    parser.add_argument('--transfer-ms', type=float, help='音声の本体を送るのにかかる時間(ミリ秒)', default=0)
+    parser.add_argument('--fail-status', type=int, help='POSTに常に返すステータス (0で無効)', default=0)
+    args = parser.parse_args()
+
+    stub = tts_stub(args.host, args.port, args.latency_ms, args.realtime_factor, max_concurrency=args.max_concurrency,
+                    transfer_ms=args.transfer_ms, fail_status=args.fail_status)
+    print(f"VOICEVOX-compatible stub listening on {stub.url}", flush=True)
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
+
+if __name__ == "__main__":
+    main()
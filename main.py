@@ -1,16 +1,38 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Response
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Response, Header
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Dict
 import os
-from AutoGenBook import BookGenerator
-from utils.models import llms
+import json
+import time
+from urllib.parse import quote
+import threading
+from contextlib import asynccontextmanager
+from worker import start_workers, supervise, stop_workers
+from utils.job_queue import job_queue, queue_full
+from utils.artifact_manifest import artifact_index
+from utils.zip_stream import zip_stream, bundle_entries, parse_range
+from utils.audio_segments import iter_stream, SEGMENT_DIRNAME, SEGMENT_PATTERN, PLAYLIST_FILENAME
+from utils.audio_encoder import AUDIO_FORMATS
+from utils.models import PROVIDERS, PROMPT_KINDS
 import uvicorn
-import glob
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # JOB_EMBEDDED_WORKERS=0 の場合は、別途 worker.py でワーカーを起動する
+    n_workers = int(os.environ.get("JOB_EMBEDDED_WORKERS", "1"))
+    processes = start_workers(n_workers) if n_workers > 0 else []
+    stop = threading.Event()
+    if processes:
+        threading.Thread(target=supervise, args=(processes,), kwargs={"stop": stop}, daemon=True).start()
+    yield
+    stop.set()
+    stop_workers(processes)
 
 app = FastAPI(
     title="AutoGenBook API",
     description="本の自動生成APIサービス",
+    lifespan=lifespan,
 )
 
 class BookRequest(BaseModel):
@@ -19,6 +41,11 @@ class BookRequest(BaseModel):
     n_pages: int
     level: Optional[int] = None
     wav_output: Optional[int] = 0
+    audio_format: Optional[str] = "wav"
+    profile: Optional[bool] = False
+    provider: Optional[str] = None  # 省略時は環境変数 PROVIDER
+    model: Optional[str] = None  # 省略時は環境変数 MODEL (PROVIDERと異なる場合は <PROVIDER>_MODEL)
+    models: Optional[Dict[str, str]] = None  # プロンプトの種類ごとのモデル (dirname, outline, content, cover, kana)
 
 class BookResponse(BaseModel):
     status: str
@@ -26,122 +53,120 @@ class BookResponse(BaseModel):
     task_id: str
     output_dir: Optional[str] = None
     author: Optional[str] = None
+    deduplicated: bool = False
 
-# 進行状況を保存する辞書
-task_status = {}
-
-def generate_book_task(task_id: str, request: BookRequest):
-    try:
-        bookgenerator = BookGenerator()
-        llm = llms()
-        author = f"{llm.get_provider_name()}:{llm.get_model_name()}"
-        
-        # 初期化
-        bookgenerator.initialize(request.book_content, request.target_readers, request.n_pages)
-
-        if request.level:
-            bookgenerator.set_equation_frequency_level(request.level)
-
-        # 本の概要を生成
-        bookgenerator.generate_book_title_and_summary()
-        
-        # 本の中身を生成
-        bookgenerator.generate_book_detail()
-        
-        # PDFを生成
-        filename = bookgenerator.create_pdf()
-
-        # wavファイルを生成
-        if request.wav_output > 0:
-            wav_filename = bookgenerator.create_wav(filename,request.wav_output)
-            if wav_filename:
-                wav_files = glob.glob(os.path.join(bookgenerator.home_dir, "*.wav"))
-                if wav_files:
-                    wav_path = wav_files[0]
-                    wav_filename = os.path.basename(wav_path)
-                else:
-                    wav_filename = None
-                    wav_path = None
-        else:
-            wav_filename = None
-            wav_path = None
-        # カバー画像のパスを取得（.png ファイルを検索）
-        cover_files = glob.glob(os.path.join(bookgenerator.home_dir, "*.png"))
-        if cover_files:
-            cover_path = cover_files[0]  # 完全なパス
-            cover_filename = os.path.basename(cover_path)  # ファイル名のみ
-        else:
-            cover_path = None
-            cover_filename = None
-
-        # タスクの状態を更新
-        task_status[task_id] = {
-            "status": "completed",
-            "output_dir": bookgenerator.home_dir,
-            "title": bookgenerator.book_node["title"],
-            "cover_path": cover_path,
-            "cover_filename": cover_filename,
-            "wav_path": wav_path,
-            "wav_filename": wav_filename,
-            "author": author
-        }
+# ジョブの状態はキュー(SQLite)に保存し、生成はワーカープロセスで行う
+jobs = job_queue()
+# タスクIDから本の成果物(manifest.json)を引く索引
+artifacts = artifact_index(jobs.db_path)
 
-    except Exception as e:
-        task_status[task_id] = {
-            "status": "failed",
-            "error": str(e)
-        }
+def get_task(task_id: str) -> dict:
+    task = jobs.status(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return task
 
 @app.post("/generate-book", response_model=BookResponse)
-async def generate_book(request: BookRequest, background_tasks: BackgroundTasks):
+async def generate_book(request: BookRequest):
     import uuid
+    if request.audio_format not in AUDIO_FORMATS:
+        raise HTTPException(status_code=400, detail=f"audio_format must be one of {', '.join(AUDIO_FORMATS)}")
+    if request.provider is not None:
+        request.provider = request.provider.upper()
+        if request.provider not in PROVIDERS:
+            raise HTTPException(status_code=400, detail=f"provider must be one of {', '.join(PROVIDERS)}")
+    if request.models and not set(request.models) <= set(PROMPT_KINDS):
+        raise HTTPException(status_code=400, detail=f"models keys must be among {', '.join(PROMPT_KINDS)}")
     task_id = str(uuid.uuid4())
     
-    # タスクの初期状態を設定
-    task_status[task_id] = {
-        "status": "processing",
-        "author": None
-    }
-    
-    # バックグラウンドタスクとして本の生成を開始
-    background_tasks.add_task(generate_book_task, task_id, request)
-    
+    # キューに登録し、空いているワーカーが生成を開始する
+    # 同じ内容のリクエストが直前に登録されていれば、そのタスクIDが返る
+    try:
+        leader_id = jobs.enqueue(task_id, request.model_dump(), {
+            "author": None,
+            "wav_output": request.wav_output,
+            "audio_format": request.audio_format
+        })
+    except queue_full as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    if leader_id != task_id:
+        return {
+            "status": "accepted",
+            "message": "同じ内容の本の生成に合流しました",
+            "task_id": leader_id,
+            "author": None,
+            "deduplicated": True
+        }
     return {
         "status": "accepted",
-        "message": "本の生成を開始しました",
+        "message": "本の生成を受け付けました",
         "task_id": task_id,
         "author": None
     }
 
 @app.get("/task/{task_id}")
 async def get_task_status(task_id: str):
-    if task_id not in task_status:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = task_status[task_id]
+    task = get_task(task_id)
     if task["status"] == "failed":
         raise HTTPException(status_code=500, detail=task["error"])
     
     return task
 
-@app.get("/download/{task_id}")
-async def download_book(task_id: str):
-    if task_id not in task_status:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = task_status[task_id]
+def event_stream(task_id: str, last_event_id: int, poll_interval: float = 0.5, keepalive: float = 15.0):
+    """
+    タスクの進捗イベントをSSE形式で送出します。
+    タスクが終了し、未送出のイベントがなくなった時点で終了します。
+    """
+    yield "retry: 3000\n\n"
+    last_sent = time.monotonic()
+    while True:
+        # 先に状態を読み、その後のイベントを読み切ってから終了判定する
+        status = jobs.get(task_id)["status"]
+        events = jobs.events(task_id, last_event_id)
+        for event in events:
+            last_event_id = event["id"]
+            data = json.dumps({**event["data"], "created_at": event["created_at"]}, ensure_ascii=False, default=str)
+            yield f"id: {event['id']}\nevent: {event['event']}\ndata: {data}\n\n"
+            last_sent = time.monotonic()
+        if events:
+            continue
+        if status in ("completed", "failed"):
+            return
+        if time.monotonic() - last_sent >= keepalive:
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+        time.sleep(poll_interval)
+
+@app.get("/events/{task_id}")
+async def task_events(task_id: str, last_event_id: Optional[int] = None,
+                      last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")):
+    get_task(task_id)
+    # 再接続時はブラウザが送るLast-Event-IDヘッダ、またはクエリの last_event_id から再開する
+    if last_event_id is None:
+        last_event_id = int(last_event_id_header) if last_event_id_header and last_event_id_header.isdigit() else 0
+    return StreamingResponse(
+        event_stream(task_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def get_artifact(task_id: str, name: str, label: str) -> dict:
+    """完了したタスクの成果物を、索引とmanifestから引きます。"""
+    task = get_task(task_id)
     if task["status"] != "completed":
         raise HTTPException(status_code=400, detail="Book generation is not completed")
-    
-    # PDFファイルのパスを構築
-    pdf_path = os.path.join(task["output_dir"], f"{task['title']}.pdf")
-    
-    if not os.path.exists(pdf_path):
-        raise HTTPException(status_code=404, detail="PDF file not found")
-    
+    entry = artifacts.artifact(task_id, name)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    return entry
+
+@app.get("/download/{task_id}")
+async def download_book(task_id: str):
+    entry = get_artifact(task_id, "pdf", "PDF file")
     return FileResponse(
-        path=pdf_path,
-        filename=f"{task['title']}.pdf",
+        path=entry["path"],
+        filename=os.path.basename(entry["path"]),
         media_type="application/pdf"
     )
 
@@ -151,35 +176,94 @@ async def health_check():
 
 @app.get("/download-cover/{task_id}")
 async def download_cover(task_id: str):
-    if task_id not in task_status:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = task_status[task_id]
-    if task["status"] != "completed":
-        raise HTTPException(status_code=400, detail="Book generation is not completed")
-    
-    if not task.get("cover_path"):
-        raise HTTPException(status_code=404, detail="Cover image not found")
-    
+    entry = get_artifact(task_id, "cover_png", "Cover image")
     return FileResponse(
-        path=task["cover_path"],
-        filename=task["cover_filename"],
+        path=entry["path"],
+        filename=os.path.basename(entry["path"]),
         media_type="image/png"
     )
 
 @app.get("/download-wav/{task_id}")
+@app.get("/download-audio/{task_id}")
 async def download_wav(task_id: str):
-    if task_id not in task_status:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = task_status[task_id]
+    entry = get_artifact(task_id, "audio", "Audio file")
+    # 選択された形式のまま配信する
+    media_type = AUDIO_FORMATS[entry.get("format") or "wav"]["media_type"]
+    return FileResponse(path=entry["path"], filename=os.path.basename(entry["path"]), media_type=media_type)
+
+@app.get("/download-bundle/{task_id}")
+def download_bundle(task_id: str, range_header: Optional[str] = Header(None, alias="Range"),
+                    if_range: Optional[str] = Header(None, alias="If-Range")):
+    task = get_task(task_id)
     if task["status"] != "completed":
         raise HTTPException(status_code=400, detail="Book generation is not completed")
-    
-    if not os.path.exists(task["wav_path"]):
-        raise HTTPException(status_code=404, detail="WAV file not found")
-    
-    return FileResponse(path=task["wav_path"], filename=task["wav_filename"], media_type="audio/wav")   
+    home_dir = artifacts.home_dir(task_id)
+    manifest = artifacts.manifest(task_id)
+    if not manifest:
+        raise HTTPException(status_code=404, detail="Artifacts not found")
+
+    # 各ファイルのサイズとCRC-32はmanifestの記録を使うため、メディアを読み直さずに配置が決まる
+    bundle = zip_stream(bundle_entries(manifest, home_dir))
+    etag = f'"{bundle.etag}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(os.path.basename(os.path.normpath(home_dir)))}.zip",
+    }
+    if if_range and if_range != etag:
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, bundle.size)
+    except ValueError:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{bundle.size}"})
+    if byte_range is None:
+        headers["Content-Length"] = str(bundle.size)
+        return StreamingResponse(bundle.iter_range(), media_type="application/zip", headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{bundle.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(bundle.iter_range(start, end), status_code=206, media_type="application/zip", headers=headers)
+
+def get_streaming_task(task_id: str):
+    task = get_task(task_id)
+    if task["status"] == "failed":
+        raise HTTPException(status_code=500, detail=task["error"])
+    if not task.get("wav_output"):
+        raise HTTPException(status_code=404, detail="WAV output is not requested")
+    return task
+
+def stream_audio(task_id: str):
+    is_running = lambda: jobs.status(task_id)["status"] in ("queued", "processing")
+    # 出力先が決まるまで待つ
+    while is_running() and not jobs.status(task_id).get("output_dir"):
+        time.sleep(1)
+    output_dir = jobs.status(task_id).get("output_dir")
+    if not output_dir:
+        return
+    yield from iter_stream(os.path.join(output_dir, SEGMENT_DIRNAME), is_running)
+
+@app.get("/stream-wav/{task_id}")
+async def stream_wav(task_id: str):
+    get_streaming_task(task_id)
+    # 完成した章から順にchunkedで送出する
+    return StreamingResponse(stream_audio(task_id), media_type="audio/wav")
+
+@app.get("/stream-wav/{task_id}/{filename}")
+async def download_wav_segment(task_id: str, filename: str):
+    task = get_streaming_task(task_id)
+    if not task.get("output_dir"):
+        raise HTTPException(status_code=404, detail="Audio segment not found")
+
+    if filename != PLAYLIST_FILENAME and not SEGMENT_PATTERN.fullmatch(filename):
+        raise HTTPException(status_code=404, detail="Audio segment not found")
+    path = os.path.join(task["output_dir"], SEGMENT_DIRNAME, filename)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Audio segment not found")
+
+    if filename == PLAYLIST_FILENAME:
+        with open(path, encoding="UTF-8") as f:
+            return Response(content=f.read(), media_type="audio/x-mpegurl")
+    return FileResponse(path=path, filename=filename, media_type="audio/wav")
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8100, reload=True)
+    uvicorn.run("main:app", host="0.0.0.0", port=8100)
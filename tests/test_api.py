@@ -0,0 +1,115 @@
+import io
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+from utils.artifact_manifest import artifact_index, artifact_manifest
+from utils.audio_segments import SEGMENT_DIRNAME
+from utils.job_queue import job_queue
+
+REQUEST = {"book_content": "統計", "target_readers": "学生", "n_pages": 3, "wav_output": 1}
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    """ワーカーを起動せず (lifespanを実行しない)、一時的なキューでAPIを呼び出します。"""
+    db_path = str(tmp_path / "jobs.sqlite3")
+    monkeypatch.setenv("JOB_DB_PATH", db_path)
+    import main
+
+    def client(**settings):
+        for name, value in settings.items():
+            monkeypatch.setenv(name, str(value))
+        queue = job_queue(db_path)
+        monkeypatch.setattr(main, "jobs", queue)
+        monkeypatch.setattr(main, "artifacts", artifact_index(db_path))
+        return TestClient(main.app), queue
+
+    return client
+
+def test_segments_beyond_999_are_served(api, tmp_path):
+    client, queue = api()
+    queue.enqueue("task", dict(REQUEST), {"wav_output": 1})
+    queue.claim("worker")
+    queue.update("task", "worker", output_dir=str(tmp_path))
+    segment_dir = tmp_path / SEGMENT_DIRNAME
+    segment_dir.mkdir()
+    for name in ("001.wav", "1000.wav"):
+        (segment_dir / name).write_bytes(b"RIFF")
+
+    for name in ("001.wav", "1000.wav"):
+        response = client.get(f"/stream-wav/task/{name}")
+        assert response.status_code == 200
+        assert response.content == b"RIFF"
+    assert client.get("/stream-wav/task/01.wav").status_code == 404
+    assert client.get("/stream-wav/task/cover.wav").status_code == 404
+
+def test_full_queue_returns_429_with_retry_after(api):
+    client, queue = api(JOB_MAX_QUEUED=2, JOB_SECONDS_PER_PAGE=60, JOB_MAX_RUNNING=0, JOB_MAX_PAGES_IN_FLIGHT=0)
+    task_ids = []
+    for content in ("統計", "線形代数"):
+        response = client.post("/generate-book", json={"book_content": content, "target_readers": "学生", "n_pages": 3})
+        assert response.status_code == 200
+        task_ids.append(response.json()["task_id"])
+
+    response = client.post("/generate-book", json={"book_content": "微分積分", "target_readers": "学生", "n_pages": 3})
+    assert response.status_code == 429
+    assert "too many queued books (2/2)" in response.json()["detail"]
+    # 待機中の6ページ×60秒を、処理中・待機中の2件で割った1件あたりの時間
+    assert response.headers["Retry-After"] == "180"
+
+    # 2件目は1件目(3ページ)の後に並び、自分の3ページを加えた時間で終わる見込み
+    task = client.get(f"/task/{task_ids[1]}").json()
+    assert (task["queue_position"], task["eta_seconds"]) == (2, 360)
+
+def test_pages_in_flight_limit(api):
+    client, queue = api(JOB_MAX_QUEUED=0, JOB_SECONDS_PER_PAGE=60, JOB_MAX_RUNNING=0, JOB_MAX_PAGES_IN_FLIGHT=10,
+                        JOB_AUDIO_PAGE_WEIGHT=1.0)
+    # 音声付きの本は合成の分を含めて 4×2=8 ページと見積もる
+    assert client.post("/generate-book", json={"book_content": "統計", "target_readers": "学生", "n_pages": 4, "wav_output": 1}).status_code == 200
+    response = client.post("/generate-book", json={"book_content": "線形代数", "target_readers": "学生", "n_pages": 3})
+    assert response.status_code == 429
+    assert "too many pages in flight (8+3/10)" in response.json()["detail"]
+    assert response.headers["Retry-After"] == "480"
+    assert client.post("/generate-book", json={"book_content": "線形代数", "target_readers": "学生", "n_pages": 2}).status_code == 200
+
+def test_download_bundle_ranges(api, tmp_path):
+    client, queue = api()
+    home_dir = tmp_path / "統計の本"
+    (home_dir / "tex").mkdir(parents=True)
+    (home_dir / "book.pdf").write_bytes(b"%PDF-1.5" + bytes(range(256)) * 100)
+    (home_dir / "tex" / "1-1-p.tex").write_text("\\section{はじめに}\n" * 100, encoding="UTF-8")
+    manifest = artifact_manifest(str(home_dir))
+    manifest.record("pdf", str(home_dir / "book.pdf"))
+    manifest.record("tex/1-1-p.tex", str(home_dir / "tex" / "1-1-p.tex"))
+    queue.enqueue("task", dict(REQUEST))
+    queue.claim("worker")
+    queue.complete("task", "worker", {"output_dir": str(home_dir)})
+    artifact_index(queue.db_path).register("task", str(home_dir))
+
+    response = client.get("/download-bundle/task")
+    assert response.status_code == 200
+    bundle = response.content
+    assert response.headers["Content-Length"] == str(len(bundle))
+    with zipfile.ZipFile(io.BytesIO(bundle)) as zf:
+        assert zf.testzip() is None
+        assert zf.read("統計の本/book.pdf") == (home_dir / "book.pdf").read_bytes()
+        assert "統計の本/tex/1-1-p.tex" in zf.namelist()
+        assert "統計の本/manifest.json" in zf.namelist()
+
+    # 途中から再開する: 後半だけを受け取り、前半とつなげると同じZIPになる
+    etag = response.headers["ETag"]
+    response = client.get("/download-bundle/task", headers={"Range": "bytes=100-", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 100-{len(bundle) - 1}/{len(bundle)}"
+    assert bundle[:100] + response.content == bundle
+    response = client.get("/download-bundle/task", headers={"Range": "bytes=-10"})
+    assert (response.status_code, response.content) == (206, bundle[-10:])
+
+    # ETagが変わっていれば全体を送り直す
+    response = client.get("/download-bundle/task", headers={"Range": "bytes=100-", "If-Range": '"stale"'})
+    assert (response.status_code, response.content) == (200, bundle)
+
+    response = client.get("/download-bundle/task", headers={"Range": f"bytes={len(bundle)}-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(bundle)}"
@@ -0,0 +1,60 @@
+import os
+import zlib
+import hashlib
+
+from utils.artifact_manifest import artifact_manifest, artifact_index, MANIFEST_FILENAME
+
+def test_record_stores_digest_and_survives_reload(tmp_path):
+    pdf = tmp_path / "book.pdf"
+    pdf.write_bytes(b"%PDF-1.5 test")
+    manifest = artifact_manifest(str(tmp_path))
+    entry = manifest.record("pdf", str(pdf), seconds=1.23456, pages=3)
+    assert entry["relpath"] == "book.pdf"
+    assert entry["size"] == len(b"%PDF-1.5 test")
+    assert entry["sha256"] == hashlib.sha256(b"%PDF-1.5 test").hexdigest()
+    assert entry["crc32"] == zlib.crc32(b"%PDF-1.5 test")
+    assert (entry["seconds"], entry["pages"]) == (1.235, 3)
+    # 存在しないファイルは記録しない
+    assert manifest.record("cover_png", str(tmp_path / "cover.png")) is None
+
+    manifest.timing("pdf", 2.0)
+    reloaded = artifact_manifest(str(tmp_path))
+    assert reloaded.get("pdf") == entry
+    assert reloaded.get("cover_png") is None
+    assert reloaded.data["timings"] == {"pdf": 2.0}
+
+def test_index_resolves_task_to_artifacts(tmp_path):
+    home_dir = tmp_path / "book"
+    home_dir.mkdir()
+    (home_dir / "book.pdf").write_bytes(b"%PDF")
+    artifact_manifest(str(home_dir)).record("pdf", str(home_dir / "book.pdf"))
+
+    index = artifact_index(str(tmp_path / "jobs.sqlite3"))
+    index.register("task", str(home_dir))
+    assert index.home_dir("task") == str(home_dir)
+    assert index.manifest("task")["artifacts"]["pdf"]["relpath"] == "book.pdf"
+    assert index.artifact("task", "pdf")["path"] == str(home_dir / "book.pdf")
+    assert index.artifact("task", "audio") is None
+
+    # 別のインスタンス (別プロセスのワーカー) からも同じ索引が見える
+    assert artifact_index(index.db_path).home_dir("task") == str(home_dir)
+
+def test_missing_files_and_tasks_return_none(tmp_path):
+    home_dir = tmp_path / "book"
+    home_dir.mkdir()
+    (home_dir / "book.pdf").write_bytes(b"%PDF")
+    artifact_manifest(str(home_dir)).record("pdf", str(home_dir / "book.pdf"))
+    index = artifact_index(str(tmp_path / "jobs.sqlite3"))
+    index.register("task", str(home_dir))
+
+    # 記録後にファイルが消えた場合
+    os.remove(home_dir / "book.pdf")
+    assert index.artifact("task", "pdf") is None
+    assert index.manifest("task")["artifacts"]["pdf"]["relpath"] == "book.pdf"
+
+    # manifest.json がない本、登録されていないタスク
+    os.remove(home_dir / MANIFEST_FILENAME)
+    assert index.manifest("task") is None
+    assert index.artifact("task", "pdf") is None
+    assert index.home_dir("unknown") is None
+    assert index.artifact("unknown", "pdf") is None
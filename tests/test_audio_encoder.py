@@ -0,0 +1,73 @@
+import io
+import json
+import math
+import shutil
+import struct
+import subprocess
+import wave
+
+import pytest
+
+from utils.audio_encoder import audio_encoder, AUDIO_FORMATS
+
+def tone(seconds: float, sample_rate: int, channels: int) -> bytes:
+    """440Hzの正弦波のWAV。"""
+    frames = int(seconds * sample_rate)
+    samples = (int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate)) for i in range(frames) for _ in range(channels))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(struct.pack(f"<{frames * channels}h", *samples))
+    return buffer.getvalue()
+
+def probe(path: str) -> dict:
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=format_name,duration:stream=codec_name,sample_rate,channels",
+         "-of", "json", path],
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout)
+
+# ffprobeが報告する (コンテナ, コーデック)
+EXPECTED = {
+    "flac": ("flac", "flac"),
+    "mp3": ("mp3", "mp3"),
+    "opus": ("ogg", "opus"),
+}
+
+def encode_two_chapters(path: str, audio_format: str) -> audio_encoder:
+    encoder = audio_encoder(path, audio_format)
+    # 1章目の形式 (24kHzモノラル) に、形式の異なる2章目 (44.1kHzステレオ) を揃えて続ける
+    encoder.write_wav(io.BytesIO(tone(1.0, 24000, 1)))
+    encoder.write_wav(io.BytesIO(tone(0.5, 44100, 2)))
+    encoder.close()
+    return encoder
+
+def test_wav_chapters_are_concatenated(tmp_path):
+    path = str(tmp_path / "book.wav")
+    encoder = encode_two_chapters(path, "wav")
+    with wave.open(path, "rb") as w:
+        assert (w.getnchannels(), w.getsampwidth(), w.getframerate()) == (1, 2, 24000)
+        assert w.getnframes() == 36000
+    metrics = encoder.metrics()
+    assert (metrics["format"], metrics["duration"]) == ("wav", 1.5)
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None, reason="ffmpeg is not installed")
+@pytest.mark.parametrize("audio_format", sorted(EXPECTED))
+def test_compressed_chapters_are_encoded(tmp_path, audio_format):
+    path = str(tmp_path / f"book.{AUDIO_FORMATS[audio_format]['ext']}")
+    encoder = encode_two_chapters(path, audio_format)
+    metrics = encoder.metrics()
+    assert metrics["duration"] == 1.5
+    assert metrics["size"] > 0
+    assert metrics["encode_cpu_seconds"] is None or metrics["encode_cpu_seconds"] >= 0
+
+    info = probe(path)
+    container, codec = EXPECTED[audio_format]
+    assert container in info["format"]["format_name"].split(",")
+    assert info["streams"][0]["codec_name"] == codec
+    assert info["streams"][0]["channels"] == 1
+    # mp3・opusはエンコーダーの遅延分の無音が前後に付くため、少し長くなることがある
+    assert float(info["format"]["duration"]) == pytest.approx(1.5, abs=0.1)
@@ -0,0 +1,37 @@
+import io
+import wave
+
+import numpy as np
+import pytest
+
+from utils.audio_postprocess import read_wav
+
+def wav_bytes(sample_width: int, frames: int = 100, channels: int = 1) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(sample_width)
+        w.setframerate(24000)
+        w.writeframes(bytes(frames * channels * sample_width))
+    return buffer.getvalue()
+
+def test_path_and_buffer_read_the_same(tmp_path):
+    path = tmp_path / "chunk.wav"
+    path.write_bytes(wav_bytes(2, channels=2))
+
+    from_path = read_wav(str(path))
+    from_buffer = read_wav(io.BytesIO(path.read_bytes()))
+
+    assert from_path[1:] == from_buffer[1:] == (2, 24000)
+    assert from_path[0].shape == from_buffer[0].shape == (100, 2)
+    assert from_path[0].dtype == np.int16
+
+@pytest.mark.parametrize("sample_width", [1, 3])
+def test_unsupported_sample_width_is_rejected(tmp_path, sample_width):
+    path = tmp_path / "chunk.wav"
+    path.write_bytes(wav_bytes(sample_width))
+
+    with pytest.raises(ValueError):
+        read_wav(str(path))
+    with pytest.raises(ValueError):
+        read_wav(io.BytesIO(path.read_bytes()))
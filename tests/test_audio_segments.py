@@ -0,0 +1,14 @@
+import os
+
+from utils.audio_segments import audio_segments, INDEX_FILENAME, PLAYLIST_FILENAME, read_index
+
+def test_only_previous_segments_are_removed(tmp_path):
+    segment_dir = tmp_path / "audio_segments"
+    (segment_dir / "nested").mkdir(parents=True)
+    for name in ("000.wav", "001.wav", INDEX_FILENAME, PLAYLIST_FILENAME, "notes.txt", "cover.wav"):
+        (segment_dir / name).write_bytes(b"old")
+
+    audio_segments(str(segment_dir), ["第1章"])
+
+    assert sorted(os.listdir(segment_dir)) == sorted(["nested", "notes.txt", "cover.wav", INDEX_FILENAME, PLAYLIST_FILENAME])
+    assert read_index(str(segment_dir)) == {"total": 1, "complete": False, "segments": []}
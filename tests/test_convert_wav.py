@@ -0,0 +1,81 @@
+import io
+import zipfile
+
+import pytest
+
+from benchmarks.tts_stub import tts_stub
+
+@pytest.fixture
+def converter(monkeypatch):
+    stub = tts_stub().start()
+    monkeypatch.setenv("PROVIDER", "MOCK")
+    monkeypatch.setenv("VOICE_KIND", "VOICEVOX")
+    monkeypatch.setenv("VOICEVOX_API_URL", stub.url)
+    monkeypatch.setenv("VOICE_BATCH_SIZE", "4")
+    from utils.convert_wav import convert_wav
+    yield convert_wav(), stub
+    stub.stop()
+
+def queries(n: int) -> list:
+    return [{"kana": "あ" * (i + 1), "speedScale": 1.0} for i in range(n)]
+
+def test_multi_synthesis_returns_one_buffer_per_query(converter):
+    cw, stub = converter
+    buffers = cw.generate_audio_batch(queries(3))
+    assert [buffer.read(4) for buffer in buffers] == [b"RIFF"] * 3
+    assert stub.snapshot()["multi_synthesis"] == 1
+
+def test_short_archive_falls_back_to_synthesis(converter, monkeypatch):
+    cw, stub = converter
+    multi_synthesis = stub.multi_synthesis
+
+    def short_archive(items):
+        # 最後の音声が欠けたZIPを返す
+        data = multi_synthesis(items)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(io.BytesIO(data)) as source, zipfile.ZipFile(buffer, "w") as target:
+            for name in source.namelist()[:-1]:
+                target.writestr(name, source.read(name))
+        return buffer.getvalue()
+
+    monkeypatch.setattr(stub, "multi_synthesis", short_archive)
+    buffers = cw.generate_audio_batch(queries(3))
+    assert [buffer.read(4) for buffer in buffers] == [b"RIFF"] * 3
+    assert stub.snapshot()["synthesis"] == 3
+
+def test_broken_archive_falls_back_to_synthesis(converter, monkeypatch):
+    cw, stub = converter
+    monkeypatch.setattr(stub, "multi_synthesis", lambda items: b"not a zip")
+    buffers = cw.generate_audio_batch(queries(2))
+    assert [buffer.read(4) for buffer in buffers] == [b"RIFF"] * 2
+
+def test_unsupported_multi_synthesis_switches_to_single_queries(converter, monkeypatch):
+    cw, stub = converter
+    monkeypatch.setattr(stub, "multi_synthesis_enabled", False)
+    buffers = cw.generate_audio_batch(queries(2))
+    assert [buffer.read(4) for buffer in buffers] == [b"RIFF"] * 2
+    assert cw.multi_synthesis_supported is False
+    assert cw.batch_limit() == 1
+    # 以降はmulti_synthesisを送らない
+    cw.generate_audio_batch(queries(2))
+    assert stub.snapshot()["synthesis"] == 4
+
+def test_query_cache_is_not_shared_between_engines(converter, monkeypatch):
+    cw, stub = converter
+    other = tts_stub().start()
+    try:
+        monkeypatch.setenv("VOICE_KIND", "AIVIS")
+        monkeypatch.setenv("AIVSISPEECH_API_URL", other.url)
+        from utils.convert_wav import convert_wav
+        aivis = convert_wav()
+        text = "エンジンごとのクエリ"
+        for engine in (cw, aivis, cw, aivis):
+            assert engine.generate_query(text)["kana"] == text
+        assert stub.snapshot()["audio_query"] == other.snapshot()["audio_query"] == 1
+
+        # 同じエンジンでもバージョンが変わった場合は取り直す
+        monkeypatch.setattr(aivis, "engine_version", "0.0.1")
+        aivis.generate_query(text)
+        assert other.snapshot()["audio_query"] == 2
+    finally:
+        other.stop()
@@ -0,0 +1,64 @@
+import os
+import re
+import threading
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from utils.cover_image import cover_image, FONT_DIR
+
+def linear_clamp_title_text(title, width):
+    """二分探索にする前の実装 (大きいフォントサイズから1つずつ試す)。"""
+    dr = ImageDraw.Draw(Image.new('RGBA', (500,500), "white"))
+    font_path = os.path.join(FONT_DIR, 'GaramondLight.ttf')
+    for fontSize in range(80, 61, -1):
+        font = ImageFont.truetype(font_path, fontSize)
+        bbox = dr.textbbox((0, 0), title, font=font)
+        if bbox[2] - bbox[0] < width:
+            return fontSize, title
+    for fontSize in range(80, 34, -1):
+        font = ImageFont.truetype(font_path, fontSize)
+        for match in re.finditer(r'\s', title, re.UNICODE):
+            newTitle = u''.join((title[:match.start()], u'\n', title[(match.start()+1):]))
+            bbox = dr.multiline_textbbox((0, 0), newTitle, font=font)
+            if bbox[2] - bbox[0] < width:
+                return fontSize, newTitle
+    return None, None
+
+TITLES = [
+    "Go",
+    "Dify Guide",
+    "Statistics",
+    "Linear Algebra",
+    "Machine Learning Basics",
+    "Introduction to Probability",
+    "Practical Bayesian Statistics for Engineers",
+    "Supercalifragilisticexpialidocious",
+    "A Very Long Title That Cannot Fit On Two Lines At Any Size At All",
+]
+
+@pytest.mark.parametrize("title", TITLES)
+def test_binary_search_matches_linear_search(title):
+    font, newTitle = cover_image().clamp_title_text(title, 420)
+    size = font.size if font else None
+    assert (size, newTitle) == linear_clamp_title_text(title, 420)
+
+def test_concurrent_covers_match_sequential(tmp_path):
+    def generate(filename):
+        return cover_image().generate_image(str(tmp_path), "Machine Learning Basics", "テスト", "Tomatio", "3", "6",
+                                            formats=('png',), filename=filename)["png"]
+
+    expected = Image.open(generate("sequential")).tobytes()
+    paths = [None] * 8
+
+    def run(i):
+        paths[i] = generate(f"parallel-{i}")
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(paths))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for path in paths:
+        with Image.open(path) as im:
+            assert im.tobytes() == expected
@@ -0,0 +1,105 @@
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from benchmarks.tts_stub import tts_stub
+from utils.engine_pool import engine_pool
+
+QUERY = {"kana": "あいうえお", "speedScale": 1.0}
+
+@pytest.fixture
+def stubs():
+    started = []
+
+    def start(**kwargs):
+        stub = tts_stub(**kwargs).start()
+        started.append(stub)
+        return stub
+
+    yield start
+    for stub in started:
+        stub.stop()
+
+def closed_port_url() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+def synthesize(pool: engine_pool):
+    response, body = pool.post_spooled("/synthesis", params={"speaker": 1}, json=QUERY)
+    return response.status_code, body.read(4) if body else None
+
+def test_slot_is_held_until_body_is_read(stubs):
+    # エンジン側は4件同時に処理できるが、プールの上限は1件なので本体の転送中も次のリクエストは送られない
+    stub = stubs(max_concurrency=4, transfer_ms=100)
+    pool = engine_pool([stub.url], max_concurrency=1)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: synthesize(pool), range(4)))
+    assert results == [(200, b"RIFF")] * 4
+    assert stub.snapshot()["peak_inflight"] == 1
+    stats = pool.stats()[0]
+    assert stats["requests"] == 4
+    # 処理時間には転送中の時間も含まれる
+    assert stats["busy_seconds"] >= 0.35
+
+def test_concurrency_cap_per_endpoint(stubs):
+    engines = [stubs(max_concurrency=8, latency_ms=20, transfer_ms=20) for _ in range(2)]
+    pool = engine_pool([engine.url for engine in engines], max_concurrency=2)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: synthesize(pool), range(16)))
+    assert results == [(200, b"RIFF")] * 16
+    for engine in engines:
+        snapshot = engine.snapshot()
+        assert 0 < snapshot["synthesis"]
+        assert snapshot["peak_inflight"] <= 2
+
+def test_failover_on_server_error(stubs):
+    broken = stubs(fail_status=500)
+    healthy = stubs()
+    pool = engine_pool([broken.url, healthy.url], retry_cooldown=60)
+    for _ in range(3):
+        assert synthesize(pool) == (200, b"RIFF")
+    stats = {endpoint["url"]: endpoint for endpoint in pool.stats()}
+    # 失敗したエンジンはクールダウンの間は選ばれない
+    assert stats[broken.url]["errors"] == 1
+    assert not stats[broken.url]["healthy"]
+    assert stats[healthy.url]["requests"] == 3
+    assert broken.snapshot()["errors"] == 1
+
+def test_failover_on_connection_error(stubs):
+    healthy = stubs()
+    dead = closed_port_url()
+    pool = engine_pool([dead, healthy.url], retry_cooldown=60)
+    assert synthesize(pool) == (200, b"RIFF")
+    stats = {endpoint["url"]: endpoint for endpoint in pool.stats()}
+    assert stats[dead]["errors"] == 1
+    assert stats[healthy.url]["requests"] == 1
+
+def test_all_engines_unreachable_raises():
+    pool = engine_pool([closed_port_url(), closed_port_url()])
+    with pytest.raises(RuntimeError):
+        synthesize(pool)
+
+def test_last_error_response_is_returned(stubs):
+    # 全て5xxの場合は最後のレスポンスを返し、本体は読み込まない
+    pool = engine_pool([stubs(fail_status=503).url, stubs(fail_status=500).url])
+    assert synthesize(pool) == (500, None)
+
+def test_unread_responses_are_closed(stubs, monkeypatch):
+    closed = []
+    close = requests.Response.close
+
+    def recording_close(response):
+        closed.append(response.status_code)
+        close(response)
+
+    monkeypatch.setattr(requests.Response, "close", recording_close)
+    # 1台目の500は本体を読まずにフェイルオーバーし、2台目の503は本体を読んでから返す
+    pool = engine_pool([stubs(fail_status=500).url, stubs(fail_status=503).url], retry_cooldown=60)
+    response, body = pool.post_spooled("/synthesis", params={"speaker": 1}, json=QUERY)
+    assert (response.status_code, body) == (503, None)
+    assert sorted(closed) == [500, 503]
+    assert "stub failure" in response.text
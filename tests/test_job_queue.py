@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+from utils.job_queue import job_queue
+
+def book(content: str, n_pages: int = 3) -> dict:
+    return {"book_content": content, "target_readers": "学生", "n_pages": n_pages}
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    def make(lease_seconds: float = 60, max_attempts: int = 3, **settings) -> job_queue:
+        for name, value in settings.items():
+            monkeypatch.setenv(name, str(value))
+        return job_queue(str(tmp_path / "jobs.sqlite3"), lease_seconds, max_attempts)
+
+    return make
+
+def test_expired_lease_is_claimed_again(queue):
+    jobs = queue(lease_seconds=0.2, max_attempts=2)
+    jobs.enqueue("job", book("統計"))
+    assert jobs.claim("crashed")["attempts"] == 1
+    # ハートビートを送らずに落ちたワーカーのリースが切れると、別のワーカーが取得する
+    assert jobs.claim("other") is None
+    time.sleep(0.3)
+    job = jobs.claim("other")
+    assert (job["id"], job["attempts"]) == ("job", 2)
+
+    # 落ちたワーカーのハートビートと結果は反映しない
+    assert not jobs.heartbeat("job", "crashed")
+    assert not jobs.complete("job", "crashed", {"title": "old"})
+    assert jobs.heartbeat("job", "other")
+    assert jobs.complete("job", "other", {"title": "new"})
+    assert jobs.status("job")["status"] == "completed"
+    assert jobs.status("job")["title"] == "new"
+
+def test_job_fails_after_max_attempts(queue):
+    jobs = queue(lease_seconds=0.1, max_attempts=2)
+    jobs.enqueue("job", book("統計"))
+    jobs.claim("first")
+    time.sleep(0.15)
+    jobs.claim("second")
+    time.sleep(0.15)
+    assert jobs.claim("third") is None
+    task = jobs.status("job")
+    assert task["status"] == "failed"
+    assert task["error"] == "worker lost after 2 attempts"
+
+def test_heartbeat_keeps_the_lease(queue):
+    jobs = queue(lease_seconds=0.3)
+    jobs.enqueue("job", book("統計"))
+    jobs.claim("worker")
+    for _ in range(3):
+        time.sleep(0.15)
+        assert jobs.heartbeat("job", "worker")
+    assert jobs.claim("other") is None
+
+def test_max_running_is_respected(queue):
+    jobs = queue(JOB_MAX_RUNNING=2)
+    for content in ("統計", "線形代数", "微分積分"):
+        jobs.enqueue(content, book(content))
+    assert jobs.claim("a")["id"] == "統計"
+    assert jobs.claim("b")["id"] == "線形代数"
+    assert jobs.claim("c") is None
+    jobs.fail("統計", "a", "error")
+    assert jobs.claim("c")["id"] == "微分積分"
+    assert jobs.counts() == {"failed": 1, "processing": 2}
+
+def test_identical_request_joins_the_running_leader(queue):
+    jobs = queue()
+    assert jobs.enqueue("leader", book("統計")) == "leader"
+    jobs.claim("worker")
+    # 前後の空白だけが異なるリクエストも同じ本とみなす
+    assert jobs.enqueue("follower", book(" 統計 ")) == "leader"
+    assert jobs.get("follower") is None
+    assert jobs.status("leader")["followers"] == 1
+    assert [event["event"] for event in jobs.events("leader")][-1] == "coalesced"
+    # 内容が異なるリクエストは別のジョブになる
+    assert jobs.enqueue("other", book("統計", n_pages=4)) == "other"
+
+def test_completed_leader_is_reused(queue):
+    jobs = queue()
+    jobs.enqueue("leader", book("統計"))
+    jobs.claim("worker")
+    jobs.complete("leader", "worker", {"title": "統計入門"})
+    assert jobs.enqueue("follower", book("統計")) == "leader"
+    assert jobs.status("leader")["title"] == "統計入門"
+
+def test_failed_leader_is_not_joined(queue):
+    jobs = queue()
+    jobs.enqueue("leader", book("統計"))
+    jobs.claim("worker")
+    jobs.fail("leader", "worker", "error")
+    assert jobs.enqueue("retry", book("統計")) == "retry"
+    assert jobs.status("retry")["status"] == "queued"
+    # やり直しのジョブには合流する
+    assert jobs.enqueue("follower", book("統計")) == "retry"
+
+def test_dedup_window(queue):
+    jobs = queue(JOB_DEDUP_WINDOW_SECONDS=0.2)
+    jobs.enqueue("leader", book("統計"))
+    time.sleep(0.3)
+    assert jobs.enqueue("later", book("統計")) == "later"
+
+    disabled = queue(JOB_DEDUP_WINDOW_SECONDS=0)
+    assert disabled.enqueue("again", book("統計")) == "again"
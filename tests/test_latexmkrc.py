@@ -0,0 +1,39 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from AutoGenBook import BookGenerator
+from utils.tracing import tracer
+
+# LLMが決めたディレクトリ名に、Perlの文字列で特別な意味を持つ文字が含まれる場合
+DIRNAMES = ["it's a book", "back\\slash", "q'uo\\'te"]
+
+def generator(home_dir: str) -> BookGenerator:
+    bookgenerator = BookGenerator.__new__(BookGenerator)
+    bookgenerator.home_dir = home_dir
+    bookgenerator.latexmkrc_path = os.path.join(home_dir, ".latexmkrc")
+    bookgenerator.tracer = tracer()
+    return bookgenerator
+
+@pytest.mark.skipif(shutil.which("perl") is None, reason="perl is not installed")
+@pytest.mark.parametrize("dirname", DIRNAMES)
+def test_latexmkrc_parses_and_records_passes(tmp_path, dirname):
+    home_dir = tmp_path / dirname
+    home_dir.mkdir()
+    bookgenerator = generator(str(home_dir))
+    bookgenerator.create_latexmkrc()
+
+    # latexmkと同じく、本のディレクトリで .latexmkrc を読み込んでから規則を実行する
+    script = (
+        "do './.latexmkrc'; die $@ if $@;"
+        "die 'latex rule is not set' unless $latex =~ /^internal traced_rule platex /;"
+        "exit(traced_rule('platex', 'true') >> 8);"
+    )
+    result = subprocess.run(["perl", "-e", script], cwd=home_dir, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    rows = bookgenerator.trace_latex_passes()
+    assert [(row[0], row[3]) for row in rows] == [("platex", "0")]
+    assert bookgenerator.latex_passes_path() == str(home_dir / "latex_passes.tsv")
@@ -0,0 +1,60 @@
+import pytest
+
+from benchmarks.openai_stub import openai_stub
+from utils.llm_batch import batch_collector
+from utils.models import llms
+
+def prompts(n: int) -> list:
+    return [[{"role": "user", "content": f"第{i + 1}節の本文を書いてください。"}] for i in range(n)]
+
+@pytest.fixture
+def openai(monkeypatch):
+    def start(**settings):
+        stub = openai_stub(output_tokens=20, **settings).start()
+        stubs.append(stub)
+        monkeypatch.setenv("PROVIDER", "OPENAI")
+        monkeypatch.setenv("MODEL", "gpt-4o-mini")
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setenv("OPENAI_BASE_URL", stub.base_url)
+        monkeypatch.delenv("OPENAI_ENDPOINTS", raising=False)
+        return stub, llms()
+
+    stubs = []
+    yield start
+    for stub in stubs:
+        stub.stop()
+
+def collector() -> batch_collector:
+    return batch_collector(window=0.2, poll_interval=0.05, timeout=10, straggler_wait=60)
+
+def expected(llm, requests: list) -> list:
+    # スタブは同じリクエストに同じ応答を返すため、同期呼び出しの応答と比べる
+    return [llm._raw_content(llm._call_api(messages)) for messages in requests]
+
+def test_results_are_returned_in_request_order(openai):
+    stub, llm = openai()
+    requests = prompts(5)
+    batches = collector()
+
+    futures = [batches.submit(llm, messages) for messages in requests]
+    contents = [llm._raw_content(future.result(timeout=10)) for future in futures]
+
+    assert contents == expected(llm, requests)
+    assert stub.snapshot()["batch_requests"] == 5
+    stats = batches.snapshot()
+    assert (stats["batches"], stats["batch_results"], stats["fallback_requests"]) == (1, 5, 0)
+
+def test_expired_requests_fall_back_to_synchronous_calls(openai):
+    # バッチの全てのリクエストが処理されないまま期限切れになる
+    stub, llm = openai(batch_straggler_rate=1.0, batch_expire_ms=200)
+    requests = prompts(4)
+    batches = collector()
+
+    futures = [batches.submit(llm, messages) for messages in requests]
+    contents = [llm._raw_content(future.result(timeout=10)) for future in futures]
+
+    assert contents == expected(llm, requests)
+    batch_id = next(iter(stub.batches))
+    assert stub.openai_batch(batch_id)["status"] == "expired"
+    stats = batches.snapshot()
+    assert (stats["batches"], stats["batch_results"], stats["cancelled_batches"], stats["fallback_requests"]) == (1, 0, 0, 4)
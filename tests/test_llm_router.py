@@ -0,0 +1,69 @@
+import threading
+import time
+
+from utils.llm_router import llm_endpoint, llm_router, CLOSED, OPEN
+
+def router(*clients, failure_threshold: int = 2, cooldown: float = 0.2, max_concurrency: int = 8):
+    endpoints = [llm_endpoint(name, name, max_concurrency=max_concurrency) for name in clients]
+    return llm_router(endpoints, failure_threshold=failure_threshold, cooldown=cooldown)
+
+def test_failover_to_the_next_endpoint():
+    r = router("a", "b")
+    calls = []
+
+    def fn(client):
+        calls.append(client)
+        if client == "a":
+            raise RuntimeError("down")
+        return "ok"
+
+    # 同じ負荷なら先頭の a を選び、失敗したら b で再試行する
+    assert r.call(fn) == "ok"
+    assert calls == ["a", "b"]
+    assert r.call(lambda client: None) is None
+
+def test_circuit_opens_and_recovers_after_cooldown():
+    r = router("a", "b", failure_threshold=2)
+    a = r.endpoints[0]
+    broken = {"a"}
+
+    def fn(client):
+        return None if client in broken else client
+
+    for _ in range(4):
+        assert r.call(fn) == "b"
+    assert a.state == OPEN and a.ejections == 1
+    # 外している間は a を試さない
+    requests = a.total_requests
+    assert r.call(fn) == "b"
+    assert a.total_requests == requests
+
+    broken.clear()
+    time.sleep(0.25)
+    # クールダウン後の試しの1件が成功すれば復帰する
+    results = {r.call(fn) for _ in range(4)}
+    assert "a" in results
+    assert a.state == CLOSED
+
+def test_concurrency_is_capped_per_endpoint():
+    r = router("a", "b", max_concurrency=2)
+    lock = threading.Lock()
+    inflight = {"a": 0, "b": 0}
+    peak = {"a": 0, "b": 0}
+
+    def fn(client):
+        with lock:
+            inflight[client] += 1
+            peak[client] = max(peak[client], inflight[client])
+        time.sleep(0.02)
+        with lock:
+            inflight[client] -= 1
+        return client
+
+    threads = [threading.Thread(target=r.call, args=(fn,)) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == {"a": 2, "b": 2}
+    assert sum(stat["requests"] for stat in r.stats()) == 12
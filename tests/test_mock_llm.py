@@ -0,0 +1,39 @@
+import pytest
+
+from benchmarks.openai_stub import openai_stub
+from utils.mock_llm import cassette_key
+from utils.models import llms
+
+MESSAGES = [{"role": "user", "content": "節の本文を書いてください。"}]
+
+def test_key_includes_model_and_temperature():
+    key = cassette_key(MESSAGES, None, "gpt-4o", 0.3)
+    assert key == cassette_key(MESSAGES, None, "gpt-4o", 0.3)
+    assert key != cassette_key(MESSAGES, None, "gpt-4o-mini", 0.3)
+    assert key != cassette_key(MESSAGES, None, "gpt-4o", 0.7)
+
+def test_replay_matches_the_recorded_model_and_temperature(tmp_path, monkeypatch):
+    cassette = tmp_path / "llm.jsonl"
+    stub = openai_stub().start()
+    try:
+        monkeypatch.setenv("PROVIDER", "OPENAI")
+        monkeypatch.setenv("MODEL", "gpt-4o")
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setenv("OPENAI_BASE_URL", stub.base_url)
+        monkeypatch.setenv("LLM_CASSETTE", str(cassette))
+        monkeypatch.setenv("LLM_CASSETTE_MODE", "record")
+        recorder = llms()
+        recorded = recorder._raw_content(recorder._call_api(list(MESSAGES), temperature=0.3))
+    finally:
+        stub.stop()
+
+    monkeypatch.setenv("PROVIDER", "MOCK")
+    monkeypatch.setenv("MOCK_ON_MISS", "error")
+    monkeypatch.delenv("LLM_CASSETTE_MODE")
+    replayed = llms()._call_api(list(MESSAGES), temperature=0.3)
+    assert replayed["cassette"] and replayed["content"] == recorded
+
+    with pytest.raises(KeyError):
+        llms(model="gpt-4o-mini")._call_api(list(MESSAGES), temperature=0.3)
+    with pytest.raises(KeyError):
+        llms()._call_api(list(MESSAGES), temperature=0.7)
@@ -0,0 +1,58 @@
+import pytest
+
+from benchmarks.tts_stub import tts_stub
+
+@pytest.fixture
+def generate(tmp_path, monkeypatch):
+    """MOCKのLLMで本を1冊生成し、表紙と読みの変換まで呼び出して、(種類, モデル) の組を返します。"""
+    stub = tts_stub().start()
+    for name, value in {
+        "PROVIDER": "MOCK",
+        "MODEL": "large",
+        "MODEL_SMALL": "small",
+        "BOOK_OUTPUT_DIR": str(tmp_path),
+        "VOICE_KIND": "VOICEVOX",
+        "VOICEVOX_API_URL": stub.url,
+    }.items():
+        monkeypatch.setenv(name, value)
+    for name in ("LLM_CASSETTE", "LLM_CASSETTE_MODE", "LLM_BATCH_MODE",
+                 "MODEL_DIRNAME", "MODEL_OUTLINE", "MODEL_CONTENT", "MODEL_COVER", "MODEL_KANA"):
+        monkeypatch.delenv(name, raising=False)
+    from AutoGenBook import BookGenerator
+    from utils.convert_wav import convert_wav
+
+    def run(models: dict = None) -> set:
+        bookgenerator = BookGenerator(models=models)
+        bookgenerator.max_depth = 2
+        try:
+            bookgenerator.initialize("統計", "学生", 2)
+            bookgenerator.generate_book_title_and_summary()
+            bookgenerator.generate_book_detail()
+            bookgenerator.create_cover_iamge(bookgenerator.book_node["title"], bookgenerator.book_node["summary"])
+            cw = convert_wav()
+            cw.set_llm(bookgenerator.llm)
+            cw.convert_to_japanese("ABC")
+            return {(row["kind"], row["model"]) for row in bookgenerator.llm.tier_metrics()}
+        finally:
+            bookgenerator.llm.close()
+
+    yield run
+    stub.stop()
+
+def test_small_kinds_use_the_small_model(generate):
+    assert generate() == {
+        ("dirname", "small"),
+        ("outline", "large"),
+        ("content", "large"),
+        ("cover", "small"),
+        ("kana", "small"),
+    }
+
+def test_request_models_override_the_environment(generate):
+    assert generate({"content": "content-model", "cover": "cover-model"}) == {
+        ("dirname", "small"),
+        ("outline", "large"),
+        ("content", "content-model"),
+        ("cover", "cover-model"),
+        ("kana", "small"),
+    }
@@ -0,0 +1,60 @@
+import anthropic
+import openai
+import pytest
+
+from utils.models import llms
+
+@pytest.fixture
+def env(monkeypatch):
+    """プロセスの既定のプロバイダを OPENAI にし、他のプロバイダ向けの設定も並べておきます。"""
+    settings = {
+        "PROVIDER": "OPENAI",
+        "MODEL": "gpt-4o",
+        "MODEL_SMALL": "gpt-4o-mini",
+        "OPENAI_API_KEY": "sk-openai",
+        "OPENAI_BASE_URL": "http://openai.test/v1",
+        "OLLAMA_BASE_URL": "http://ollama.test/v1",
+        "OLLAMA_MODEL": "llama3.1:70b",
+        "OLLAMA_MODEL_SMALL": "llama3.1:8b",
+        "ANTHROPIC_API_KEY": "sk-ant",
+        "ANTHROPIC_BASE_URL": "http://anthropic.test",
+        "ANTHROPIC_MODEL": "claude-sonnet",
+    }
+    for name, value in settings.items():
+        monkeypatch.setenv(name, value)
+    for name in ("OPENAI_ENDPOINTS", "OLLAMA_ENDPOINTS", "ANTHROPIC_ENDPOINTS", "LLM_CASSETTE_MODE",
+                 "OPENAI_MODEL", "MODEL_KANA", "OLLAMA_MODEL_CONTENT"):
+        monkeypatch.delenv(name, raising=False)
+
+def test_instances_have_their_own_clients_and_models(env):
+    default = llms()
+    ollama = llms("ollama")
+    claude = llms("ANTHROPIC")
+    try:
+        assert len({id(default.client), id(ollama.client), id(claude.client)}) == 3
+        assert isinstance(default.client, openai.OpenAI)
+        assert isinstance(ollama.client, openai.OpenAI)
+        assert isinstance(claude.client, anthropic.Anthropic)
+
+        assert (str(default.client.base_url), default.client.api_key) == ("http://openai.test/v1/", "sk-openai")
+        assert (str(ollama.client.base_url), ollama.client.api_key) == ("http://ollama.test/v1/", "EMPTY")
+        assert (str(claude.client.base_url), claude.client.api_key) == ("http://anthropic.test", "sk-ant")
+        # プロセス全体の設定は変更しない
+        assert openai.api_key is None and openai.base_url is None
+
+        # 環境変数と同じプロバイダは MODEL・MODEL_SMALL、異なるプロバイダは <PROVIDER>_ を付けた変数を使う
+        assert (default.model, default.model_for("content"), default.model_for("kana")) == ("gpt-4o", "gpt-4o", "gpt-4o-mini")
+        assert (ollama.model, ollama.model_for("content"), ollama.model_for("kana")) == ("llama3.1:70b", "llama3.1:70b", "llama3.1:8b")
+        assert (claude.model, claude.model_for("content"), claude.model_for("kana")) == ("claude-sonnet", "claude-sonnet", "claude-sonnet")
+        assert llms("OPENAI").model == "gpt-4o"
+    finally:
+        for llm in (default, ollama, claude):
+            llm.close()
+
+def test_closing_one_instance_keeps_the_other_open(env):
+    first, second = llms("ollama"), llms("ollama")
+    assert first.client is not second.client
+    first.close()
+    assert first.client.is_closed()
+    assert not second.client.is_closed()
+    second.close()
@@ -0,0 +1,32 @@
+import threading
+import time
+
+from utils.profiler import sampling_profiler
+
+def spin(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+def test_only_threads_of_this_request_are_sampled():
+    stop = threading.Event()
+    # プロファイラの開始前から動いているスレッド (他のリクエストやWebサーバー)
+    other = threading.Thread(target=spin, args=(stop,), name="other-request")
+    other.start()
+    try:
+        profiler = sampling_profiler(interval=0.005).start()
+        pool = threading.Thread(target=spin, args=(stop,), name="llm-pool_0")
+        pool.start()
+        time.sleep(0.2)
+        stop.set()
+        pool.join()
+        profiler.stop()
+    finally:
+        stop.set()
+        other.join()
+
+    names = set(profiler.threads)
+    assert "llm-pool" in names
+    assert threading.current_thread().name in names
+    assert "other-request" not in names
+    assert not any(stack.startswith("other-request;") for stack in profiler.wall)
+    assert profiler.summary()["wall_samples"] > 0
@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from utils.models import llms
+from utils.resource_slots import resource_slots
+
+@pytest.fixture
+def mock_env(monkeypatch):
+    monkeypatch.setenv("PROVIDER", "MOCK")
+    monkeypatch.setenv("MOCK_LATENCY_MS", "20")
+    monkeypatch.setenv("MOCK_OUTPUT_TOKENS", "20")
+    monkeypatch.delenv("LLM_CASSETTE", raising=False)
+
+def book(slots: resource_slots, name: str, calls: list, lock: threading.Lock):
+    """節の呼び出しをする本の代わり。全ての本で同じ上限を共有し、実際に呼び出された順を calls に記録します。"""
+    llm = llms()
+    llm.slots = slots
+    complete = llm.mock.complete
+
+    def recorded(messages, *args, **kwargs):
+        with lock:
+            calls.append(messages[-1]["content"])
+        return complete(messages, *args, **kwargs)
+
+    llm.mock.complete = recorded
+    return lambda section: llm._call_api([{"role": "user", "content": f"{name}-{section}"}], kind="content")
+
+def wait_for_tickets(slots: resource_slots, n: int):
+    deadline = time.monotonic() + 5
+    while slots._next_ticket < n:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+def test_two_books_stay_within_the_shared_limit(mock_env):
+    slots = resource_slots("llm", 2)
+    calls, lock = [], threading.Lock()
+    books = [book(slots, name, calls, lock) for name in ("a", "b")]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(call, section) for section in range(6) for call in books]
+        for future in futures:
+            future.result()
+
+    stats = slots.stats()
+    assert stats["acquired"] == len(calls) == 12
+    assert stats["peak_in_use"] == 2
+    assert stats["in_use"] == 0
+
+def test_calls_are_served_in_arrival_order(mock_env):
+    slots = resource_slots("llm", 1)
+    calls, lock = [], threading.Lock()
+    a, b = book(slots, "a", calls, lock), book(slots, "b", calls, lock)
+    arrivals = [(a, 1), (a, 2), (b, 1), (a, 3), (b, 2)]
+
+    threads = []
+    with slots.hold():
+        # 枠を埋めておき、1件ずつ番号を取らせて到着順を決める
+        for i, (call, section) in enumerate(arrivals):
+            threads.append(threading.Thread(target=call, args=(section,), daemon=True))
+            threads[-1].start()
+            wait_for_tickets(slots, i + 2)
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert calls == ["a-1", "a-2", "b-1", "a-3", "b-2"]
+
+def test_abandoned_ticket_does_not_block_later_callers():
+    slots = resource_slots("latex", 1)
+    interrupt = threading.Event()
+
+    class interruptible(threading.Condition):
+        def wait(self, timeout=None):
+            if threading.current_thread().name == "abandoned" and interrupt.is_set():
+                raise KeyboardInterrupt
+            return super().wait(timeout)
+
+    slots._cond = interruptible()
+    served = threading.Event()
+    errors = []
+
+    def abandoned():
+        try:
+            with slots.hold():
+                pass
+        except KeyboardInterrupt:
+            errors.append("interrupted")
+
+    def later():
+        with slots.hold():
+            served.set()
+
+    with slots.hold():
+        first = threading.Thread(target=abandoned, name="abandoned", daemon=True)
+        first.start()
+        wait_for_tickets(slots, 2)
+        second = threading.Thread(target=later, daemon=True)
+        second.start()
+        wait_for_tickets(slots, 3)
+        # 先に並んだ処理が中断されても、後の処理の順番は回ってくる
+        interrupt.set()
+        with slots._cond:
+            slots._cond.notify_all()
+        first.join(timeout=5)
+    assert served.wait(timeout=5)
+    second.join(timeout=5)
+    assert errors == ["interrupted"]
+    assert slots.stats()["in_use"] == 0
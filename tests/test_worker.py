@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+import AutoGenBatch
+import worker
+from utils.job_queue import job_queue
+
+class fake_llm:
+    def get_provider_name(self):
+        return "MOCK"
+
+    def get_model_name(self):
+        return "mock"
+
+class failing_generator:
+    """PDFのコンパイルに失敗する BookGenerator の代わり。"""
+
+    def __init__(self, home_dir: str):
+        self.llm = fake_llm()
+        self.home_dir = home_dir
+        self.book_node = {"title": "テスト"}
+
+    def initialize(self, *args):
+        pass
+
+    def generate_book_title_and_summary(self):
+        pass
+
+    def generate_book_detail(self):
+        pass
+
+    def create_pdf(self):
+        return False
+
+REQUEST = {"book_content": "統計", "target_readers": "学生", "n_pages": 3, "wav_output": 0}
+
+def test_failed_pdf_raises(tmp_path):
+    with pytest.raises(RuntimeError, match="PDF compilation failed"):
+        worker._generate_book(failing_generator(str(tmp_path)), dict(REQUEST), lambda **fields: None)
+
+def test_failed_pdf_is_reported_as_failed_book(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        AutoGenBatch, "generate_book",
+        lambda request, update: worker._generate_book(failing_generator(str(tmp_path)), request, update),
+    )
+    outcome = AutoGenBatch.run_entry(1, dict(REQUEST))
+    assert not outcome["ok"]
+    assert outcome["error"].startswith("RuntimeError: PDF compilation failed")
+    assert outcome["output_dir"] == str(tmp_path)
+
+    report = AutoGenBatch.summarize([outcome], 1.0, 1)
+    assert (report["succeeded"], report["failed"], report["pages"]) == (0, 1, 0)
+
+def test_run_job_records_completion_and_failure(tmp_path, monkeypatch):
+    queue = job_queue(str(tmp_path / "jobs.sqlite3"), lease_seconds=0.3)
+    queue.enqueue("ok", dict(REQUEST, book_content="統計"))
+    queue.enqueue("ng", dict(REQUEST, book_content="線形代数"))
+
+    def fake_generate_book(request, update, emit=None, task_id=None):
+        if request["book_content"] == "線形代数":
+            raise RuntimeError("PDF compilation failed")
+        # 処理に時間がかかってもハートビートでリースが延長される
+        time.sleep(0.5)
+        return {"title": request["book_content"]}
+
+    monkeypatch.setattr(worker, "generate_book", fake_generate_book)
+    for _ in range(2):
+        worker.run_job(queue, queue.claim("worker"), "worker")
+    assert queue.status("ok")["status"] == "completed"
+    assert queue.status("ok")["attempts"] == 1
+    assert queue.status("ng")["status"] == "failed"
+    assert queue.status("ng")["error"] == "PDF compilation failed"
+
+class fake_process:
+    def __init__(self, alive: bool):
+        self.alive = alive
+        self.pid = id(self)
+        self.exitcode = None if alive else -9
+
+    def is_alive(self):
+        return self.alive
+
+def test_supervise_restarts_exited_workers(monkeypatch):
+    monkeypatch.setattr(worker, "_spawn", lambda poll_interval: fake_process(True))
+    processes = [fake_process(True), fake_process(False)]
+    alive = processes[0]
+    stop = threading.Event()
+    thread = threading.Thread(target=worker.supervise, args=(processes,), kwargs={"stop": stop, "check_interval": 0.01})
+    thread.start()
+    time.sleep(0.1)
+    stop.set()
+    thread.join()
+    assert processes[0] is alive
+    assert processes[1].is_alive()
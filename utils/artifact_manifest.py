@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+from os.path import join, dirname
+from dotenv import load_dotenv
+from .job_queue import DEFAULT_DB_PATH
+
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+MANIFEST_FILENAME = "manifest.json"
+
+def file_digest(path: str, chunk_size: int = 1 << 20):
+    """ファイルを1回だけ読み、(サイズ, sha256, crc32) を返します。"""
+    sha256 = hashlib.sha256()
+    crc = 0
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return size, sha256.hexdigest(), crc
+
+class artifact_manifest:
+    """
+    本のディレクトリに置く成果物の一覧(manifest.json)。
+    各工程が出力したファイルのパス・サイズ・ハッシュと、工程の所要時間を記録します。
+    """
+
+    def __init__(self, home_dir: str):
+        self.home_dir = os.path.abspath(home_dir)
+        self.path = os.path.join(self.home_dir, MANIFEST_FILENAME)
+        self._lock = threading.Lock()
+        self.data = self.load(self.home_dir) or {"artifacts": {}, "timings": {}}
+
+    @staticmethod
+    def load(home_dir: str):
+        try:
+            with open(os.path.join(home_dir, MANIFEST_FILENAME), encoding="UTF-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def record(self, name: str, path: str, seconds: float = None, **meta) -> dict:
+        """
+        成果物を記録します。name は "pdf"、"cover_png"、"tex/1-1-p.tex" のような一覧内での名前です。
+        ファイルが存在しない場合は記録しません。
+        """
+        if not path or not os.path.exists(path):
+            return None
+        path = os.path.abspath(path)
+        size, sha256, crc32 = file_digest(path)
+        entry = {
+            "path": path,
+            "relpath": os.path.relpath(path, self.home_dir),
+            "size": size,
+            "sha256": sha256,
+            "crc32": crc32,
+            "mtime": os.path.getmtime(path),
+            **meta,
+        }
+        if seconds is not None:
+            entry["seconds"] = round(seconds, 3)
+        with self._lock:
+            self.data["artifacts"][name] = entry
+            self._write()
+        return entry
+
+    def timing(self, stage: str, seconds: float):
+        with self._lock:
+            self.data["timings"][stage] = round(seconds, 3)
+            self._write()
+
+    def set(self, **fields):
+        with self._lock:
+            self.data.update(fields)
+            self._write()
+
+    def get(self, name: str):
+        return self.data["artifacts"].get(name)
+
+    def _write(self):
+        os.makedirs(self.home_dir, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+class artifact_index:
+    """
+    タスクIDから本のディレクトリと成果物の一覧を引くための索引。
+    ジョブキューと同じSQLiteファイルに保存します。
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.environ.get("JOB_DB_PATH") or DEFAULT_DB_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS books ("
+                "task_id TEXT PRIMARY KEY, home_dir TEXT NOT NULL, manifest_path TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def register(self, task_id: str, home_dir: str):
+        home_dir = os.path.abspath(home_dir)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO books (task_id, home_dir, manifest_path, updated_at) VALUES (?, ?, ?, ?)",
+                (task_id, home_dir, os.path.join(home_dir, MANIFEST_FILENAME), time.time()),
+            )
+
+    def home_dir(self, task_id: str):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT home_dir FROM books WHERE task_id = ?", (task_id,)).fetchone()
+        return row["home_dir"] if row else None
+
+    def manifest(self, task_id: str):
+        home_dir = self.home_dir(task_id)
+        return artifact_manifest.load(home_dir) if home_dir else None
+
+    def artifact(self, task_id: str, name: str):
+        """成果物の記録を返します。ファイルが消えている場合は None を返します。"""
+        manifest = self.manifest(task_id)
+        entry = manifest["artifacts"].get(name) if manifest else None
+        if entry is None or not os.path.exists(entry["path"]):
+            return None
+        return entry
@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+class audio_cache:
+    """
+    チャンク単位の音声をコンテンツアドレスで保存するディスクキャッシュ。
+    キーは正規化テキスト・エンジン種別・話者ID・エンジンバージョンのハッシュで、
+    合計サイズが上限を超えたら最終アクセスが古いものから削除する(LRU)。
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None):
+        if cache_dir is None:
+            cache_dir = os.environ.get("AUDIO_CACHE_DIR") or os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'cache', 'audio'))
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("AUDIO_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # path -> size。先頭ほど最終アクセスが古い
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    @classmethod
+    def from_env(cls):
+        """AUDIO_CACHE_MAX_MB=0 の場合はキャッシュを無効にして None を返します。"""
+        if float(os.environ.get("AUDIO_CACHE_MAX_MB", "2048")) <= 0:
+            return None
+        return cls()
+
+    def _load_index(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(".wav"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._entries[path] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        text = unicodedata.normalize("NFKC", text)
+        return re.sub(r"\s+", " ", text).strip()
+
+    def make_key(self, text: str, engine: str, speaker, engine_version: str, params: dict = None) -> str:
+        """
+        キャッシュキーを作ります。params には合成結果を左右するその他の設定
+        (読みの変換に使うLLM・プロンプト、話速など)を渡します。
+        """
+        payload = json.dumps(
+            [self.normalize_text(text), str(engine), str(speaker), str(engine_version), params or {}],
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.wav")
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                size = self._entries.pop(path, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+            else:
+                self._entries[path] = len(data)
+                self._total_bytes += len(data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if not data or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書き込み途中のファイルを他プロセスが読まないように一時ファイル経由で置換する
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            old_size = self._entries.pop(path, None)
+            if old_size is not None:
+                self._total_bytes -= old_size
+            self._entries[path] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logger.info(f"audio cache evicted: {os.path.basename(path)}")
+
+    def total_bytes(self) -> int:
+        return self._total_bytes
@@ -0,0 +1,118 @@
+import os
+import time
+import wave
+import logging
+import subprocess
+from pydub import AudioSegment
+
+logger = logging.getLogger(__name__)
+
+# 出力形式ごとの拡張子・MIMEタイプ・ffmpegのエンコード引数
+AUDIO_FORMATS = {
+    "wav": {"ext": "wav", "media_type": "audio/wav", "args": None},
+    "flac": {"ext": "flac", "media_type": "audio/flac", "args": ["-c:a", "flac", "-f", "flac"]},
+    "mp3": {"ext": "mp3", "media_type": "audio/mpeg", "args": ["-c:a", "libmp3lame", "-b:a", "{bitrate}", "-f", "mp3"]},
+    # libopusは対応するサンプルレートが限られるため48kHzに変換する
+    "opus": {"ext": "opus", "media_type": "audio/ogg", "args": ["-c:a", "libopus", "-b:a", "{bitrate}", "-ar", "48000", "-f", "ogg"]},
+}
+
+class audio_encoder:
+    """
+    PCMを受け取りながら出力ファイルへエンコードします。
+    wavはwaveモジュールで直接書き込み、それ以外はffmpegの標準入力へ流し込むため、
+    全体の合成が終わってから変換し直す必要がありません。
+    """
+
+    def __init__(self, output_filename: str, audio_format: str = "wav", bitrate: str = None):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+        self.output_filename = output_filename
+        self.audio_format = audio_format
+        self.bitrate = bitrate or os.environ.get("AUDIO_BITRATE", "64k")
+        self.params = None
+        self.writer = None
+        self.process = None
+        self.frames = 0
+        self.encode_seconds = 0.0
+        self.encode_cpu_seconds = None
+
+    def _open(self, channels: int, sample_width: int, sample_rate: int):
+        self.params = (channels, sample_width, sample_rate)
+        args = AUDIO_FORMATS[self.audio_format]["args"]
+        if args is None:
+            self.writer = wave.open(self.output_filename, "wb")
+            self.writer.setnchannels(channels)
+            self.writer.setsampwidth(sample_width)
+            self.writer.setframerate(sample_rate)
+            return
+        sample_format = {1: "u8", 2: "s16le", 4: "s32le"}[sample_width]
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", sample_format, "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0",
+            *[arg.format(bitrate=self.bitrate) for arg in args],
+            self.output_filename,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write_wav(self, source):
+        """WAV(パスまたはファイルオブジェクト)のPCMを書き込みます。形式が異なる場合は最初の形式に揃えます。"""
+        with wave.open(source, "rb") as w:
+            params = (w.getnchannels(), w.getsampwidth(), w.getframerate())
+            if self.params is None:
+                self._open(*params)
+            if params == self.params:
+                while True:
+                    data = w.readframes(1 << 16)
+                    if not data:
+                        break
+                    self.write(data)
+                return
+        if hasattr(source, "seek"):
+            source.seek(0)
+        audio = AudioSegment.from_wav(source)
+        audio = audio.set_channels(self.params[0]).set_sample_width(self.params[1]).set_frame_rate(self.params[2])
+        self.write(audio.raw_data)
+
+    def write(self, data: bytes):
+        start = time.monotonic()
+        if self.writer:
+            self.writer.writeframesraw(data)
+        else:
+            self.process.stdin.write(data)
+        self.encode_seconds += time.monotonic() - start
+        self.frames += len(data) // (self.params[0] * self.params[1])
+
+    def close(self):
+        if self.params is None:
+            logger.error(f"No audio was written to {self.output_filename}")
+            return
+        start = time.monotonic()
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        elif self.process:
+            self.process.stdin.close()
+            stderr = self.process.stderr.read()
+            if hasattr(os, "wait4"):
+                # ffmpegが消費したCPU時間も記録する
+                _, status, usage = os.wait4(self.process.pid, 0)
+                self.process.returncode = os.waitstatus_to_exitcode(status)
+                self.encode_cpu_seconds = usage.ru_utime + usage.ru_stime
+            else:
+                self.process.wait()
+            self.process.stderr.close()
+            if self.process.returncode != 0:
+                raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace')}")
+            self.process = None
+        self.encode_seconds += time.monotonic() - start
+
+    def metrics(self) -> dict:
+        size = os.path.getsize(self.output_filename) if os.path.exists(self.output_filename) else 0
+        duration = self.frames / self.params[2] if self.params else 0.0
+        return {
+            "format": self.audio_format,
+            "size": size,
+            "duration": round(duration, 3),
+            "encode_seconds": round(self.encode_seconds, 3),
+            "encode_cpu_seconds": None if self.encode_cpu_seconds is None else round(self.encode_cpu_seconds, 3),
+        }
@@ -0,0 +1,154 @@
+import os
+import wave
+import logging
+import numpy as np
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+SAMPLE_DTYPES = {2: np.int16, 4: np.int32}
+
+def _env_float(name: str, default):
+    value = os.environ.get(name, default)
+    return None if value in (None, "") else float(value)
+
+def read_wav(source):
+    """
+    WAV(パスまたはファイルオブジェクト)を (frames, channels) のサンプル配列として読み込みます。
+    チャンクは合成結果のバッファを1つずつ読むため、全体を読み込んでも1チャンク分のメモリで済みます。
+    返り値は (samples, sample_width, sample_rate) です。
+    """
+    with wave.open(source, "rb") as w:
+        channels, sample_width, sample_rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+        if sample_width not in SAMPLE_DTYPES:
+            raise ValueError(f"Unsupported sample width: {sample_width}")
+        data = w.readframes(w.getnframes())
+    samples = np.frombuffer(data, dtype=SAMPLE_DTYPES[sample_width]).reshape(-1, channels)
+    return samples, sample_width, sample_rate
+
+def window_rms(x: np.ndarray, window: int) -> np.ndarray:
+    """window フレームごとのRMSを返します。端数のフレームは切り捨てます。"""
+    n = len(x) // window
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+    blocks = x[:n * window].reshape(n, window * x.shape[1])
+    return np.sqrt(np.mean(np.square(blocks), axis=1))
+
+def trim_silence(x: np.ndarray, sample_rate: int, threshold_db: float, pad_ms: float = 50, window_ms: float = 10) -> np.ndarray:
+    """前後の、閾値(dBFS)を下回る区間を取り除きます。pad_ms だけ余白を残します。"""
+    window = max(1, int(sample_rate * window_ms / 1000))
+    rms = window_rms(x, window)
+    voiced = np.flatnonzero(rms > 10 ** (threshold_db / 20))
+    if voiced.size == 0:
+        return x[:0]
+    pad = int(sample_rate * pad_ms / 1000)
+    start = max(0, voiced[0] * window - pad)
+    end = min(len(x), (voiced[-1] + 1) * window + pad)
+    return x[start:end]
+
+def normalize_loudness(x: np.ndarray, sample_rate: int, target_db: float, threshold_db: float,
+                       peak_db: float = -1.0, window_ms: float = 10) -> np.ndarray:
+    """無音区間を除いたRMSが target_db (dBFS) になるよう音量を揃えます。ピークは peak_db を超えないようにします。"""
+    if len(x) == 0:
+        return x
+    window = max(1, int(sample_rate * window_ms / 1000))
+    rms = window_rms(x, window)
+    voiced = rms[rms > 10 ** (threshold_db / 20)]
+    if voiced.size == 0:
+        return x
+    loudness_db = 10 * np.log10(np.mean(np.square(voiced)))
+    gain_db = target_db - loudness_db
+    peak = float(np.max(np.abs(x)))
+    if peak > 0:
+        gain_db = min(gain_db, peak_db - 20 * np.log10(peak))
+    return x * np.float32(10 ** (gain_db / 20))
+
+def resample(x: np.ndarray, source_rate: int, target_rate: int) -> np.ndarray:
+    if source_rate == target_rate or len(x) == 0:
+        return x
+    frames = int(round(len(x) * target_rate / source_rate))
+    positions = np.linspace(0, len(x) - 1, frames)
+    return np.stack([np.interp(positions, np.arange(len(x)), x[:, c]) for c in range(x.shape[1])], axis=1).astype(np.float32)
+
+class pcm_postprocessor:
+    """
+    合成したチャンクを NumPy で後処理しながら1つのWAVに連結します。
+    各チャンクの前後の無音の除去・音量の正規化を行い、チャンク間は一定の間隔かクロスフェードでつなぎます。
+    出力は逐次書き込むため、メモリ使用量はチャンク1つ分程度に収まります。
+    """
+
+    def __init__(self):
+        self.target_db = _env_float("AUDIO_NORMALIZE_DBFS", "-20")
+        self.threshold_db = _env_float("AUDIO_SILENCE_THRESHOLD_DBFS", "-50")
+        self.trim_pad_ms = _env_float("AUDIO_TRIM_PAD_MS", "50")
+        self.gap_ms = _env_float("AUDIO_GAP_MS", "300") or 0.0
+        self.crossfade_ms = _env_float("AUDIO_CROSSFADE_MS", "0") or 0.0
+
+    def process(self, samples: np.ndarray, sample_width: int, sample_rate: int) -> np.ndarray:
+        x = samples.astype(np.float32) / np.float32(2 ** (8 * sample_width - 1))
+        if self.threshold_db is not None:
+            x = trim_silence(x, sample_rate, self.threshold_db, self.trim_pad_ms)
+        if self.target_db is not None:
+            x = normalize_loudness(x, sample_rate, self.target_db, self.threshold_db if self.threshold_db is not None else -70)
+        return x
+
+    def combine(self, sources: list, output_filename: str):
+        writer = None
+        params = None
+        tail = None
+        for i, source in enumerate(sources):
+            if source is None:
+                logger.error(f"audio part {i} is missing")
+                continue
+            samples, sample_width, sample_rate = read_wav(source)
+            if hasattr(source, "close"):
+                source.close()
+            if writer is None:
+                params = (samples.shape[1], sample_width, sample_rate)
+                writer = wave.open(output_filename, "wb")
+                writer.setnchannels(params[0])
+                writer.setsampwidth(params[1])
+                writer.setframerate(params[2])
+            x = self.process(samples, sample_width, sample_rate)
+            # 形式が異なるチャンクは最初のチャンクの形式に揃える
+            x = resample(x, sample_rate, params[2])
+            if x.shape[1] != params[0]:
+                x = np.repeat(x.mean(axis=1, keepdims=True), params[0], axis=1)
+            if len(x) == 0:
+                continue
+            tail = self._append(writer, params, tail, x)
+        if writer is None:
+            logger.error(f"No audio was written to {output_filename}")
+            return
+        if tail is not None and len(tail):
+            writer.writeframes(self._to_pcm(tail, params[1]))
+        writer.close()
+
+    def _append(self, writer, params, tail, x: np.ndarray):
+        """前のチャンクの末尾(tail)と x をつなぎ、確定した部分を書き込んで、まだ書き込まない末尾を返します。"""
+        channels, sample_width, sample_rate = params
+        if self.crossfade_ms > 0:
+            if tail is not None and len(tail):
+                n = min(len(tail), len(x))
+                writer.writeframes(self._to_pcm(tail[:len(tail) - n], sample_width))
+                ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)[:, None]
+                x = np.concatenate([tail[len(tail) - n:] * (1 - ramp) + x[:n] * ramp, x[n:]])
+            # クロスフェードに使う末尾は次のチャンクまで書き込まずに保持する
+            keep = min(int(sample_rate * self.crossfade_ms / 1000), len(x))
+            writer.writeframes(self._to_pcm(x[:len(x) - keep], sample_width))
+            return x[len(x) - keep:]
+        if tail is not None:
+            gap = int(sample_rate * self.gap_ms / 1000)
+            if gap > 0:
+                writer.writeframes(bytes(gap * channels * sample_width))
+        writer.writeframes(self._to_pcm(x, sample_width))
+        return x[:0]
+
+    @staticmethod
+    def _to_pcm(x: np.ndarray, sample_width: int) -> bytes:
+        scale = 2 ** (8 * sample_width - 1)
+        return np.clip(np.rint(x * scale), -scale, scale - 1).astype(SAMPLE_DTYPES[sample_width]).tobytes()
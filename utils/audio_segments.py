@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import time
+import wave
+import struct
+import logging
+import threading
+import pymupdf
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_DIRNAME = "audio_segments"
+INDEX_FILENAME = "segments.json"
+PLAYLIST_FILENAME = "playlist.m3u"
+# このクラスが書き出す章の音声のファイル名 (000.wav, 001.wav, ...)
+SEGMENT_PATTERN = re.compile(r"\d{3,}\.wav")
+
+def pdf_chapters(filename: str) -> list:
+    """
+    PDFの目次(しおり)の第1階層を章とみなし、[(章タイトル, テキスト), ...] を返します。
+    最初の章より前のページ(表紙・目次)は先頭の区間としてまとめ、目次がない場合は全体を1区間とします。
+    """
+    doc = pymupdf.open(filename)
+    try:
+        pages = [page.get_text() for page in doc]
+        starts = []
+        for level, title, page_number in doc.get_toc():
+            if level == 1 and page_number >= 1 and (not starts or page_number - 1 > starts[-1][1]):
+                starts.append((title, page_number - 1))
+    finally:
+        doc.close()
+
+    if not starts:
+        return [("", "".join(pages))]
+    chapters = []
+    if starts[0][1] > 0:
+        chapters.append(("", "".join(pages[:starts[0][1]])))
+    for i, (title, start) in enumerate(starts):
+        end = starts[i + 1][1] if i + 1 < len(starts) else len(pages)
+        chapters.append((title, "".join(pages[start:end])))
+    return [(title, text) for title, text in chapters if text.strip()]
+
+class audio_segments:
+    """
+    章ごとの音声ファイルを書き出し、一覧(segments.json)とプレイリスト(playlist.m3u)を更新します。
+    本全体の合成が終わる前から、完成した章を配信できるようにするためのものです。
+    encoderを渡した場合は、章が追加されるたびにその音声を本全体の出力ファイルへエンコードします。
+    """
+
+    def __init__(self, segment_dir: str, titles: list, encoder=None):
+        self.segment_dir = segment_dir
+        self.titles = titles
+        self.encoder = encoder
+        self.segments = []
+        self.complete = False
+        self._lock = threading.Lock()
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self._remove_previous()
+        self._write_index()
+
+    def _remove_previous(self):
+        """前回の生成で書き出した章の音声・一覧・プレイリストだけを削除します。それ以外のファイルやディレクトリは残します。"""
+        own = {INDEX_FILENAME, PLAYLIST_FILENAME, f".{INDEX_FILENAME}.tmp", f".{PLAYLIST_FILENAME}.tmp"}
+        for name in os.listdir(self.segment_dir):
+            path = os.path.join(self.segment_dir, name)
+            if (name in own or SEGMENT_PATTERN.fullmatch(name)) and os.path.isfile(path):
+                os.remove(path)
+
+    def next_segment_path(self) -> str:
+        return os.path.join(self.segment_dir, f"{len(self.segments):03d}.wav")
+
+    def add(self, title: str, path: str):
+        """書き出し済みの章の音声を一覧に追加します。音声のない章は追加しないため、番号は連番になります。"""
+        with wave.open(path, "rb") as w:
+            params = {
+                "channels": w.getnchannels(),
+                "sample_width": w.getsampwidth(),
+                "sample_rate": w.getframerate(),
+                "frames": w.getnframes(),
+            }
+        with self._lock:
+            index = len(self.segments)
+            self.segments.append({
+                "index": index,
+                "title": title,
+                "filename": os.path.basename(path),
+                "duration": params["frames"] / params["sample_rate"],
+                **params,
+            })
+            self._write_index()
+        logger.info(f"audio segment {index + 1}/{len(self.titles)} ready: {title}")
+        if self.encoder:
+            self.encoder.write_wav(path)
+
+    def paths(self) -> list:
+        return [os.path.join(self.segment_dir, segment["filename"]) for segment in self.segments]
+
+    def finish(self):
+        if self.encoder:
+            self.encoder.close()
+        with self._lock:
+            self.complete = True
+            self._write_index()
+
+    def _write_index(self):
+        index = {
+            "total": len(self.titles),
+            "complete": self.complete,
+            "segments": self.segments,
+        }
+        # 配信側が書き込み途中のファイルを読まないよう、置換で更新する
+        tmp_path = os.path.join(self.segment_dir, f".{INDEX_FILENAME}.tmp")
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.segment_dir, INDEX_FILENAME))
+
+        lines = ["#EXTM3U"]
+        for segment in self.segments:
+            lines.append(f"#EXTINF:{segment['duration']:.3f},{segment['title']}")
+            lines.append(segment["filename"])
+        tmp_path = os.path.join(self.segment_dir, f".{PLAYLIST_FILENAME}.tmp")
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, os.path.join(self.segment_dir, PLAYLIST_FILENAME))
+
+def read_index(segment_dir: str):
+    try:
+        with open(os.path.join(segment_dir, INDEX_FILENAME), encoding="UTF-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def streaming_wav_header(channels: int, sample_width: int, sample_rate: int) -> bytes:
+    # 長さが未確定のため、RIFF/dataのサイズは最大値にしておく
+    data_size = 0xFFFFFFFF - 36
+    return b"".join((
+        b"RIFF", struct.pack("<I", 0xFFFFFFFF), b"WAVE",
+        b"fmt ", struct.pack("<IHHIIHH", 16, 1, channels, sample_rate,
+                             sample_rate * channels * sample_width, channels * sample_width, sample_width * 8),
+        b"data", struct.pack("<I", data_size),
+    ))
+
+def iter_stream(segment_dir: str, is_running, poll_interval: float = 1.0, chunk_size: int = 1 << 16):
+    """
+    完成した章の音声を順に1本のWAVとして送出するジェネレータです。
+    is_running() が False を返し、かつ未送出の章がなくなった時点で終了します。
+    """
+    sent = 0
+    header_sent = False
+    finishing = False
+    while True:
+        index = read_index(segment_dir)
+        segments = sorted(index["segments"], key=lambda s: s["index"]) if index else []
+        ready = [s for s in segments if s["index"] >= sent]
+        # 章は順番に完成するので、連続している分だけ送る
+        while ready and ready[0]["index"] == sent:
+            segment = ready.pop(0)
+            if not header_sent:
+                yield streaming_wav_header(segment["channels"], segment["sample_width"], segment["sample_rate"])
+                header_sent = True
+            with wave.open(os.path.join(segment_dir, segment["filename"]), "rb") as w:
+                frames_per_chunk = max(1, chunk_size // (w.getnchannels() * w.getsampwidth()))
+                while True:
+                    data = w.readframes(frames_per_chunk)
+                    if not data:
+                        break
+                    yield data
+            sent += 1
+        if index and index["complete"] and sent >= len(segments):
+            return
+        if finishing:
+            return
+        if not is_running():
+            # 終了判定の直前に完成した章を取りこぼさないよう、もう一度だけ一覧を読む
+            finishing = True
+            continue
+        time.sleep(poll_interval)
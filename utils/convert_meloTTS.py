@@ -1,25 +1,64 @@
-import requests
-from pydub import AudioSegment
 import pymupdf
 import argparse
 from dotenv import load_dotenv
 from os.path import join, dirname
 import os
+import hashlib
+import io
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 try:
     from .models import llms
+    from .audio_cache import audio_cache
+    from .engine_pool import engine_pool
+    from .audio_segments import audio_segments, pdf_chapters, SEGMENT_DIRNAME
+    from .audio_encoder import audio_encoder, AUDIO_FORMATS
+    from .audio_postprocess import pcm_postprocessor
+    from .tracing import span, submit
 except ImportError:
     from models import llms
+    from audio_cache import audio_cache
+    from engine_pool import engine_pool
+    from audio_segments import audio_segments, pdf_chapters, SEGMENT_DIRNAME
+    from audio_encoder import audio_encoder, AUDIO_FORMATS
+    from audio_postprocess import pcm_postprocessor
+    from tracing import span, submit
 
 logger = logging.getLogger(__name__)
 load_dotenv(verbose=True)
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
+# 読みの変換(ひらがな化)のプロンプト。変更するとキャッシュキーが変わる
+KANA_SYSTEM_PROMPT = "あなたは誠実で優秀な翻訳家です"
+KANA_PROMPT = (
+    "以下のテキストを全て日本語のひらがなに変換してください。\n"
+    "漢字、カタカナ、アルファベット、記号は全て変換してください。\n"
+    "文章の意味や文節を意識し、適切な日本語(ひらがな)に変換してください。\n"
+    "省略せずにすべて変換して下さい。ただし、目次ページは全体的に省略して下さい。\n"
+    "入力テキスト：\n{text}\n"
+    "出力テキスト：変換後のテキストのみを出力してください。\n"
+)
+KANA_TEMPERATURE = 0.3
+
 class convert_meloTTS:
 
     def __init__(self):
-        self.mellotts_api_url=os.environ.get("MELOTTS_API_URL")
+        self.mellotts_api_url=os.environ.get("MELOTTS_API_URLS") or os.environ.get("MELOTTS_API_URL")
+        self.engine_pool=engine_pool.shared("MELOTTS") if self.mellotts_api_url else None
+        # MeloTTSにはバージョン取得APIがないため環境変数で指定する
+        self.engine_version=os.environ.get("MELOTTS_VERSION", "unknown")
+        # 話速 (合成結果が変わるため、キャッシュキーに含める)
+        self.mellotts_speed = 1.0
+        self.audio_cache = audio_cache.from_env()
+        self.audio_format = "wav"
+        self.encode_metrics = None
+        self.postprocessor = pcm_postprocessor()
+        self.on_progress = None
+        # 読みの変換に使うLLM (未設定の場合は環境変数の設定で都度作る)
+        self.llm = None
+        self._llm_lock = threading.Lock()
 
     def split_text(self,text, max_length=1000):
         return [text[i:i + max_length] for i in range(0, len(text), max_length)]
@@ -29,22 +68,15 @@ class convert_meloTTS:
         テキスト内の英数字や記号を日本語に変換する
         """
         try:
-            llm = llms()
-            prompt = (
-                f"以下のテキストを全て日本語のひらがなに変換してください。\n"
-                f"漢字、カタカナ、アルファベット、記号は全て変換してください。\n"
-                f"文章の意味や文節を意識し、適切な日本語(ひらがな)に変換してください。\n"
-                f"省略せずにすべて変換して下さい。ただし、目次ページは全体的に省略して下さい。\n"
-                f"入力テキスト：\n{text}\n"
-                f"出力テキスト：変換後のテキストのみを出力してください。\n"
-            )
+            llm = self.get_llm()
             messages=[
-                {"role": "system", "content": "あなたは誠実で優秀な翻訳家です"},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": KANA_SYSTEM_PROMPT},
+                {"role": "user", "content": KANA_PROMPT.format(text=text)}
             ]
             completion = llm._call_api(
                 messages=messages,
-                temperature=0.3
+                temperature=KANA_TEMPERATURE,
+                kind="kana"
             )
             
             if completion:
@@ -58,7 +90,7 @@ class convert_meloTTS:
             logger.error(f"日本語変換処理でエラーが発生しました: {e}")
             return text
 
-    def generate_audio(self,text, index,pdf_dir,url=None,speaker="JP",language="JP",speed=1.0):
+    def generate_audio(self,text,speaker="JP",language="JP",speed=1.0):
 
         payload = {
             "text": text,
@@ -67,14 +99,22 @@ class convert_meloTTS:
             "speed": speed
         }
 
-        url=url+"/synthesize"
-        response = requests.post(url, json=payload)
+        response, body = self.engine_pool.post_spooled("/synthesize", json=payload)
         
         if response.status_code == 200:
-            with open(os.path.join(pdf_dir,f"output_{index}.wav"), "wb") as f:
-                f.write(response.content)
+            return body
         else:
             print(f"Error: {response.status_code}")
+            return None
+
+    def cache_key(self, text):
+        return self.audio_cache.make_key(
+            text,
+            "MeloTTS",
+            f"{self.mellotts_speaker_id}:{self.mellotts_language}",
+            self.engine_version,
+            {"speed": self.mellotts_speed, **self.kana_settings()}
+        )
 
     def pdf2text(self,filename:str):
         try:
@@ -111,38 +151,102 @@ class convert_meloTTS:
 
         logging.info(f"Converting {filename} to wav Started")
         pdf_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ),  '..',filename))
-        pdf_dir=os.path.dirname(pdf_path)
-        text=self.pdf2text(pdf_path)
+        # テキストを抽出できないPDFはここでエラーにする
+        self.pdf2text(pdf_path)
+        chapters=pdf_chapters(pdf_path)
 
-        split_texts = self.split_text(text)
+        split_texts = [(c, part) for c, (_, text) in enumerate(chapters) for part in self.split_text(text)]
         logging.info(f"Converting {filename} to wav text split into {len(split_texts)} parts")
-        for i, part in enumerate(split_texts):
-            part=self.convert_to_japanese(part)
-            logging.info(f"Converting {filename} to wav text extracted")
-            self.generate_audio(part, i,pdf_dir,self.mellotts_api_url,self.mellotts_speaker_id,self.mellotts_language)
-            logging.info(f"Converting {filename} to wav audio file {i} generated")
-
         output_filename=self.set_output_filename(pdf_path)
-        self.combine_audio_files_with_name(len(split_texts),pdf_dir,output_filename)
+        # 章が書き出されるたびに、選択した形式で本全体のファイルへエンコードする
+        encoder = audio_encoder(output_filename, self.audio_format)
+        segments = audio_segments(self.set_segment_dir(pdf_path), [title for title, _ in chapters], encoder)
+        self.emit_progress("tts_started", chunks=len(split_texts), chapters=len(chapters))
+        done = 0
+        done_lock = threading.Lock()
+
+        def chunk_done(_):
+            nonlocal done
+            with done_lock:
+                done += 1
+                self.emit_progress("tts_chunk", done=done, total=len(split_texts))
+
+        # エンジンプールの同時実行数の合計だけチャンクを並列に合成する
+        with ThreadPoolExecutor(max_workers=self.engine_pool.capacity()) as executor:
+            futures = [
+                submit(executor, self.synthesize_part, filename, part, i)
+                for i, (_, part) in enumerate(split_texts)
+            ]
+            for future in futures:
+                future.add_done_callback(chunk_done)
+            # 章ごとに、全チャンクが揃った時点で書き出す
+            for chapter, (title, _) in enumerate(chapters):
+                chapter_files = [futures[i].result() for i, (c, _) in enumerate(split_texts) if c == chapter]
+                if any(audio_file is not None for audio_file in chapter_files):
+                    segment_path = segments.next_segment_path()
+                    with span("audio_concat", chapter=chapter + 1, chunks=len(chapter_files)):
+                        self.combine_audio_files_with_name(chapter_files, segment_path)
+                        segments.add(title, segment_path)
+                    self.emit_progress("tts_segment", index=len(segments.segments) - 1, title=title,
+                                       chapter=chapter + 1, chapters=len(chapters))
+
+        with span("audio_finish", format=self.audio_format):
+            segments.finish()
+        self.encode_metrics = encoder.metrics()
+        self.emit_progress("tts_finished", **self.encode_metrics)
+        logging.info(f"Converting {filename} to {self.audio_format}: {self.encode_metrics}")
         logging.info(f"Converting {filename} to wav Finished")
         return output_filename
 
+    def synthesize_part(self, filename, part, index):
+        with span("tts_chunk", chunk=index):
+            return self._synthesize_part(filename, part, index)
+
+    def _synthesize_part(self, filename, part, index):
+        key = self.cache_key(part) if self.audio_cache else None
+        cached = self.audio_cache.get(key) if key else None
+        if cached is not None:
+            # キャッシュにヒットしたチャンクは変換・合成を省略する
+            logging.info(f"Converting {filename} to wav audio file {index} loaded from cache")
+            return io.BytesIO(cached)
+        part=self.convert_to_japanese(part)
+        logging.info(f"Converting {filename} to wav text extracted")
+        buffer=self.generate_audio(part,self.mellotts_speaker_id,self.mellotts_language,self.mellotts_speed)
+        if key and buffer is not None:
+            self.audio_cache.put(key, buffer.read())
+            buffer.seek(0)
+        logging.info(f"Converting {filename} to wav audio file {index} generated")
+        return buffer
+
     def set_output_filename(self, filename: str):
-        # PDFファイル名から拡張子を除去してwav拡張子を付与
+        # PDFファイル名から拡張子を除去して出力形式の拡張子を付与
         base_name = os.path.splitext(filename)[0]
-        return f"{base_name}.wav"
+        return f"{base_name}.{AUDIO_FORMATS[self.audio_format]['ext']}"
+
+    def set_audio_format(self, audio_format: str):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+        self.audio_format = audio_format
+
+    def set_segment_dir(self, filename: str):
+        # 章ごとの音声はPDFと同じディレクトリのaudio_segmentsに出力する
+        return os.path.join(os.path.dirname(filename), SEGMENT_DIRNAME)
+
+    def combine_audio_files_with_name(self, audio_files, output_filename):
+        # 無音の除去・音量の正規化・チャンク間の間隔をNumPyでまとめて処理する
+        self.postprocessor.combine(audio_files, output_filename)
+
+    def set_progress_callback(self, callback):
+        """進捗を callback(event, **data) で通知します。"""
+        self.on_progress = callback
 
-    def combine_audio_files_with_name(self, num_files, pdf_dir, output_filename):
-        combined = AudioSegment.empty()
-        for i in range(num_files):
-            audio = AudioSegment.from_wav(os.path.join(pdf_dir,f"output_{i}.wav"))
-            combined += audio
-            # 一時ファイルを削除
-            os.remove(os.path.join(pdf_dir,f"output_{i}.wav"))
-        combined.export(output_filename, format="wav")
+    def emit_progress(self, event, **data):
+        if self.on_progress:
+            self.on_progress(event, **data)
 
     def set_mellotts_url(self,url):
-        self.mellotts_api_url=url
+        self.engine_pool=engine_pool.from_urls(url, "MELOTTS")
+        self.mellotts_api_url=",".join(self.engine_pool.urls())
 
     def set_mellotts_speaker_id(self,speaker_id):
         self.mellotts_speaker_id=speaker_id
@@ -150,11 +254,32 @@ class convert_meloTTS:
     def set_mellotts_language(self,language):
         self.mellotts_language=language
 
-def main(filename, url, speaker,language):
+    def get_llm(self):
+        """読みの変換に使うLLM。set_llm で設定されていなければ環境変数の設定で1度だけ作ります。"""
+        with self._llm_lock:
+            if self.llm is None:
+                self.llm = llms()
+            return self.llm
+
+    def kana_settings(self) -> dict:
+        """読みの変換に使うLLMとプロンプト。これらが変わった場合に古い音声を使わないよう、キャッシュキーに含めます。"""
+        llm = self.get_llm()
+        return {
+            "kana_llm": f"{llm.get_provider_name()}:{llm.model_for('kana')}",
+            "kana_prompt": hashlib.sha256((KANA_SYSTEM_PROMPT + KANA_PROMPT).encode("utf-8")).hexdigest()[:16],
+            "kana_temperature": KANA_TEMPERATURE,
+        }
+
+    def set_llm(self, llm):
+        """読みの変換に使うLLMのクライアント(本と同じプロバイダ・モデル)を設定します。"""
+        self.llm = llm
+
+def main(filename, url, speaker,language,audio_format="wav"):
     cw = convert_meloTTS()
     cw.set_mellotts_url(url)
     cw.set_mellotts_speaker_id(speaker) 
     cw.set_mellotts_language(language)
+    cw.set_audio_format(audio_format)
     filename=cw.generate_wav(filename)
     return filename
 
@@ -164,7 +289,8 @@ if __name__ == "__main__":
     parser.add_argument('url', type=str, help='use mellotts url')
     parser.add_argument('speaker', type=str, help='speaker type')
     parser.add_argument('language', type=str, help='language type')
+    parser.add_argument('--format', type=str, help='output audio format', default="wav", choices=list(AUDIO_FORMATS))
     args = parser.parse_args()
 
-    filename=main(args.filename, args.url, args.speaker,args.language)
+    filename=main(args.filename, args.url, args.speaker,args.language,args.format)
     print(filename)
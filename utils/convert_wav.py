@@ -1,32 +1,75 @@
-import requests
-from pydub import AudioSegment
 import pymupdf
 import argparse
 from dotenv import load_dotenv
 from os.path import join, dirname
 import os
+import hashlib
+import io
+import shutil
 import logging
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from .models import llms
+from .audio_cache import audio_cache
+from .engine_pool import engine_pool
+from .audio_segments import audio_segments, pdf_chapters, SEGMENT_DIRNAME
+from .audio_encoder import audio_encoder, AUDIO_FORMATS
+from .audio_postprocess import pcm_postprocessor
+from .tracing import span, submit
 
 logger = logging.getLogger(__name__)
 load_dotenv(verbose=True)
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
+# 読みの変換(ひらがな化)のプロンプト。変更するとキャッシュキーが変わる
+KANA_SYSTEM_PROMPT = "あなたは誠実で優秀な日本語変換家です"
+KANA_PROMPT = (
+    "以下のテキストを全て日本語のひらがなに変換してください。\n"
+    "漢字、カタカナ、アルファベット、記号は全て変換してください。\n"
+    "文章の意味や文節を意識し、適切な日本語(ひらがな)に変換してください。\n"
+    "省略せずにすべて変換して下さい。ただし、目次ページは全体的に省略して下さい。\n"
+    "入力テキスト：\n{text}\n"
+    "出力テキスト：変換後のテキストのみを出力してください。\n"
+)
+KANA_TEMPERATURE = 0.3
+
+# 同じ(エンジンの種類・URL・バージョン, テキスト, 話者)のaudio_queryはプロセス内で使い回す
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
 class convert_wav:
 
     def __init__(self):
         self.voice_kind=os.environ.get("VOICE_KIND")
-        if self.voice_kind=="VOICEVOX":
-            self.voice_api_url=os.environ.get("VOICEVOX_API_URL")
-        elif self.voice_kind=="AIVIS":
-            self.voice_api_url=os.environ.get("AIVSISPEECH_API_URL")
-        else:
+        if self.voice_kind not in ("VOICEVOX", "AIVIS"):
             logger.error("VOICE_KIND is not set")
             raise ValueError("VOICE_KIND is not set")
+        # 複数のエンジンをカンマ区切りで指定した場合は負荷分散する (プールはプロセス内の本で共有する)
+        self.engine_pool=engine_pool.shared(self.voice_kind)
+        self.voice_api_url=",".join(self.engine_pool.urls())
         logger.info(f"voice_kind: {self.voice_kind}")
         logger.info(f"voice_api_url: {self.voice_api_url}")
+        self.audio_cache = audio_cache.from_env()
+        self.engine_version = None
+        # multi_synthesisでまとめて合成するクエリ数(1以下でバッチ無効)
+        self.batch_size = int(os.environ.get("VOICE_BATCH_SIZE", "4"))
+        # multi_synthesisに対応しているか (None は未確認)。合成のスレッドから更新するためロックで守る
+        self.multi_synthesis_supported = None
+        self._batch_lock = threading.Lock()
+        self.query_cache_size = int(os.environ.get("VOICE_QUERY_CACHE_SIZE", "1024"))
+        self.spool_max_bytes = int(float(os.environ.get("VOICE_SPOOL_MAX_MB", "16")) * 1024 * 1024)
+        self.audio_format = "wav"
+        self.encode_metrics = None
+        self.postprocessor = pcm_postprocessor()
+        self.on_progress = None
+        # 読みの変換に使うLLM (未設定の場合は環境変数の設定で都度作る)
+        self.llm = None
+        self._llm_lock = threading.Lock()
 
     def split_text(self,text, max_length=1000):
         return [text[i:i + max_length] for i in range(0, len(text), max_length)]
@@ -36,22 +79,15 @@ class convert_wav:
         テキスト内の英数字や記号を日本語に変換する
         """
         try:
-            llm = llms()
-            prompt = (
-                f"以下のテキストを全て日本語のひらがなに変換してください。\n"
-                f"漢字、カタカナ、アルファベット、記号は全て変換してください。\n"
-                f"文章の意味や文節を意識し、適切な日本語(ひらがな)に変換してください。\n"
-                f"省略せずにすべて変換して下さい。ただし、目次ページは全体的に省略して下さい。\n"
-                f"入力テキスト：\n{text}\n"
-                f"出力テキスト：変換後のテキストのみを出力してください。\n"
-            )
+            llm = self.get_llm()
             messages=[
-                {"role": "system", "content": "あなたは誠実で優秀な日本語変換家です"},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": KANA_SYSTEM_PROMPT},
+                {"role": "user", "content": KANA_PROMPT.format(text=text)}
             ]
             completion = llm._call_api(
                 messages=messages,
-                temperature=0.3
+                temperature=KANA_TEMPERATURE,
+                kind="kana"
             )
             
             if completion:
@@ -65,28 +101,109 @@ class convert_wav:
             logger.error(f"日本語変換処理でエラーが発生しました: {e}")
             return text
 
-    def generate_query(self,text, url=None, speaker=1):
+    def generate_query(self,text, speaker=1):
+        # VOICEVOXとAIVISのプールを同じプロセスで使う場合や、エンジンを更新した場合に、別のエンジンのクエリを返さない
+        cache_key=(self.voice_kind, self.voice_api_url, self.get_engine_version(), audio_cache.normalize_text(text), str(speaker))
+        with _query_cache_lock:
+            if cache_key in _query_cache:
+                _query_cache.move_to_end(cache_key)
+                return _query_cache[cache_key]
+
         query_payload={'text': text,'speaker': speaker}
-        url=url+"/audio_query"
-        response= requests.post(url,params=query_payload)
+        response= self.engine_pool.post("/audio_query",params=query_payload)
 
         if response.status_code != 200:
             print(f"Eroor in audio_eury: {response.text}")
             return
 
         query=response.json()
+        with _query_cache_lock:
+            _query_cache[cache_key]=query
+            while len(_query_cache) > self.query_cache_size:
+                _query_cache.popitem(last=False)
         return query
 
-    def generate_audio(self,query, index,pdf_dir,url=None,speaker=1):
+    def generate_audio(self,query, speaker=1):
         payload={"speaker": speaker}
-        url=url+"/synthesis"
-        response = requests.post(url, params=payload,json=query)
+        response, body = self.engine_pool.post_spooled("/synthesis", self.spool_max_bytes, params=payload,json=query)
         
         if response.status_code == 200:
-            with open(os.path.join(pdf_dir,f"output_{index}.wav"), "wb") as f:
-                f.write(response.content)
+            return body
         else:
             print(f"Error: {response.status_code}")
+            return None
+
+    def generate_audio_batch(self, queries, speaker=1):
+        """
+        multi_synthesisで複数のクエリをまとめて合成し、クエリ順の音声を返します。
+        エンジンが対応していない場合や、返ってきたZIPの音声の数がクエリと合わない場合は1件ずつの合成に切り替えます。
+        """
+        if self.batch_limit() <= 1 or len(queries) == 1:
+            return [self.generate_audio(query, speaker) for query in queries]
+
+        payload={"speaker": speaker}
+        response, archive = self.engine_pool.post_spooled("/multi_synthesis", self.spool_max_bytes, params=payload,json=queries)
+        if response.status_code in (404, 405):
+            with self._batch_lock:
+                if self.multi_synthesis_supported is not False:
+                    logger.info("multi_synthesis is not supported, falling back to synthesis")
+                self.multi_synthesis_supported = False
+            return [self.generate_audio(query, speaker) for query in queries]
+        if response.status_code != 200:
+            logger.error(f"multi_synthesis failed with {response.status_code}, falling back to synthesis")
+            return [self.generate_audio(query, speaker) for query in queries]
+
+        buffers = []
+        try:
+            with zipfile.ZipFile(archive) as zf:
+                # 001.wav, 002.wav ... の順にクエリと対応する
+                for name in sorted(zf.namelist()):
+                    buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_max_bytes)
+                    buffers.append(buffer)
+                    with zf.open(name) as member:
+                        shutil.copyfileobj(member, buffer)
+                    buffer.seek(0)
+        except (zipfile.BadZipFile, OSError, EOFError) as e:
+            logger.error(f"multi_synthesis returned a broken archive ({e}), falling back to synthesis")
+            buffers = self.close_buffers(buffers)
+        finally:
+            archive.close()
+        if len(buffers) != len(queries):
+            # 音声が欠けたまま章を書き出さないよう、全て1件ずつ合成し直す
+            logger.error(f"multi_synthesis returned {len(buffers)} files for {len(queries)} queries, falling back to synthesis")
+            self.close_buffers(buffers)
+            return [self.generate_audio(query, speaker) for query in queries]
+        return buffers
+
+    def close_buffers(self, buffers):
+        for buffer in buffers:
+            buffer.close()
+        return []
+
+    def batch_limit(self):
+        """multi_synthesisでまとめるクエリ数。エンジンが対応していないと分かった後は1件ずつにします。"""
+        with self._batch_lock:
+            return 1 if self.multi_synthesis_supported is False else max(1, self.batch_size)
+
+    def get_engine_version(self):
+        # キャッシュキーに含めるため、エンジンのバージョンを一度だけ取得する
+        if self.engine_version is None:
+            try:
+                response = self.engine_pool.get("/version", timeout=10)
+                self.engine_version = str(response.json()) if response.status_code == 200 else "unknown"
+            except Exception as e:
+                logger.error(f"Error in version: {e}")
+                self.engine_version = "unknown"
+        return self.engine_version
+
+    def cache_key(self, text):
+        return self.audio_cache.make_key(
+            text,
+            self.voice_kind,
+            self.voice_speaker_id,
+            self.get_engine_version(),
+            self.kana_settings()
+        )
 
     def pdf2text(self,filename:str):
         try:
@@ -122,48 +239,182 @@ class convert_wav:
     def generate_wav(self,filename:str):
         logging.info(f"Converting {filename} to wav Started")
         pdf_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ),  '..',filename))
-        pdf_dir=os.path.dirname(pdf_path)
-        text=self.pdf2text(pdf_path)
+        # テキストを抽出できないPDFはここでエラーにする
+        with span("tts_extract"):
+            self.pdf2text(pdf_path)
+            chapters=pdf_chapters(pdf_path)
 
-        split_texts = self.split_text(text)
+        # (章番号, テキスト) の順に分割する
+        split_texts = [(c, part) for c, (_, text) in enumerate(chapters) for part in self.split_text(text)]
+        chapter_parts = [[i for i, (c, _) in enumerate(split_texts) if c == chapter] for chapter in range(len(chapters))]
         logging.info(f"Converting {filename} to wav text split into {len(split_texts)} parts")
         logging.info(f"speaker: {self.voice_speaker_id}")
-        for i, part in enumerate(split_texts):
-            part=self.convert_to_japanese(part)
-            logging.info(f"Converting {filename} to wav text extracted")
-            query=self.generate_query(part,self.voice_api_url,self.voice_speaker_id)
-            self.generate_audio(query, i,pdf_dir,self.voice_api_url,self.voice_speaker_id)
-            logging.info(f"Converting {filename} to wav audio file {i} generated")
-
+        self.engine_pool.check_health()
         output_filename=self.set_output_filename(pdf_path)
-        self.combine_audio_files_with_name(len(split_texts),pdf_dir,output_filename)
+        # 章が書き出されるたびに、選択した形式で本全体のファイルへエンコードする
+        encoder = audio_encoder(output_filename, self.audio_format)
+        segments = audio_segments(self.set_segment_dir(pdf_path), [title for title, _ in chapters], encoder)
+        audio_files = [None] * len(split_texts)
+        resolved = [False] * len(split_texts)
+        next_chapter = 0
+        self.emit_progress("tts_started", chunks=len(split_texts), chapters=len(chapters))
+
+        def resolve(i, buffer):
+            audio_files[i] = buffer
+            resolved[i] = True
+            self.emit_progress("tts_chunk", done=sum(resolved), total=len(split_texts))
+
+        def flush_chapters(pending):
+            # 合成が終わったバッチを回収し、全チャンクが揃った章から順に書き出す
+            nonlocal next_chapter
+            for future in [f for f in pending if f.done()]:
+                pending.remove(future)
+                for i, buffer in future.result():
+                    resolve(i, buffer)
+            while next_chapter < len(chapters):
+                indexes = chapter_parts[next_chapter]
+                if not all(resolved[i] for i in indexes):
+                    break
+                chapter_files = [audio_files[i] for i in indexes]
+                if any(audio_file is not None for audio_file in chapter_files):
+                    segment_path = segments.next_segment_path()
+                    with span("audio_concat", chapter=next_chapter + 1, chunks=len(chapter_files)):
+                        self.combine_audio_files_with_name(chapter_files, segment_path)
+                        segments.add(chapters[next_chapter][0], segment_path)
+                    self.emit_progress("tts_segment", index=len(segments.segments) - 1, title=chapters[next_chapter][0],
+                                       chapter=next_chapter + 1, chapters=len(chapters))
+                for i in indexes:
+                    audio_files[i] = None
+                next_chapter += 1
+
+        # エンジンプールの同時実行数の合計だけ、クエリ生成と合成をそれぞれ並列に行う
+        capacity = self.engine_pool.capacity()
+        with ThreadPoolExecutor(max_workers=capacity) as query_executor, ThreadPoolExecutor(max_workers=capacity) as synth_executor:
+            query_futures = [
+                submit(query_executor, self.prepare_part, filename, part, i)
+                for i, (_, part) in enumerate(split_texts)
+            ]
+            pending = []
+            batch = []
+            for i, future in enumerate(query_futures):
+                cached, key, query = future.result()
+                if cached is not None:
+                    resolve(i, cached)
+                elif query is None:
+                    resolve(i, None)
+                else:
+                    batch.append((i, key, query))
+                # 章の区切りではバッチを待たずに送り、その章を早く書き出せるようにする
+                chapter_end = i + 1 == len(split_texts) or split_texts[i + 1][0] != split_texts[i][0]
+                if batch and (len(batch) >= self.batch_limit() or chapter_end):
+                    pending.append(submit(synth_executor, self.synthesize_batch, filename, batch))
+                    batch = []
+                flush_chapters(pending)
+            while pending:
+                wait(pending, return_when=FIRST_COMPLETED)
+                flush_chapters(pending)
+            flush_chapters(pending)
+
+        with span("audio_finish", format=self.audio_format):
+            segments.finish()
+        self.encode_metrics = encoder.metrics()
+        self.emit_progress("tts_finished", **self.encode_metrics)
+        logging.info(f"Converting {filename} to {self.audio_format}: {self.encode_metrics}")
         logging.info(f"Converting {filename} to wav Finished")
         return output_filename
 
+    def prepare_part(self, filename, part, index):
+        """キャッシュを引き、ヒットしなければ日本語変換とaudio_queryの生成を行います。"""
+        with span("tts_prepare", chunk=index) as record:
+            key = self.cache_key(part) if self.audio_cache else None
+            cached = self.audio_cache.get(key) if key else None
+            if cached is not None:
+                # キャッシュにヒットしたチャンクは変換・合成を省略する
+                logging.info(f"Converting {filename} to wav audio file {index} loaded from cache")
+                if record:
+                    record["attributes"]["cached"] = True
+                return io.BytesIO(cached), key, None
+            with span("tts_kana", chunk=index, chars=len(part)):
+                part=self.convert_to_japanese(part)
+            logging.info(f"Converting {filename} to wav text extracted")
+            with span("tts_audio_query", chunk=index):
+                query=self.generate_query(part,self.voice_speaker_id)
+            return None, key, query
+
+    def synthesize_batch(self, filename, batch):
+        with span("tts_synthesis", chunks=",".join(str(index) for index, _, _ in batch)):
+            buffers = self.generate_audio_batch([query for _, _, query in batch], self.voice_speaker_id)
+        if len(buffers) != len(batch):
+            # 欠けたチャンクも失敗として返し、後ろの章が書き出されずに残らないようにする
+            logger.error(f"synthesis returned {len(buffers)} files for {len(batch)} chunks")
+            buffers = list(buffers[:len(batch)]) + [None] * (len(batch) - len(buffers))
+        results = []
+        for (index, key, _), buffer in zip(batch, buffers):
+            if key and buffer is not None:
+                self.audio_cache.put(key, buffer.read())
+                buffer.seek(0)
+            logging.info(f"Converting {filename} to wav audio file {index} generated")
+            results.append((index, buffer))
+        return results
+
     def set_output_filename(self, filename: str):
-        # PDFファイル名から拡張子を除去してwav拡張子を付与
+        # PDFファイル名から拡張子を除去して出力形式の拡張子を付与
         base_name = os.path.splitext(filename)[0]
-        return f"{base_name}.wav"
+        return f"{base_name}.{AUDIO_FORMATS[self.audio_format]['ext']}"
+
+    def set_audio_format(self, audio_format: str):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+        self.audio_format = audio_format
+
+    def set_segment_dir(self, filename: str):
+        # 章ごとの音声はPDFと同じディレクトリのaudio_segmentsに出力する
+        return os.path.join(os.path.dirname(filename), SEGMENT_DIRNAME)
+
+    def combine_audio_files_with_name(self, audio_files, output_filename):
+        # 無音の除去・音量の正規化・チャンク間の間隔をNumPyでまとめて処理する
+        self.postprocessor.combine(audio_files, output_filename)
 
-    def combine_audio_files_with_name(self, num_files, pdf_dir, output_filename):
-        combined = AudioSegment.empty()
-        for i in range(num_files):
-            audio = AudioSegment.from_wav(os.path.join(pdf_dir,f"output_{i}.wav"))
-            combined += audio
-            # 一時ファイルを削除
-            os.remove(os.path.join(pdf_dir,f"output_{i}.wav"))
-        combined.export(output_filename, format="wav")
+    def set_progress_callback(self, callback):
+        """進捗を callback(event, **data) で通知します。"""
+        self.on_progress = callback
+
+    def emit_progress(self, event, **data):
+        if self.on_progress:
+            self.on_progress(event, **data)
 
     def set_voice_url(self,url):
-        self.voice_api_url=url
+        self.engine_pool=engine_pool.from_urls(url, self.voice_kind)
+        self.voice_api_url=",".join(self.engine_pool.urls())
 
     def set_voice_speaker_id(self,speaker_id):
         self.voice_speaker_id=speaker_id
 
-def main(filename, url, speaker):
+    def get_llm(self):
+        """読みの変換に使うLLM。set_llm で設定されていなければ環境変数の設定で1度だけ作ります。"""
+        with self._llm_lock:
+            if self.llm is None:
+                self.llm = llms()
+            return self.llm
+
+    def kana_settings(self) -> dict:
+        """読みの変換に使うLLMとプロンプト。これらが変わった場合に古い音声を使わないよう、キャッシュキーに含めます。"""
+        llm = self.get_llm()
+        return {
+            "kana_llm": f"{llm.get_provider_name()}:{llm.model_for('kana')}",
+            "kana_prompt": hashlib.sha256((KANA_SYSTEM_PROMPT + KANA_PROMPT).encode("utf-8")).hexdigest()[:16],
+            "kana_temperature": KANA_TEMPERATURE,
+        }
+
+    def set_llm(self, llm):
+        """読みの変換に使うLLMのクライアント(本と同じプロバイダ・モデル)を設定します。"""
+        self.llm = llm
+
+def main(filename, url, speaker, audio_format="wav"):
     cw = convert_wav()
     cw.set_voice_url(url)
     cw.set_voice_speaker_id(speaker) 
+    cw.set_audio_format(audio_format)
     filename=cw.generate_wav(filename)
     return filename
 
@@ -172,8 +423,9 @@ if __name__ == "__main__":
     parser.add_argument('filename', type=str, help='pdf file name')
     parser.add_argument('url', type=str, help='use voicevox url')
     parser.add_argument('speaker', type=int, help='speaker number')
+    parser.add_argument('--format', type=str, help='output audio format', default="wav", choices=list(AUDIO_FORMATS))
 
     args = parser.parse_args()
 
-    filename=main(args.filename, args.url, args.speaker)
+    filename=main(args.filename, args.url, args.speaker, args.format)
     print(filename)
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import random
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from .cover_image import cover_image, preload
+except ImportError:
+    from cover_image import cover_image, preload
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "manifest.json"
+
+def _render(args):
+    index, spec, output_dir = args
+    start = time.perf_counter()
+    try:
+        paths = cover_image().generate_image(
+            output_dir,
+            spec["title"],
+            spec.get("top_text", ""),
+            spec.get("author", ""),
+            str(spec.get("image_code", 1)),
+            str(spec.get("theme", 0)),
+            spec.get("guide_text_placement", "bottom_right"),
+            spec.get("guide_text", "The Definitive Guide"),
+            formats=tuple(spec.get("formats", ("png",))),
+            filename=spec.get("filename") or f"cover_{index:05d}",
+        )
+        error = None
+    except Exception as e:
+        paths = {}
+        error = str(e)
+    return {
+        "index": index,
+        "spec": spec,
+        "paths": paths,
+        "seconds": round(time.perf_counter() - start, 4),
+        "error": error,
+    }
+
+def generate_covers(specs: list, output_dir: str, workers: int = None, write_manifest: bool = True) -> dict:
+    """
+    表紙の仕様(title, top_text, author, image_code, theme, guide_text_placement, guide_text, formats, filename)
+    のリストをプロセスプールで描画し、結果の一覧(manifest)を返します。
+    フォントとイラストは親プロセスで読み込んでおき、各ワーカーでも初期化時に読み込みます。
+    """
+    output_dir = os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    preload()
+
+    start = time.perf_counter()
+    tasks = [(index, spec, output_dir) for index, spec in enumerate(specs)]
+    if workers == 1:
+        results = [_render(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=preload) as executor:
+            # 1件あたりの処理が短いため、まとめて渡してプロセス間通信を減らす
+            chunksize = max(1, len(tasks) // (workers * 4))
+            results = list(executor.map(_render, tasks, chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+
+    succeeded = [r for r in results if not r["error"]]
+    manifest = {
+        "output_dir": output_dir,
+        "workers": workers,
+        "total": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "seconds": round(elapsed, 3),
+        "covers_per_second": round(len(succeeded) / elapsed, 2) if elapsed > 0 else None,
+        "covers": results,
+    }
+    if write_manifest:
+        with open(os.path.join(output_dir, MANIFEST_FILENAME), "w", encoding="UTF-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+def random_specs(n: int, seed: int = 0) -> list:
+    """ベンチマーク用に、タイトル・テーマ・イラストを組み合わせた仕様を生成します。"""
+    rng = random.Random(seed)
+    titles = ["Dify Guide", "Next.js Practical Web Apps", "Introduction to Python Programming",
+              "Machine Learning Basics", "Rust for the Impatient Engineer", "Go"]
+    return [
+        {
+            "title": rng.choice(titles),
+            "author": "AutoGenBook",
+            "image_code": rng.randint(1, 40),
+            "theme": rng.randint(0, 16),
+            "formats": ["png"],
+        }
+        for _ in range(n)
+    ]
+
+def load_specs(filename: str) -> list:
+    with open(filename, encoding="UTF-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate many cover images in parallel.")
+    parser.add_argument('specs', type=str, nargs='?', help='JSONL file of cover specs')
+    parser.add_argument('--output-dir', type=str, help='output directory', default="output/covers")
+    parser.add_argument('--workers', type=int, help='number of worker processes', default=None)
+    parser.add_argument('--benchmark', type=int, help='render N random covers and report covers per second', default=None)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        specs = random_specs(args.benchmark)
+    elif args.specs:
+        specs = load_specs(args.specs)
+    else:
+        parser.error("specs or --benchmark is required")
+
+    manifest = generate_covers(specs, args.output_dir, args.workers)
+    summary = {key: value for key, value in manifest.items() if key != "covers"}
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,54 @@
 import os, re
 import random
+import functools
+import threading
 from PIL import Image, ImageDraw, ImageFont
 import datetime
 from fontTools.ttLib import TTFont
 import uuid
 
+FONT_DIR = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'fonts'))
+
+# フォントの読み込みは重いため、(パス, サイズ)ごとにプロセス内で使い回す。
+# FreeTypeのフォントはスレッドセーフではないので、使い回したフォントでの計測・描画は _font_lock の中で行う
+_font_lock = threading.RLock()
+
+@functools.lru_cache(maxsize=None)
+def load_font(font_path, size):
+    return ImageFont.truetype(font_path, size)
+
+@functools.lru_cache(maxsize=None)
+def load_codepoints(font_file_path):
+    """フォントが収録している文字のコードポイントの集合を返します。"""
+    font = TTFont(font_file_path, lazy=True)
+    try:
+        return frozenset(font['cmap'].getcmap(3,1).cmap)
+    finally:
+        font.close()
+
+IMAGE_DIR = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'images'))
+
+# 表紙のイラストはデコード済みのものを使い回す
+@functools.lru_cache(maxsize=None)
+def load_artwork(image_code):
+    with Image.open(os.path.join(IMAGE_DIR, '%s.png'%image_code)) as artwork:
+        return artwork.convert('RGBA')
+
+def preload(image_codes=None):
+    """表紙の生成に使うイラストとフォントを事前に読み込みます。"""
+    if image_codes is None:
+        image_codes = [os.path.splitext(name)[0] for name in os.listdir(IMAGE_DIR) if name.endswith('.png')]
+    for image_code in image_codes:
+        load_artwork(str(image_code))
+    for name in ('GaramondLight.ttf', 'GaramondLightItalic.ttf', 'HelveticaBold.ttf'):
+        load_codepoints(os.path.join(FONT_DIR, name))
+
 class cover_image:
-    def generate_image(self,base_dir,title, topText, author, image_code, theme, guide_text_placement='bottom_right', guide_text='The Definitive Guide'):
+    def generate_image(self,base_dir,title, topText, author, image_code, theme, guide_text_placement='bottom_right', guide_text='The Definitive Guide', formats=('png', 'eps'), filename=None):
+        """
+        表紙をメモリ上で1度だけ描画し、formats ('png', 'eps', 'pdf') の各形式で保存します。
+        返り値は {形式: 出力したファイルの絶対パス} です。
+        """
 
         themeColors = {
             "0" : (85,19,93,255),
@@ -32,18 +74,52 @@ class cover_image:
         width = 500
         height = 700
         im = Image.new('RGBA', (width, height), "white")
+        with _font_lock:
+            self._draw_text(im, themeColor, title, topText, author, guide_text_placement, guide_text)
+
+        coverImage = load_artwork(str(image_code))
+
+        offset = (80,40)
+        im.paste(coverImage, offset, coverImage)
+        # 同じ描画結果から各形式を直接書き出す
+        if filename is None:
+            filename = str(uuid.uuid4())
+        output_dir = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..',base_dir))
+        paths = {}
+        rgb = None
+        for image_format in formats:
+            final_path = os.path.join(output_dir, '%s.%s'%(filename, image_format))
+            if image_format == 'png':
+                im.save(final_path)
+            else:
+                # EPS・PDFはアルファチャンネルを扱えないためRGBに変換する
+                if rgb is None:
+                    rgb = im.convert('RGB')
+                if image_format == 'eps':
+                    rgb.save(final_path,lossless = True)
+                elif image_format == 'pdf':
+                    rgb.save(final_path, 'PDF', resolution=72.0)
+                else:
+                    raise ValueError(f'Unsupported cover format: {image_format}')
+            paths[image_format] = final_path
+        if rgb is not None:
+            rgb.close()
+        im.close()
+
+        return paths
 
-        font_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'fonts', 'GaramondLight.ttf'))
-        font_path_helv = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'fonts', 'HelveticaNeue-Medium.otf'))
-        font_path_helv_bold = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'fonts', 'HelveticaBold.ttf'))
-        font_path_italic = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'fonts', 'GaramondLightItalic.ttf'))
-        topFont = ImageFont.truetype(font_path_italic, 20)
-        subtitleFont = ImageFont.truetype(font_path_italic, 34)
-        authorFont = ImageFont.truetype(font_path_italic, 12)
-        titleFont = ImageFont.truetype(font_path, 62)
-        oriellyFont = ImageFont.truetype(font_path_helv, 14)
-        questionMarkFont = ImageFont.truetype(font_path_helv_bold, 16)
+    def _draw_text(self, im, themeColor, title, topText, author, guide_text_placement, guide_text):
+        font_path = os.path.join(FONT_DIR, 'GaramondLight.ttf')
+        font_path_helv = os.path.join(FONT_DIR, 'HelveticaNeue-Medium.otf')
+        font_path_helv_bold = os.path.join(FONT_DIR, 'HelveticaBold.ttf')
+        font_path_italic = os.path.join(FONT_DIR, 'GaramondLightItalic.ttf')
+        topFont = load_font(font_path_italic, 20)
+        subtitleFont = load_font(font_path_italic, 34)
+        authorFont = load_font(font_path_italic, 12)
+        oriellyFont = load_font(font_path_helv, 14)
+        questionMarkFont = load_font(font_path_helv_bold, 16)
 
+        width, height = im.size
         dr = ImageDraw.Draw(im)
         dr.rectangle(((20,0),(width-20,10)), fill=themeColor)
 
@@ -117,81 +193,63 @@ class cover_image:
 
         dr.multiline_text((40,420), newTitle, fill='white', font=titleFont)
 
-        cover_image_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ),  '..','images', ('%s.png'%image_code)))
-        coverImage = Image.open(cover_image_path).convert('RGBA')
-
-        offset = (80,40)
-        im.paste(coverImage, offset, coverImage)
-        final_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..',base_dir,('%s.png'%uuid.uuid4())))
-        #final_path=os.path.join(base_dir,('%s.png'%uuid.uuid4()))
-        im.save(final_path)
-        im.close()
-
-        im = Image.open(final_path)
-        fig = im.convert('RGB')
-        final_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..',base_dir,('%s.eps'%uuid.uuid4())))
-        #final_path=os.path.join(base_dir,('%s.eps'%uuid.uuid4()))
-        fig.save(final_path,lossless = True)
-        im.close()
-        fig.close()
-
-        return final_path
-
     def clamp_title_text(self,title, width):
-        im = Image.new('RGBA', (500,500), "white")
-        dr = ImageDraw.Draw(im)
+        font_path = os.path.join(FONT_DIR, 'GaramondLight.ttf')
+        # 文字列の大きさを測るだけの描画先は呼び出しごとに作る
+        dr = ImageDraw.Draw(Image.new('RGBA', (1,1), "white"))
+
+        def largest_fitting_size(start_font_size, end_font_size, fits):
+            # 文字幅はフォントサイズに対して単調増加するので、収まる最大のサイズを二分探索する
+            low, high = end_font_size + 1, start_font_size
+            best = None
+            while low <= high:
+                mid = (low + high) // 2
+                result = fits(load_font(font_path, mid))
+                if result is not None:
+                    best = result
+                    low = mid + 1
+                else:
+                    high = mid - 1
+            return best
 
-        font_path_italic = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'fonts', 'GaramondLight.ttf'))
         #try and fit title on one line
-        font = None
-
-        startFontSize = 80
-        endFontSize = 61
-
-        for fontSize in range(startFontSize,endFontSize,-1):
-            font = ImageFont.truetype(font_path_italic, fontSize)
+        def fits_one_line(font):
             bbox = dr.textbbox((0, 0), title, font=font)
-            w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+            return (font, title) if bbox[2] - bbox[0] < width else None
 
-            if w < width:
-                return font, title
+        with _font_lock:
+            result = largest_fitting_size(80, 61, fits_one_line)
+        if result:
+            return result
 
         #try and fit title on two lines
-        startFontSize = 80
-        endFontSize = 34
-
-        for fontSize in range(startFontSize,endFontSize,-1):
-            font = ImageFont.truetype(font_path_italic, fontSize)
+        splits = [
+            u''.join((title[:match.start()], u'\n', title[(match.start()+1):]))
+            for match in re.finditer(r'\s',title, re.UNICODE)
+        ]
 
-            for match in list(re.finditer(r'\s',title, re.UNICODE)):
-                newTitle = u''.join((title[:match.start()], u'\n', title[(match.start()+1):]))
+        def fits_two_lines(font):
+            for newTitle in splits:
                 bbox = dr.multiline_textbbox((0, 0), newTitle, font=font)
-                substringWidth, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
-
-
-                if substringWidth < width:
+                if bbox[2] - bbox[0] < width:
                     return font, newTitle
+            return None
 
-        im.close()
+        with _font_lock:
+            result = largest_fitting_size(80, 34, fits_two_lines)
+        if result:
+            return result
 
         return None, None
 
     def sanitzie_unicode(self,string, font_file_path):
-        sanitized_string = u''
-
-        font = TTFont(font_file_path)
-        cmap = font['cmap'].getcmap(3,1).cmap
-        for char in string:
-            code_point = ord(char)
-
-            if code_point in cmap.keys():
-                sanitized_string = ''.join((sanitized_string, char))
-
-        return sanitized_string
+        codepoints = load_codepoints(font_file_path)
+        return u''.join(char for char in string if ord(char) in codepoints)
 
 def main():
     ci = cover_image()
     result=ci.generate_image(
+        "output",
         "Dify Guide", 
         "NowCode", 
         "Tomatio",  
@@ -0,0 +1,104 @@
+import time
+import threading
+
+class balanced_endpoint:
+    """endpoint_balancer が振り分ける先の1つ。同時実行数と処理の記録を持ちます。"""
+
+    def __init__(self, name: str, max_concurrency: int = 1):
+        self.name = name
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.outstanding = 0
+        self.failures = 0
+        self.total_requests = 0
+        self.total_errors = 0
+        self.busy_seconds = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.outstanding < self.max_concurrency
+
+    def load(self) -> float:
+        return self.outstanding / self.max_concurrency
+
+    def retry_at(self) -> float:
+        """外している場合に、再び使えるようになる時刻 (time.monotonic) を返します。外していなければ0です。"""
+        return 0.0
+
+class endpoint_balancer:
+    """
+    複数のエンドポイントへの振り分け (TTSエンジンのプール、LLMのルーター) に共通する処理。
+    使えるエンドポイントのうち _rank が最小のものを選び、エンドポイントごとの同時実行数の上限を守ります。
+    失敗した場合は、まだ試していないエンドポイントで再試行します。
+    異常の判定と復帰の方法は、サブクラスが _on_acquire・_on_release で決めます。
+    """
+
+    def __init__(self, endpoints: list):
+        self.endpoints = endpoints
+        self.started_at = time.monotonic()
+        self._cond = threading.Condition()
+
+    def capacity(self) -> int:
+        return sum(endpoint.max_concurrency for endpoint in self.endpoints)
+
+    def _rank(self, endpoint: balanced_endpoint):
+        return endpoint.load()
+
+    def _on_acquire(self, endpoint: balanced_endpoint):
+        """エンドポイントを確保したときに、ロックを持った状態で呼ばれます。"""
+
+    def _on_release(self, endpoint: balanced_endpoint, ok: bool):
+        """エンドポイントを返したときに、ロックを持った状態で呼ばれます。ok は成功したかどうかです。"""
+
+    def _acquire(self, exclude: set) -> balanced_endpoint:
+        """exclude にないエンドポイントを1つ確保します。候補が残っていない場合は None を返します。"""
+        with self._cond:
+            while True:
+                candidates = [e for e in self.endpoints if e.name not in exclude]
+                if not candidates:
+                    return None
+                now = time.monotonic()
+                available = [e for e in candidates if e.available(now)]
+                if available:
+                    endpoint = min(available, key=self._rank)
+                    self._on_acquire(endpoint)
+                    endpoint.outstanding += 1
+                    return endpoint
+                # 全て埋まっているか外れている場合は、空きが出るかクールダウンが明けるまで待つ
+                retry_in = [e.retry_at() - now for e in candidates if e.retry_at() > now]
+                self._cond.wait(timeout=max(0.1, min(retry_in, default=1.0)))
+
+    def _release(self, endpoint: balanced_endpoint, ok: bool, elapsed: float):
+        with self._cond:
+            endpoint.outstanding -= 1
+            endpoint.total_requests += 1
+            endpoint.busy_seconds += elapsed
+            if ok:
+                endpoint.failures = 0
+            else:
+                endpoint.total_errors += 1
+                endpoint.failures += 1
+            self._on_release(endpoint, ok)
+            self._cond.notify_all()
+
+    def _failover(self, attempt) -> tuple:
+        """
+        エンドポイントを確保して attempt(endpoint, last) を実行し、失敗した場合は別のエンドポイントで再試行します。
+        attempt は (成功したか, 結果) を返し、last は最後の候補かどうかです。
+        attempt の実行中はエンドポイントを確保したままにするため、応答の本体を読む処理なども attempt の中で行います。
+        成功した時点の、または最後に試した (成功したか, 結果) を返します。
+        """
+        tried = set()
+        ok, result = False, None
+        while len(tried) < len(self.endpoints):
+            endpoint = self._acquire(tried)
+            if endpoint is None:
+                break
+            tried.add(endpoint.name)
+            start = time.monotonic()
+            ok = False
+            try:
+                ok, result = attempt(endpoint, len(tried) == len(self.endpoints))
+            finally:
+                self._release(endpoint, ok, time.monotonic() - start)
+            if ok:
+                break
+        return ok, result
@@ -0,0 +1,229 @@
+import os
+import time
+import logging
+import threading
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+from os.path import join, dirname
+from dotenv import load_dotenv
+try:
+    from .endpoint_balancer import balanced_endpoint, endpoint_balancer
+except ImportError:
+    from endpoint_balancer import balanced_endpoint, endpoint_balancer
+
+logger = logging.getLogger(__name__)
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+# VOICE_KINDごとのURL環境変数とヘルスチェック用のパス
+ENGINE_ENV = {
+    "VOICEVOX": (["VOICEVOX_API_URLS", "VOICEVOX_API_URL"], "/version"),
+    "AIVIS": (["AIVSISPEECH_API_URLS", "AIVSISPEECH_API_URL", "AivisSPEECH_API_URL"], "/version"),
+    "MELOTTS": (["MELOTTS_API_URLS", "MELOTTS_API_URL"], None),
+}
+
+def spool_response(response: requests.Response, max_bytes: int = None):
+    """
+    レスポンス本体をメモリ上に保持し、max_bytesを超えた場合のみ一時ファイルへ書き出します。
+    返り値は先頭にシーク済みのファイルオブジェクトです。
+    """
+    if max_bytes is None:
+        max_bytes = int(float(os.environ.get("VOICE_SPOOL_MAX_MB", "16")) * 1024 * 1024)
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_bytes)
+    for chunk in response.iter_content(chunk_size=1 << 16):
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+class engine_endpoint(balanced_endpoint):
+    def __init__(self, url: str, max_concurrency: int = 1):
+        super().__init__(url.rstrip("/"), max_concurrency)
+        self.url = self.name
+        self.healthy = True
+        self.unhealthy_until = 0.0
+        self.session = requests.Session()
+        # stream=Trueのレスポンスは解放後に本体を読むため、上限より多めに接続を保持する
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency * 2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def available(self, now: float) -> bool:
+        # 異常判定後もクールダウンが明ければ再度試す
+        return (self.healthy or now >= self.unhealthy_until) and super().available(now)
+
+    def retry_at(self) -> float:
+        return 0.0 if self.healthy else self.unhealthy_until
+
+class engine_pool(endpoint_balancer):
+    """
+    複数のTTSエンジンに対して、未完了リクエスト数が最も少ないエンドポイントへ振り分けるプール。
+    エンドポイントごとの同時実行数の上限、ヘルスチェック、失敗時の別エンドポイントへのフェイルオーバーを行う。
+    失敗したエンジンは retry_cooldown 秒の間は使わない。クールダウンが明けた後も、成功するまでは正常なエンジンに空きがない場合にだけ使う。
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, urls: list, max_concurrency: int = 1, health_path: str = None,
+                 retry_cooldown: float = 10.0, request_timeout: float = 600.0):
+        if not urls:
+            raise ValueError("TTS engine url is not set")
+        super().__init__([engine_endpoint(url, max_concurrency) for url in urls])
+        self.health_path = health_path
+        self.retry_cooldown = retry_cooldown
+        self.request_timeout = request_timeout
+
+    @classmethod
+    def from_urls(cls, urls, kind: str = "VOICEVOX"):
+        """カンマ区切りの文字列またはリストからプールを作成します。"""
+        if isinstance(urls, str):
+            urls = [url.strip() for url in urls.split(",") if url.strip()]
+        _, health_path = ENGINE_ENV.get(kind, ([], None))
+        return cls(
+            urls,
+            max_concurrency=int(os.environ.get("VOICE_ENGINE_MAX_CONCURRENCY", "1")),
+            health_path=health_path,
+            retry_cooldown=float(os.environ.get("VOICE_ENGINE_RETRY_COOLDOWN", "10")),
+            request_timeout=float(os.environ.get("VOICE_ENGINE_TIMEOUT", "600")),
+        )
+
+    @classmethod
+    def from_env(cls, kind: str):
+        env_names, _ = ENGINE_ENV[kind]
+        for name in env_names:
+            if os.environ.get(name):
+                return cls.from_urls(os.environ[name], kind)
+        raise ValueError(f"{' or '.join(env_names)} is not set")
+
+    @classmethod
+    def shared(cls, kind: str):
+        """
+        環境変数の設定から作るプールを、プロセス内で共有して返します。
+        同じプロセスで複数の本の音声を作る場合も、エンドポイントごとの同時実行数の上限を全体で守るためです。
+        """
+        env_names, _ = ENGINE_ENV[kind]
+        key = (kind, tuple(os.environ.get(name) for name in env_names))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls.from_env(kind)
+            return cls._shared[key]
+
+    @classmethod
+    def shared_stats(cls) -> dict:
+        """共有しているプールごとの、エンドポイントの利用状況を返します。"""
+        with cls._shared_lock:
+            pools = dict(cls._shared)
+        return {kind: pool.stats() for (kind, _), pool in pools.items()}
+
+    def urls(self) -> list:
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def check_health(self):
+        """ヘルスチェック用のパスに問い合わせ、各エンドポイントの状態を更新します。"""
+        if not self.health_path:
+            return
+        for endpoint in self.endpoints:
+            try:
+                response = endpoint.session.get(endpoint.url + self.health_path, timeout=5)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with self._cond:
+                if ok:
+                    endpoint.healthy = True
+                    endpoint.failures = 0
+                else:
+                    endpoint.failures += 1
+                    self._mark_unhealthy(endpoint)
+                self._cond.notify_all()
+            if not ok:
+                logger.error(f"TTS engine is unhealthy: {endpoint.url}")
+
+    def _mark_unhealthy(self, endpoint: engine_endpoint):
+        endpoint.healthy = False
+        endpoint.unhealthy_until = time.monotonic() + self.retry_cooldown
+
+    def _rank(self, endpoint: engine_endpoint):
+        # クールダウンが明けても復帰を確かめていないエンジンは、正常なエンジンが埋まっている場合にだけ使う
+        return (not endpoint.healthy, endpoint.load())
+
+    def _on_release(self, endpoint: engine_endpoint, ok: bool):
+        if ok:
+            endpoint.healthy = True
+        else:
+            self._mark_unhealthy(endpoint)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        リクエストを送信します。接続エラーや5xxの場合は別のエンドポイントで再試行し、
+        全エンドポイントで失敗した場合は最後のレスポンスを返すか例外を送出します。
+        """
+        response, _ = self._request(method, path, None, **kwargs)
+        return response
+
+    def post_spooled(self, path: str, max_bytes: int = None, **kwargs):
+        """
+        POSTして、200の場合はレスポンス本体を spool_response で読み込みます。
+        本体を読み終えるまでエンドポイントを確保するため、転送中のリクエストも同時実行数の上限と処理時間に含まれます。
+        (レスポンス, 本体のファイル) を返し、200以外の場合の本体は None です。
+        """
+        def consume(response: requests.Response):
+            try:
+                if response.status_code == 200:
+                    return spool_response(response, max_bytes)
+                # エラーの本体は小さいため読み込んでおき (response.text で参照できる)、接続をプールへ返す
+                response.content
+                return None
+            finally:
+                response.close()
+
+        return self._request("POST", path, consume, stream=True, **kwargs)
+
+    def _request(self, method: str, path: str, consume, **kwargs):
+        kwargs.setdefault("timeout", self.request_timeout)
+        last_error = None
+
+        def attempt(endpoint: engine_endpoint, last: bool):
+            nonlocal last_error
+            try:
+                response = endpoint.session.request(method, endpoint.url + path, **kwargs)
+            except requests.RequestException as e:
+                logger.error(f"TTS engine {endpoint.url} request failed: {e}")
+                last_error = e
+                return False, None
+            ok = response.status_code < 500
+            if ok or last:
+                # 本体の読み込みもエンドポイントを確保したまま行う
+                return ok, (response, consume(response) if consume else None)
+            logger.error(f"TTS engine {endpoint.url} returned {response.status_code}, failing over")
+            # 本体を読まずに捨てるレスポンスは閉じて、接続を解放する
+            response.close()
+            return False, None
+
+        _, result = self._failover(attempt)
+        if result is None:
+            raise RuntimeError(f"All TTS engines failed: {last_error}")
+        return result
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def stats(self) -> list:
+        with self._cond:
+            return [
+                {
+                    "url": e.url,
+                    "healthy": e.healthy,
+                    "outstanding": e.outstanding,
+                    "max_concurrency": e.max_concurrency,
+                    "requests": e.total_requests,
+                    "errors": e.total_errors,
+                    "busy_seconds": round(e.busy_seconds, 3),
+                }
+                for e in self.endpoints
+            ]
@@ -0,0 +1,393 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from contextlib import closing
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "output", "jobs.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    request TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT NOT NULL DEFAULT '{}',
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    updated_at REAL NOT NULL,
+    finished_at REAL,
+    pages REAL NOT NULL DEFAULT 0,
+    request_key TEXT,
+    followers INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_job_id ON events (job_id, id);
+"""
+
+# 既存のデータベースに後から追加した列
+MIGRATIONS = {
+    "pages": "ALTER TABLE jobs ADD COLUMN pages REAL NOT NULL DEFAULT 0",
+    "request_key": "ALTER TABLE jobs ADD COLUMN request_key TEXT",
+    "followers": "ALTER TABLE jobs ADD COLUMN followers INTEGER NOT NULL DEFAULT 0",
+}
+
+# 同じ本とみなすリクエストの項目
+REQUEST_KEY_FIELDS = ("book_content", "target_readers", "n_pages", "level", "wav_output", "audio_format", "profile",
+                      "provider", "model", "models")
+
+def request_key(request: dict) -> str:
+    """リクエストの正規化したハッシュを返します。文字列は前後の空白を除いて比較します。"""
+    canonical = {
+        field: value.strip() if isinstance(value, str) else value
+        for field, value in ((field, request.get(field)) for field in REQUEST_KEY_FIELDS)
+    }
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+def estimate_pages(request: dict) -> float:
+    """
+    ジョブの重さをページ数換算で見積もります。
+    音声を出力する場合は、合成の分として JOB_AUDIO_PAGE_WEIGHT 倍のページ数を加えます。
+    """
+    pages = float(request.get("n_pages") or 0)
+    if request.get("wav_output"):
+        pages *= 1 + float(os.environ.get("JOB_AUDIO_PAGE_WEIGHT", "1.0"))
+    return pages
+
+class queue_full(Exception):
+    """受け付けの上限を超えた場合に送出します。retry_after は再送までの目安(秒)です。"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class job_queue:
+    """
+    本の生成ジョブをSQLiteに永続化するキュー。
+    ワーカーはジョブをリース付きで取得し、処理中は定期的にリースを延長(ハートビート)します。
+    ワーカーが落ちてリースが切れたジョブは、max_attempts に達するまで別のワーカーが再取得します。
+    """
+
+    def __init__(self, db_path: str = None, lease_seconds: float = None, max_attempts: int = None):
+        self.db_path = db_path or os.environ.get("JOB_DB_PATH") or DEFAULT_DB_PATH
+        self.lease_seconds = lease_seconds or float(os.environ.get("JOB_LEASE_SECONDS", "60"))
+        self.max_attempts = max_attempts or int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+        # 受け付けと実行の上限 (0は無制限)
+        self.max_running = int(os.environ.get("JOB_MAX_RUNNING", "0"))
+        self.max_queued = int(os.environ.get("JOB_MAX_QUEUED", "20"))
+        self.max_pages_in_flight = float(os.environ.get("JOB_MAX_PAGES_IN_FLIGHT", "0"))
+        # 同じリクエストを1つのジョブにまとめる期間(秒, 0で無効)
+        self.dedup_window = float(os.environ.get("JOB_DEDUP_WINDOW_SECONDS", "60"))
+        # 完了したジョブがない間のETAの見積もりに使う1ページあたりの秒数
+        self.seconds_per_page = float(os.environ.get("JOB_SECONDS_PER_PAGE", "60"))
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(statement)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_request_key ON jobs (request_key, created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # 複数のプロセス・スレッドから使うため、操作ごとに接続する
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _transaction(self, conn: sqlite3.Connection):
+        conn.execute("BEGIN IMMEDIATE")
+
+    def enqueue(self, job_id: str, request: dict, result: dict = None, admission: bool = True) -> str:
+        """
+        ジョブを登録し、そのジョブIDを返します。
+        dedup_window 秒以内に同じ内容のジョブが登録されていれば、新たに登録せずにそのジョブのIDを返します。
+        admission が True の場合、待機数や処理中のページ数が上限を超えるときは登録せずに queue_full を送出します。
+        """
+        pages = estimate_pages(request)
+        key = request_key(request)
+        conn = self._connect()
+        try:
+            self._transaction(conn)
+            now = time.time()
+            leader = self._find_leader(conn, key, now)
+            if leader:
+                # 先行するジョブに合流し、その成果物を共有する
+                conn.execute("UPDATE jobs SET followers = followers + 1 WHERE id = ?", (leader,))
+                self._add_event(conn, leader, "coalesced", {}, now)
+                conn.execute("COMMIT")
+                logger.info(f"request coalesced into job {leader}")
+                return leader
+            if admission:
+                self._admit(conn, pages, now)
+            conn.execute(
+                "INSERT INTO jobs (id, request, status, result, created_at, updated_at, pages, request_key) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(request, ensure_ascii=False), json.dumps(result or {}, ensure_ascii=False), now, now, pages, key),
+            )
+            self._add_event(conn, job_id, "queued", {"pages": pages}, now)
+            conn.execute("COMMIT")
+            return job_id
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _find_leader(self, conn: sqlite3.Connection, key: str, now: float):
+        if self.dedup_window <= 0:
+            return None
+        # 失敗したジョブには合流しない
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE request_key = ? AND created_at >= ? AND status != 'failed' "
+            "ORDER BY created_at LIMIT 1",
+            (key, now - self.dedup_window),
+        ).fetchone()
+        return row["id"] if row else None
+
+    def _admit(self, conn: sqlite3.Connection, pages: float, now: float):
+        active = conn.execute(
+            "SELECT status, COUNT(*) AS n, COALESCE(SUM(pages), 0) AS pages FROM jobs "
+            "WHERE status IN ('queued', 'processing') GROUP BY status"
+        ).fetchall()
+        queued = sum(row["n"] for row in active if row["status"] == "queued")
+        pages_in_flight = sum(row["pages"] for row in active)
+        if self.max_queued and queued >= self.max_queued:
+            reason = f"too many queued books ({queued}/{self.max_queued})"
+        elif self.max_pages_in_flight and pages_in_flight > 0 and pages_in_flight + pages > self.max_pages_in_flight:
+            reason = f"too many pages in flight ({pages_in_flight:g}+{pages:g}/{self.max_pages_in_flight:g})"
+        else:
+            return
+        # 処理中・待機中のジョブが1件終わるまでの平均的な時間を再送の目安にする
+        backlog, parallelism = self._backlog(conn, now)
+        jobs = max(1, sum(row["n"] for row in active))
+        raise queue_full(reason, int(min(3600, max(1, backlog / parallelism / jobs))))
+
+    def claim(self, worker_id: str):
+        """
+        待機中のジョブ、またはリースが切れた処理中のジョブを1件取得します。
+        試行回数が上限に達したジョブは失敗として扱います。取得できるジョブがなければ None を返します。
+        """
+        conn = self._connect()
+        try:
+            self._transaction(conn)
+            now = time.time()
+            if self.max_running:
+                running = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'processing' AND lease_expires_at >= ?", (now,)
+                ).fetchone()[0]
+                if running >= self.max_running:
+                    conn.execute("COMMIT")
+                    return None
+            while True:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'processing' AND lease_expires_at < ?) "
+                    "ORDER BY created_at LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                if row["status"] == "processing":
+                    logger.error(f"job {row['id']} lease expired (worker {row['worker_id']})")
+                    if row["attempts"] >= self.max_attempts:
+                        conn.execute(
+                            "UPDATE jobs SET status = 'failed', error = ?, worker_id = NULL, lease_expires_at = NULL, "
+                            "updated_at = ?, finished_at = ? WHERE id = ?",
+                            (f"worker lost after {row['attempts']} attempts", now, now, row["id"]),
+                        )
+                        self._add_event(conn, row["id"], "failed", {"error": f"worker lost after {row['attempts']} attempts"}, now)
+                        continue
+                conn.execute(
+                    "UPDATE jobs SET status = 'processing', attempts = attempts + 1, worker_id = ?, lease_expires_at = ?, "
+                    "started_at = COALESCE(started_at, ?), updated_at = ? WHERE id = ?",
+                    (worker_id, now + self.lease_seconds, now, now, row["id"]),
+                )
+                self._add_event(conn, row["id"], "started", {"attempt": row["attempts"] + 1}, now)
+                conn.execute("COMMIT")
+                job = self._to_dict(row)
+                job["attempts"] += 1
+                return job
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """リースを延長します。他のワーカーに取得し直されていた場合は False を返します。"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE id = ? AND worker_id = ? AND status = 'processing'",
+                (now + self.lease_seconds, now, job_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def update(self, job_id: str, worker_id: str, **fields) -> bool:
+        """処理中のジョブの結果(result)に項目を追加・更新します。"""
+        return self._write(job_id, worker_id, None, fields, None)
+
+    def complete(self, job_id: str, worker_id: str, result: dict) -> bool:
+        return self._write(job_id, worker_id, "completed", result, None)
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        return self._write(job_id, worker_id, "failed", {}, error)
+
+    def _write(self, job_id: str, worker_id: str, status: str, fields: dict, error: str) -> bool:
+        conn = self._connect()
+        try:
+            self._transaction(conn)
+            row = conn.execute(
+                "SELECT result FROM jobs WHERE id = ? AND worker_id = ? AND status = 'processing'",
+                (job_id, worker_id),
+            ).fetchone()
+            if row is None:
+                # リースを失ったワーカーの結果は反映しない
+                conn.execute("COMMIT")
+                logger.error(f"job {job_id} is no longer owned by {worker_id}")
+                return False
+            result = json.loads(row["result"])
+            result.update(fields)
+            now = time.time()
+            if status is None:
+                conn.execute(
+                    "UPDATE jobs SET result = ?, updated_at = ? WHERE id = ?",
+                    (json.dumps(result, ensure_ascii=False), now, job_id),
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, result = ?, error = ?, lease_expires_at = NULL, "
+                    "updated_at = ?, finished_at = ? WHERE id = ?",
+                    (status, json.dumps(result, ensure_ascii=False), error, now, now, job_id),
+                )
+                # 状態の変化もイベントとして残し、購読側が終了を検知できるようにする
+                self._add_event(conn, job_id, status, {"error": error} if error else result, now)
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def add_event(self, job_id: str, event: str, data: dict = None):
+        """進捗イベントを追加します。イベントIDはジョブをまたいで単調増加します。"""
+        with closing(self._connect()) as conn:
+            self._add_event(conn, job_id, event, data or {}, time.time())
+
+    def _add_event(self, conn: sqlite3.Connection, job_id: str, event: str, data: dict, now: float):
+        conn.execute(
+            "INSERT INTO events (job_id, event, data, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, event, json.dumps(data, ensure_ascii=False, default=str), now),
+        )
+
+    def events(self, job_id: str, after_id: int = 0, limit: int = 1000) -> list:
+        """after_id より後のイベントを古い順に返します。"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, event, data, created_at FROM events WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (job_id, after_id, limit),
+            ).fetchall()
+        return [
+            {"id": row["id"], "event": row["event"], "data": json.loads(row["data"]), "created_at": row["created_at"]}
+            for row in rows
+        ]
+
+    def get(self, job_id: str):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def status(self, job_id: str):
+        """
+        APIで返すタスクの状態を返します。
+        結果の項目に status・attempts を加えた辞書で、失敗した場合は error を含みます。
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        task = dict(job["result"])
+        task["status"] = job["status"]
+        task["attempts"] = job["attempts"]
+        task["followers"] = job["followers"]
+        if job["error"]:
+            task["error"] = job["error"]
+        if job["status"] in ("queued", "processing"):
+            task.update(self.estimate(job))
+        return task
+
+    def _seconds_per_page(self, conn: sqlite3.Connection) -> float:
+        """直近に完了したジョブの実績から1ページあたりの処理時間を求めます。"""
+        row = conn.execute(
+            "SELECT SUM(finished_at - started_at) AS seconds, SUM(pages) AS pages FROM "
+            "(SELECT finished_at, started_at, pages FROM jobs WHERE status = 'completed' AND pages > 0 "
+            "ORDER BY finished_at DESC LIMIT 20)"
+        ).fetchone()
+        if row["pages"]:
+            return row["seconds"] / row["pages"]
+        return self.seconds_per_page
+
+    def _backlog(self, conn: sqlite3.Connection, now: float, before: float = None):
+        """
+        残りの処理時間の合計(秒)と並列度を返します。
+        before を指定した場合は、それより前に登録された待機中のジョブだけを数えます。
+        """
+        seconds_per_page = self._seconds_per_page(conn)
+        processing = conn.execute(
+            "SELECT pages, started_at FROM jobs WHERE status = 'processing'"
+        ).fetchall()
+        remaining = sum(max(0.0, row["pages"] * seconds_per_page - (now - (row["started_at"] or now))) for row in processing)
+        queued = conn.execute(
+            "SELECT COALESCE(SUM(pages), 0) FROM jobs WHERE status = 'queued' AND created_at < ?",
+            (now if before is None else before,),
+        ).fetchone()[0]
+        parallelism = self.max_running or max(1, len(processing))
+        return remaining + queued * seconds_per_page, parallelism
+
+    def estimate(self, job: dict) -> dict:
+        """待機中のジョブの順番と、完了までの見込み時間(秒)を返します。"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            seconds_per_page = self._seconds_per_page(conn)
+            own = job["pages"] * seconds_per_page
+            if job["status"] == "processing":
+                elapsed = now - (job["started_at"] or now)
+                return {"queue_position": 0, "eta_seconds": int(max(0.0, own - elapsed))}
+            position = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (job["created_at"],)
+            ).fetchone()[0]
+            backlog, parallelism = self._backlog(conn, now, before=job["created_at"])
+        return {"queue_position": position + 1, "eta_seconds": int(backlog / parallelism + own)}
+
+    def counts(self) -> dict:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["request"] = json.loads(job["request"])
+        job["result"] = json.loads(job["result"])
+        return job
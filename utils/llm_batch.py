@@ -0,0 +1,262 @@
+import os
+import copy
+import json
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+class batch_request:
+    def __init__(self, llm, messages: list, response_format, kind: str, max_tokens: int, temperature: float):
+        self.llm = llm
+        self.messages = messages
+        self.response_format = response_format or None
+        self.kind = kind
+        self.model = llm.model_for(kind)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.custom_id = None
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+
+class openai_batch_backend:
+    """OpenAIのBatch API (入力ファイルをアップロードし、/v1/batches で処理する)。"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, items: list) -> str:
+        lines = []
+        for item in items:
+            body = item.llm._openai_body(item.model, copy.deepcopy(item.messages), item.response_format, item.temperature, item.max_tokens)
+            lines.append(json.dumps({"custom_id": item.custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}, ensure_ascii=False))
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        file = self.client.files.create(file=("batch.jsonl", data), purpose="batch")
+        batch = self.client.batches.create(input_file_id=file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id: str) -> tuple:
+        """(終了したか, 処理済みの件数, 全件数) を返します。"""
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        ended = batch.status in ("completed", "failed", "expired", "cancelled")
+        if counts is None:
+            return ended, 0, 0
+        return ended, counts.completed + counts.failed, counts.total
+
+    def cancel(self, batch_id: str):
+        self.client.batches.cancel(batch_id)
+
+    def results(self, batch_id: str, items: dict) -> dict:
+        batch = self.client.batches.retrieve(batch_id)
+        if not batch.output_file_id:
+            return {}
+        results = {}
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            item = items.get(entry.get("custom_id"))
+            if item is None or response.get("status_code") != 200:
+                continue
+            try:
+                results[item.custom_id] = item.llm._openai_completion(response["body"], item.response_format)
+            except Exception as e:
+                # 応答形式に合わない結果は同期呼び出しでやり直す
+                logger.error(f"LLM batch result {item.custom_id} could not be parsed: {e}")
+        return results
+
+class anthropic_batch_backend:
+    """AnthropicのMessage Batches API。"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, items: list) -> str:
+        requests = [
+            {
+                "custom_id": item.custom_id,
+                "params": item.llm._claude_params(item.model, copy.deepcopy(item.messages), item.response_format, item.temperature, item.max_tokens),
+            }
+            for item in items
+        ]
+        return self.client.messages.batches.create(requests=requests).id
+
+    def status(self, batch_id: str) -> tuple:
+        batch = self.client.messages.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        finished = counts.succeeded + counts.errored + counts.canceled + counts.expired
+        return batch.processing_status == "ended", finished, finished + counts.processing
+
+    def cancel(self, batch_id: str):
+        self.client.messages.batches.cancel(batch_id)
+
+    def results(self, batch_id: str, items: dict) -> dict:
+        return {
+            entry.custom_id: entry.result.message
+            for entry in self.client.messages.batches.results(batch_id)
+            if entry.result.type == "succeeded" and entry.custom_id in items
+        }
+
+BATCH_BACKENDS = {
+    "OPENAI": openai_batch_backend,
+    "ANTHROPIC": anthropic_batch_backend,
+}
+
+class batch_collector:
+    """
+    LLMの呼び出しを集めて、プロバイダのバッチAPI(OpenAI Batch / Anthropic Message Batches)でまとめて送ります。
+    最初の呼び出しから window 秒の間に届いた呼び出し(他の節や、同じプロセスで生成中の他の本の分)を1つのバッチにし、
+    完了までポーリングして、結果を呼び出しごとの Future に返します。
+    時間切れや、ほとんどが終わった後に残った呼び出し(straggler)はバッチを取り消し、同期呼び出しで補います。
+    バッチAPIのないプロバイダでは、全て同期呼び出しになります。
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, window: float = 2.0, max_requests: int = 1000, poll_interval: float = 30.0, timeout: float = 3600.0,
+                 straggler_ratio: float = 0.95, straggler_wait: float = 300.0, fallback_concurrency: int = 8,
+                 price_factor: float = 0.5):
+        self.window = window
+        self.max_requests = max(1, max_requests)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.straggler_ratio = straggler_ratio
+        self.straggler_wait = straggler_wait
+        self.fallback_concurrency = max(1, fallback_concurrency)
+        # バッチAPIの料金は同期呼び出しより安い (LLM_PRICES に掛ける係数)
+        self.price_factor = price_factor
+        self.stats = {"batches": 0, "batch_requests": 0, "batch_results": 0, "cancelled_batches": 0, "fallback_requests": 0}
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @classmethod
+    def shared(cls):
+        """プロセス内で共有するコレクターを返します。本をまたいで呼び出しをまとめるため、1つにします。"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(
+                    window=float(os.environ.get("LLM_BATCH_WINDOW", "2")),
+                    max_requests=int(os.environ.get("LLM_BATCH_MAX_REQUESTS", "1000")),
+                    poll_interval=float(os.environ.get("LLM_BATCH_POLL_INTERVAL", "30")),
+                    timeout=float(os.environ.get("LLM_BATCH_TIMEOUT", "3600")),
+                    straggler_ratio=float(os.environ.get("LLM_BATCH_STRAGGLER_RATIO", "0.95")),
+                    straggler_wait=float(os.environ.get("LLM_BATCH_STRAGGLER_WAIT", "300")),
+                    fallback_concurrency=int(os.environ.get("LLM_BATCH_FALLBACK_CONCURRENCY", "8")),
+                    price_factor=float(os.environ.get("LLM_BATCH_PRICE_FACTOR", "0.5")),
+                )
+            return cls._instance
+
+    def submit(self, llm, messages: list, response_format=None, kind: str = None, max_tokens: int = 8192, temperature: float = 0.3) -> Future:
+        """呼び出しを次のバッチに加え、応答(llms._call_api と同じもの)を返す Future を返します。"""
+        item = batch_request(llm, messages, response_format, kind, max_tokens, temperature)
+        with self._cond:
+            self._pending.append(item)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="llm-batch-collector", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return item.future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # 最初の呼び出しから window 秒待ち、同じ深さの他の節や他の本の呼び出しをまとめる
+                deadline = self._pending[0].submitted_at + self.window
+                while len(self._pending) < self.max_requests and deadline - time.monotonic() > 0:
+                    self._cond.wait(deadline - time.monotonic())
+                items = self._pending[:self.max_requests]
+                del self._pending[:self.max_requests]
+
+            groups = {}
+            for item in items:
+                key = item.llm.batch_key(item.model) if item.llm.supports_batch() else ("sync", id(item.llm))
+                groups.setdefault(key, []).append(item)
+            for group in groups.values():
+                threading.Thread(target=self._process, args=(group,), daemon=True).start()
+
+    def _process(self, items: list):
+        llm = items[0].llm
+        if llm.supports_batch():
+            for index, item in enumerate(items):
+                item.custom_id = f"req-{index + 1}"
+            try:
+                results = self._run_batch(BATCH_BACKENDS[llm.provider](llm.batch_client()), items)
+            except Exception as e:
+                logger.error(f"LLM batch failed, falling back to synchronous calls: {e}")
+                results = {}
+            now = time.monotonic()
+            for item in items:
+                if item.custom_id in results:
+                    completion = results[item.custom_id]
+                    item.llm._record_call(item.kind, item.model, completion, now - item.submitted_at, self.price_factor)
+                    item.future.set_result(completion)
+            with self._cond:
+                self.stats["batch_results"] += len(results)
+
+        stragglers = [item for item in items if not item.future.done()]
+        if not stragglers:
+            return
+        if llm.supports_batch():
+            logger.info(f"{len(stragglers)} of {len(items)} LLM requests fall back to synchronous calls")
+        with self._cond:
+            self.stats["fallback_requests"] += len(stragglers)
+        with ThreadPoolExecutor(max_workers=min(self.fallback_concurrency, len(stragglers))) as executor:
+            for item in stragglers:
+                executor.submit(self._call_sync, item)
+
+    def _call_sync(self, item: batch_request):
+        try:
+            item.future.set_result(item.llm._call_api(item.messages, item.response_format, item.max_tokens, item.temperature, kind=item.kind))
+        except Exception as e:
+            item.future.set_exception(e)
+
+    def _run_batch(self, backend, items: list) -> dict:
+        """バッチを送信して終了まで待ち、{custom_id: 応答} を返します。"""
+        batch_id = backend.submit(items)
+        with self._cond:
+            self.stats["batches"] += 1
+            self.stats["batch_requests"] += len(items)
+        logger.info(f"LLM batch {batch_id} submitted with {len(items)} requests")
+        started = time.monotonic()
+        straggling_since = None
+        while True:
+            time.sleep(self.poll_interval)
+            ended, finished, total = backend.status(batch_id)
+            if ended:
+                break
+            now = time.monotonic()
+            if total and finished / total >= self.straggler_ratio:
+                straggling_since = straggling_since or now
+            timed_out = now - started >= self.timeout
+            if timed_out or (straggling_since is not None and now - straggling_since >= self.straggler_wait):
+                logger.info(
+                    f"LLM batch {batch_id} cancelled "
+                    + ("after timeout" if timed_out else f"with {total - finished} stragglers")
+                    + f" ({finished}/{total} done)"
+                )
+                backend.cancel(batch_id)
+                with self._cond:
+                    self.stats["cancelled_batches"] += 1
+                # 取り消しが終わるのを待ってから、処理済みの分の結果を受け取る
+                while not backend.status(batch_id)[0]:
+                    time.sleep(self.poll_interval)
+                break
+        logger.info(f"LLM batch {batch_id} ended in {time.monotonic() - started:.1f}s")
+        return backend.results(batch_id, {item.custom_id: item for item in items})
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return dict(self.stats, pending=len(self._pending))
@@ -0,0 +1,182 @@
+import os
+import time
+import logging
+import threading
+from os.path import join, dirname
+from dotenv import load_dotenv
+try:
+    from .tracing import span
+    from .endpoint_balancer import balanced_endpoint, endpoint_balancer
+except ImportError:
+    from tracing import span
+    from endpoint_balancer import balanced_endpoint, endpoint_balancer
+
+logger = logging.getLogger(__name__)
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+# サーキットブレーカーの状態
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+def parse_endpoints(value: str, default_url: str = None, default_key: str = None, default_capacity: int = 8) -> list:
+    """
+    <PROVIDER>_ENDPOINTS の値を解析します。
+    カンマ区切りの各項目は url;key=...;weight=...;capacity=... の形式で、
+    url を空または default にするとプロバイダの既定のURLを、key を省略するとプロバイダのAPIキーを使います。
+    """
+    endpoints = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        url, *options = [part.strip() for part in item.split(";")]
+        settings = dict(option.split("=", 1) for option in options if "=" in option)
+        endpoints.append({
+            "url": default_url if url in ("", "default") else url,
+            "api_key": settings.get("key", default_key),
+            "weight": float(settings.get("weight", 1)),
+            "max_concurrency": int(settings.get("capacity", default_capacity)),
+        })
+    return endpoints
+
+class llm_endpoint(balanced_endpoint):
+    def __init__(self, name: str, client, weight: float = 1.0, max_concurrency: int = 8):
+        super().__init__(name, max_concurrency)
+        self.client = client
+        self.weight = max(float(weight), 0.01)
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.ejections = 0
+
+    def available(self, now: float) -> bool:
+        if not super().available(now):
+            return False
+        if self.state == OPEN:
+            # クールダウンが明けたら、1件だけ試しに流す (half-open)
+            return now >= self.open_until
+        if self.state == HALF_OPEN:
+            return self.outstanding == 0
+        return True
+
+    def load(self) -> float:
+        # 重みが大きいエンドポイントほど多くのリクエストを受け持つ
+        return (self.outstanding + 1) / self.weight
+
+    def retry_at(self) -> float:
+        return self.open_until if self.state == OPEN else 0.0
+
+class llm_router(endpoint_balancer):
+    """
+    同じプロバイダの複数のエンドポイント(OllamaのサーバーやAPIキー)へ、LLMの呼び出しを振り分けるルーター。
+    重み付きで未完了リクエスト数が最も少ない正常なエンドポイントを選び、エンドポイントごとの同時実行数の上限を守ります。
+    連続して失敗したエンドポイントはサーキットブレーカーで一定時間外し、別のエンドポイントで再試行します。
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, endpoints: list, failure_threshold: int = 3, cooldown: float = 30.0):
+        if not endpoints:
+            raise ValueError("LLM endpoint is not set")
+        super().__init__(endpoints)
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+
+    @classmethod
+    def shared(cls, key: str, build):
+        """
+        プロセス内で共有するルーターを返します。本ごとにルーターを作ると同時実行数の上限や
+        サーキットブレーカーの状態が本ごとに分かれるため、同じ設定のルーターは1つにします。
+        """
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = build()
+            return cls._shared[key]
+
+    @classmethod
+    def from_settings(cls, settings: list, make_client):
+        """parse_endpoints の結果と、(url, api_key) からクライアントを作る関数でルーターを作ります。"""
+        endpoints = []
+        for i, setting in enumerate(settings):
+            # APIキーはログや統計に出さないよう、URLと番号で名前を付ける
+            name = f"{setting['url'] or 'default'}#{i + 1}"
+            endpoints.append(llm_endpoint(
+                name,
+                make_client(setting["api_key"], setting["url"]),
+                setting["weight"],
+                setting["max_concurrency"],
+            ))
+        return cls(
+            endpoints,
+            failure_threshold=int(os.environ.get("LLM_CIRCUIT_FAILURES", "3")),
+            cooldown=float(os.environ.get("LLM_CIRCUIT_COOLDOWN", "30")),
+        )
+
+    def _rank(self, endpoint: llm_endpoint):
+        # クールダウンが明けたエンドポイントも負荷で選び、試しの1件で復帰を確かめる
+        # 同じ負荷なら、これまでのリクエスト数(重み付き)が少ない方へ回す
+        return (endpoint.load(), endpoint.total_requests / endpoint.weight)
+
+    def _on_acquire(self, endpoint: llm_endpoint):
+        if endpoint.state == OPEN:
+            endpoint.state = HALF_OPEN
+
+    def _on_release(self, endpoint: llm_endpoint, ok: bool):
+        if ok:
+            endpoint.state = CLOSED
+        elif endpoint.state == HALF_OPEN or endpoint.failures >= self.failure_threshold:
+            if endpoint.state != OPEN:
+                endpoint.ejections += 1
+                logger.error(f"LLM endpoint {endpoint.name} ejected for {self.cooldown}s after {endpoint.failures} failures")
+            endpoint.state = OPEN
+            endpoint.open_until = time.monotonic() + self.cooldown
+
+    def call(self, fn):
+        """
+        fn(client) を選んだエンドポイントで実行します。例外または None は失敗とみなし、
+        まだ試していないエンドポイントで再試行します。全て失敗した場合は None を返します。
+        """
+        attempts = 0
+
+        def attempt(endpoint: llm_endpoint, last: bool):
+            nonlocal attempts
+            attempts += 1
+            result = None
+            try:
+                with span("llm_endpoint", endpoint=endpoint.name, attempt=attempts):
+                    result = fn(endpoint.client)
+            except Exception as e:
+                logger.error(f"LLM endpoint {endpoint.name} request failed: {e}")
+            if result is None and not last:
+                logger.error(f"LLM endpoint {endpoint.name} failed, failing over")
+            return result is not None, result
+
+        ok, result = self._failover(attempt)
+        return result if ok else None
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.client.close()
+
+    def stats(self) -> list:
+        """エンドポイントごとの状態と利用率(稼働時間×同時実行数に対する処理時間の割合)を返します。"""
+        with self._cond:
+            uptime = max(time.monotonic() - self.started_at, 1e-9)
+            return [
+                {
+                    "endpoint": e.name,
+                    "state": e.state,
+                    "weight": e.weight,
+                    "outstanding": e.outstanding,
+                    "max_concurrency": e.max_concurrency,
+                    "requests": e.total_requests,
+                    "errors": e.total_errors,
+                    "ejections": e.ejections,
+                    "busy_seconds": round(e.busy_seconds, 3),
+                    "utilization": round(e.busy_seconds / (uptime * e.max_concurrency), 3),
+                }
+                for e in self.endpoints
+            ]
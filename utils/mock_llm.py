@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from pydantic import BaseModel
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+# 合成する本文に使う文 (LaTeXの特殊文字を含めない)
+FILLER_SENTENCES = [
+    "この節では基本的な考え方を順を追って説明します。",
+    "具体的な例を使って手順を確認していきます。",
+    "ここで扱う内容は後の章の前提となります。",
+    "重要な用語は最初に定義してから使います。",
+    "実際の作業では小さく試して結果を確かめることが大切です。",
+    "よくある誤りとその避け方についても触れます。",
+]
+
+def cassette_key(messages: list, response_format=None, model: str = None, temperature: float = None) -> str:
+    """
+    リクエストの内容(メッセージ・応答形式・モデル・temperature)からカセットのキーを作ります。
+    モデルや temperature を変えた呼び出しに、別の設定で記録した応答を返さないようにするためです。
+    """
+    if isinstance(response_format, type):
+        response_format = response_format.__name__
+    canonical = {
+        "messages": [{"role": m.get("role"), "content": m.get("content")} for m in messages],
+        "response_format": response_format or "",
+        "model": model or "",
+        "temperature": None if temperature is None else float(temperature),
+    }
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+class llm_cassette:
+    """
+    LLMの応答を記録したJSONLファイル。1行が1回の呼び出しで、キー・応答本文・所要時間を持ちます。
+    同じキーが複数回記録されている場合は、呼び出された順に使い回します。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self._cursor = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="UTF-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault(entry["key"], []).append(entry)
+
+    def get(self, key: str):
+        with self._lock:
+            entries = self.entries.get(key)
+            if not entries:
+                return None
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            return entries[index % len(entries)]
+
+    def record(self, key: str, messages: list, response_format, content: str, latency: float,
+               model: str = None, temperature: float = None):
+        entry = {
+            "key": key,
+            "model": model or "",
+            "temperature": temperature,
+            "response_format": response_format.__name__ if isinstance(response_format, type) else (response_format or ""),
+            "prompt": messages[-1].get("content", "")[:200] if messages else "",
+            "content": content,
+            "latency": round(latency, 3),
+        }
+        with self._lock:
+            self.entries.setdefault(key, []).append(entry)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a", encoding="UTF-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+class mock_llm:
+    """
+    PROVIDER=MOCK で使う、外部サービスに接続しないLLM。
+    カセットに記録があればその応答を返し、なければ応答形式(Pydanticモデル)に沿った応答を合成します。
+    乱数はリクエストのキーから決めるため、同じ入力には毎回同じ応答を返します。
+    """
+
+    def __init__(self, cassette: llm_cassette = None):
+        self.cassette = cassette
+        self.on_miss = os.environ.get("MOCK_ON_MISS", "synthetic")
+        self.seed = os.environ.get("MOCK_SEED", "0")
+        # 所要時間 = (基本 + 出力トークンあたり × トークン数) × 対数正規分布の揺らぎ
+        self.latency_ms = float(os.environ.get("MOCK_LATENCY_MS", "0"))
+        self.latency_per_token_ms = float(os.environ.get("MOCK_LATENCY_PER_TOKEN_MS", "0"))
+        self.latency_jitter = float(os.environ.get("MOCK_LATENCY_JITTER", "0"))
+        # 記録した応答の所要時間を再現する倍率 (0で待たない)
+        self.replay_latency_scale = float(os.environ.get("MOCK_REPLAY_LATENCY_SCALE", "0"))
+        # 合成する本文の長さ(トークン数)の中央値と揺らぎ
+        self.output_tokens = int(os.environ.get("MOCK_OUTPUT_TOKENS", "400"))
+        self.output_tokens_jitter = float(os.environ.get("MOCK_OUTPUT_TOKENS_JITTER", "0.3"))
+        self.subdivide_probability = float(os.environ.get("MOCK_SUBDIVIDE_PROBABILITY", "0.3"))
+        self.calls = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        path = os.environ.get("LLM_CASSETTE")
+        return cls(llm_cassette(path) if path else None)
+
+    def complete(self, messages: list, response_format=None, max_tokens: int = None, temperature: float = None,
+                 model: str = None) -> dict:
+        """
+        OpenAIのレスポンスの代わりに {"content", "model", "cassette", "usage"} を返します。
+        記録した応答を再生する場合は、記録したときと同じモデル(MODEL・MODEL_<KIND>)を指定してください。
+        """
+        key = cassette_key(messages, response_format, model, temperature)
+        self.calls += 1
+        # 日本語はおおよそ2文字1トークンとしてトークン数を見積もる
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages) // 2
+        entry = self.cassette.get(key) if self.cassette else None
+        if entry is not None:
+            if self.replay_latency_scale > 0:
+                time.sleep(entry.get("latency", 0) * self.replay_latency_scale)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(entry["content"]) // 2}
+            return {"content": entry["content"], "model": "mock", "cassette": True, "usage": usage}
+
+        self.misses += 1
+        if self.on_miss == "error":
+            raise KeyError(f"LLM cassette has no response for request {key[:12]}")
+        rng = random.Random(f"{self.seed}:{key}")
+        if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+            content = json.dumps(self.synthesize_model(response_format, rng), ensure_ascii=False)
+            tokens = len(content) // 2
+        else:
+            tokens = self.sample_tokens(rng)
+            text = self.synthesize_text(tokens, rng)
+            prompt = messages[-1].get("content", "") if messages else ""
+            # 本文生成のプロンプトは ```tex で括った応答を求める
+            content = f"```tex\n{text}\n```" if "```tex" in prompt else text
+        self.sleep(tokens, rng)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens}
+        return {"content": content, "model": "mock", "cassette": False, "usage": usage}
+
+    def sample_tokens(self, rng: random.Random) -> int:
+        if self.output_tokens_jitter <= 0:
+            return self.output_tokens
+        return max(1, int(self.output_tokens * rng.lognormvariate(0, self.output_tokens_jitter)))
+
+    def sleep(self, tokens: int, rng: random.Random):
+        latency = (self.latency_ms + self.latency_per_token_ms * tokens) / 1000
+        if latency <= 0:
+            return
+        if self.latency_jitter > 0:
+            latency *= rng.lognormvariate(0, self.latency_jitter)
+        time.sleep(latency)
+
+    def synthesize_text(self, tokens: int, rng: random.Random) -> str:
+        # 日本語はおおよそ1文字1トークンとして、指定の長さまで文を並べる
+        sentences = []
+        length = 0
+        while length < tokens:
+            sentence = rng.choice(FILLER_SENTENCES)
+            sentences.append(sentence)
+            length += len(sentence)
+        paragraphs = [" ".join(sentences[i:i + 4]) for i in range(0, len(sentences), 4)]
+        return "\n\n".join(paragraphs)
+
+    def synthesize_model(self, model: type, rng: random.Random) -> dict:
+        """Pydanticモデルのフィールドの型に沿って値を作ります。"""
+        return self.synthesize_schema(model.model_json_schema(), rng)
+
+    def synthesize_schema(self, schema: dict, rng: random.Random, name: str = "", defs: dict = None):
+        """JSONスキーマ(Pydanticが出力する形式)に沿って値を作ります。"""
+        defs = schema.get("$defs", defs or {})
+        if "$ref" in schema:
+            return self.synthesize_schema(defs[schema["$ref"].split("/")[-1]], rng, name, defs)
+        kind = schema.get("type")
+        if kind == "object" or "properties" in schema:
+            return {key: self.synthesize_schema(value, rng, key, defs) for key, value in schema.get("properties", {}).items()}
+        if kind == "array":
+            return [self.synthesize_schema(schema.get("items", {}), rng, name, defs) for _ in range(rng.randint(2, 4))]
+        if kind == "boolean":
+            # 節を細分化するかどうか。確率を下げるほど構成が浅くなる
+            return rng.random() < self.subdivide_probability
+        if kind == "number":
+            # ページ数。1.5ページ未満の節はそれ以上分割されない
+            return round(rng.uniform(0.3, 1.4), 1)
+        if kind == "integer":
+            return rng.randint(1, 10)
+        if name == "dirname":
+            return f"mock{rng.getrandbits(32):08x}"
+        return f"Mock {name.capitalize()} {rng.randint(1, 999)}"
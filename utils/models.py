@@ -1,6 +1,7 @@
 import os
 import re
 import json
+import httpx
 import openai
 import anthropic
 from pydantic import BaseModel
@@ -8,51 +9,161 @@ import logging
 from dotenv import load_dotenv
 from os.path import join, dirname
 import time
+import copy
+import threading
+from openai.lib._parsing._completions import type_to_response_format_param, parse_chat_completion
+try:
+    from .mock_llm import mock_llm, llm_cassette, cassette_key
+    from .llm_router import llm_router, parse_endpoints
+    from .resource_slots import resource_slots
+except ImportError:
+    from mock_llm import mock_llm, llm_cassette, cassette_key
+    from llm_router import llm_router, parse_endpoints
+    from resource_slots import resource_slots
 
 logger = logging.getLogger(__name__)
 load_dotenv(verbose=True)
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
+# 利用できるプロバイダ
+PROVIDERS = ("OPENAI", "ANTHROPIC", "OLLAMA", "GEMINI", "MOCK")
+
+# プロンプトの種類。種類ごとに使うモデルを変えられる
+PROMPT_KINDS = ("dirname", "outline", "content", "cover", "kana")
+# 構造や書式だけの小さな処理。MODEL_SMALL を設定するとこれらは既定でそのモデルを使う
+SMALL_PROMPT_KINDS = ("dirname", "cover", "kana")
+
+def parse_prices(value: str) -> dict:
+    """LLM_PRICES (model=入力/出力 のカンマ区切り、100万トークンあたりのUSD) を解析します。"""
+    prices = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        model, price = item.strip().rsplit("=", 1)
+        input_price, _, output_price = price.partition("/")
+        prices[model.strip()] = (float(input_price), float(output_price or input_price))
+    return prices
+
 class llms:
-    def __init__(self):
+    def __init__(self, provider: str = None, model: str = None, models: dict = None):
+        """
+        provider・model を省略した場合は環境変数 PROVIDER・MODEL を使います。
+        環境変数と異なるプロバイダを指定してモデルを省略した場合は、<PROVIDER>_MODEL (例: OPENAI_MODEL) を使います。
+        models はプロンプトの種類ごとのモデル ({"content": "gpt-4o", ...}) で、環境変数 MODEL_<KIND> より優先します。
+        """
         # Determine which provider to use based on environment variables
-        self.provider = os.environ.get("PROVIDER")
-        self.model = os.environ.get("MODEL")
+        self.provider = (provider or os.environ.get("PROVIDER") or "").upper() or None
+        # 環境変数と異なるプロバイダのモデルは <PROVIDER>_ を付けた環境変数から読む
+        env_prefix = f"{self.provider}_" if provider and self.provider != os.environ.get("PROVIDER") else ""
+        if model is None and env_prefix:
+            model = os.environ.get(f"{env_prefix}MODEL")
+        self.model = model or os.environ.get("MODEL")
+        small_model = os.environ.get(f"{env_prefix}MODEL_SMALL")
+        self.models = {
+            kind: (models or {}).get(kind)
+            or os.environ.get(f"{env_prefix}MODEL_{kind.upper()}")
+            or (small_model if kind in SMALL_PROMPT_KINDS else None)
+            for kind in PROMPT_KINDS
+        }
+        self.prices = parse_prices(os.environ.get("LLM_PRICES"))
+        self.tier_stats = {}
+        self._stats_lock = threading.Lock()
+        # プロセス内の全ての本で共有する同時呼び出し数の上限 (LLM_GLOBAL_CONCURRENCY、0は無制限)
+        self.slots = resource_slots.shared("llm", "LLM_GLOBAL_CONCURRENCY")
         self.openai_api_key = os.environ.get("OPENAI_API_KEY")
+        self.openai_base_url = os.environ.get("OPENAI_BASE_URL")
         self.anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
+        self.anthropic_base_url = os.environ.get("ANTHROPIC_BASE_URL")
         self.ollama_base_url=os.environ.get("OLLAMA_BASE_URL")
         self.ollama_max_tokens=os.environ.get("OLLAMA_MAX_TOKNES")
         self.gemini_api_key = os.environ.get("GEMINI_API_KEY")
         self.gemini_base_url=os.environ.get("GEMINI_BASE_URL")
+        # 接続の設定。クライアントと接続プールはインスタンスごとに持ち、プロセス全体の設定(openai.api_keyなど)は変更しない
+        self.timeout = float(os.environ.get("LLM_TIMEOUT", "600"))
+        self.max_retries = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+        self.max_connections = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+        self.max_keepalive_connections = int(os.environ.get("LLM_MAX_KEEPALIVE", "20"))
 
-        if self.provider == "OPENAI":
-            openai.api_key = self.openai_api_key
-        elif self.provider == "ANTHROPIC":
-            self.client = anthropic.Anthropic(api_key=self.anthropic_api_key)
-        elif self.provider =="OLLAMA":
-            openai.base_url=self.ollama_base_url
-            openai.api_key = "EMPTY"
-        elif self.provider == "GEMINI":
-            openai.api_key = self.gemini_api_key
-            openai.base_url=self.gemini_base_url
+        self.client = None
+        self.router = None
+        # プロバイダごとの既定の(URL, APIキー)
+        defaults = {
+            "OPENAI": (self.openai_base_url, self.openai_api_key),
+            "ANTHROPIC": (self.anthropic_base_url, self.anthropic_api_key),
+            "OLLAMA": (self.ollama_base_url, "EMPTY"),
+            "GEMINI": (self.gemini_base_url, self.gemini_api_key),
+        }
+        if self.provider in defaults:
+            base_url, api_key = defaults[self.provider]
+            endpoints = os.environ.get(f"{self.provider}_ENDPOINTS")
+            if endpoints:
+                # 複数のエンドポイントに振り分ける。ルーターはプロセス内の本で共有する
+                self.router = llm_router.shared(f"{self.provider}|{endpoints}", lambda: llm_router.from_settings(
+                    parse_endpoints(endpoints, base_url, api_key, int(os.environ.get("LLM_ENDPOINT_MAX_CONCURRENCY", "8"))),
+                    self._make_client,
+                ))
+            else:
+                self.client = self._make_client(api_key, base_url)
+        elif self.provider == "MOCK":
+            # カセットの応答を再生し、記録がなければ合成する (外部サービスに接続しない)
+            self.mock = mock_llm.from_env()
+            self.model = self.model or "mock"
         else:
             logger.error("Unknown PROVIDER specified in the environment variables.")
 
-    def _call_openai_api(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3,max_tokens: int = 1000):
+        # LLM_CASSETTE_MODE=record の場合は、実際の応答をカセットに記録する
+        self.recorder = None
+        if self.provider != "MOCK" and os.environ.get("LLM_CASSETTE_MODE") == "record" and os.environ.get("LLM_CASSETTE"):
+            self.recorder = llm_cassette(os.environ["LLM_CASSETTE"])
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive_connections)
+
+    def _make_client(self, api_key: str, base_url: str = None):
+        if self.provider == "ANTHROPIC":
+            return anthropic.Anthropic(
+                api_key=api_key,
+                base_url=base_url or None,
+                timeout=self.timeout,
+                max_retries=self.max_retries,
+                http_client=anthropic.DefaultHttpxClient(limits=self._limits()),
+            )
+        return self._openai_client(api_key, base_url)
+
+    def _openai_client(self, api_key: str, base_url: str = None) -> openai.OpenAI:
+        """OpenAI互換のAPI(OpenAI・Ollama・Gemini)のクライアントを作ります。"""
+        return openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url or None,
+            timeout=self.timeout,
+            max_retries=self.max_retries,
+            http_client=openai.DefaultHttpxClient(limits=self._limits()),
+        )
+
+    def close(self):
+        """接続プールを閉じます。共有のルーターは他の本も使うため閉じません。"""
+        if self.client is not None:
+            self.client.close()
+
+    def endpoint_stats(self) -> list:
+        """複数のエンドポイントに振り分けている場合、エンドポイントごとの状態と利用率を返します。"""
+        return self.router.stats() if self.router else None
+
+    def _call_openai_api(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3,max_tokens: int = 1000, client=None):
         """
         Helper method to call the OpenAI API.
         """
         try:
             if response_format:
-                return openai.beta.chat.completions.parse(
+                return (client or self.client).beta.chat.completions.parse(
                     model=model,
                     messages=messages,
                     response_format=response_format,
                     temperature=temperature,
                     max_tokens=max_tokens
                 )
-            return openai.chat.completions.create(
+            return (client or self.client).chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=temperature
@@ -61,28 +172,13 @@ class llms:
             logger.error(f"Error calling OpenAI API: {e}")
             return None
 
-    def _call_claude_api(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3,max_tokens: int = 1000 ) -> dict:
+    def _call_claude_api(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3,max_tokens: int = 1000, client=None) -> dict:
         """
         ClaudeのAPIを呼び出すヘルパーメソッド。指定されたPydanticモデルでのレスポンス形式をsystemメッセージに組み込みます。
         """
         try:
-            # response_modelを用いたsystemメッセージの置換
-            if response_format:
-                schema = response_format.model_json_schema()
-                model_example = json.dumps(schema, indent=2)
-                existing_content = messages[0].get("content", "")
-                systems= f"{existing_content}\nレスポンスは以下の形式に従ってください:\n{model_example}"
-            else:
-                systems = messages[0].get("content", "")
-            if messages:
-                del messages[0]
-
-            response = self.client.messages.create(
-                model=model,
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                system=systems
+            response = (client or self.client).messages.create(
+                **self._claude_params(model, messages, response_format, temperature, max_tokens)
             )
 
             return response
@@ -90,7 +186,48 @@ class llms:
             logger.error(f"Error calling Claude API: {e}")
             return None
 
-    def _call_ollama_api(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3,max_tokens=256):
+    def _claude_params(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3, max_tokens: int = 1000) -> dict:
+        """Messages APIのパラメータを作ります (バッチでも同じものを使う)。messagesの先頭(system)は取り除きます。"""
+        # response_modelを用いたsystemメッセージの置換
+        if response_format:
+            schema = response_format.model_json_schema()
+            model_example = json.dumps(schema, indent=2)
+            existing_content = messages[0].get("content", "")
+            systems= f"{existing_content}\nレスポンスは以下の形式に従ってください:\n{model_example}"
+        else:
+            systems = messages[0].get("content", "")
+        if messages:
+            del messages[0]
+        return {"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": temperature, "system": systems}
+
+    def _openai_body(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3, max_tokens: int = 1000) -> dict:
+        """バッチの1行に入れる /v1/chat/completions の本文を、_call_openai_api と同じ内容で作ります。"""
+        body = {"model": model, "messages": messages, "temperature": temperature}
+        if response_format:
+            body["response_format"] = type_to_response_format_param(response_format)
+            body["max_tokens"] = max_tokens
+        return body
+
+    def _openai_completion(self, body: dict, response_format: BaseModel = None):
+        """バッチの結果の本文を、同期呼び出しと同じ応答のオブジェクト(構造化出力ならparsed付き)にします。"""
+        completion = openai.types.chat.ChatCompletion.model_validate(body)
+        if response_format:
+            return parse_chat_completion(response_format=response_format, input_tools=openai.NOT_GIVEN, chat_completion=completion)
+        return completion
+
+    def supports_batch(self) -> bool:
+        return self.provider in ("OPENAI", "ANTHROPIC")
+
+    def batch_client(self):
+        """バッチの送信に使うクライアント。複数のエンドポイントがある場合は先頭を使います。"""
+        return self.client or self.router.endpoints[0].client
+
+    def batch_key(self, model: str) -> tuple:
+        """同じバッチにまとめられるリクエストのキー。OpenAIのバッチは1つのモデルに限られます。"""
+        client = self.batch_client()
+        return (self.provider, str(client.base_url), client.api_key, model if self.provider == "OPENAI" else None)
+
+    def _call_ollama_api(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3,max_tokens=256, client=None):
         """
         Helper method to call the Ollama API.
         """
@@ -100,7 +237,7 @@ class llms:
                 model_example = json.dumps(schema, indent=2)
                 existing_content = messages[0].get("content", "")                
                 messages[0]["content"] = f"{existing_content}\nレスポンスは以下の形式に従ってください。:\n{model_example}"
-            return openai.chat.completions.create(
+            return (client or self.client).chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=temperature,
@@ -110,7 +247,7 @@ class llms:
             logger.error(f"Error calling Ollama API: {e}")
             return None
         
-    def _call_gemini_api(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3):
+    def _call_gemini_api(self, model: str, messages: list, response_format: BaseModel = None, temperature: float = 0.3, client=None):
         """
         Helper method to call the Gemini API.
         """
@@ -122,7 +259,7 @@ class llms:
                 model_example = self.generate_json_example(response_format)
                 existing_content = messages[0].get("content", "")
                 messages[0]["content"] = f"{existing_content}\nレスポンスは以下の形式に従ってください。```jsonと```で括って下さい。:\n{model_example}。返信時にJSONフォーマット定義を先頭に入れる必要はありません。"
-            return openai.chat.completions.create(
+            return (client or self.client).chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=temperature
@@ -131,18 +268,125 @@ class llms:
             logger.error(f"Error calling Gemini API: {e}")
             return None
             
-    def _call_api(self, messages: list, response_format: type = None, max_tokens: int = 8192, temperature: float = 0.3):
+    def model_for(self, kind: str = None) -> str:
+        """プロンプトの種類に使うモデルを返します。"""
+        return self.models.get(kind) or self.model
+
+    def _call_api(self, messages: list, response_format: type = None, max_tokens: int = 8192, temperature: float = 0.3, kind: str = None):
         """
         Call the appropriate API based on the provider.
+        kind はプロンプトの種類 (PROMPT_KINDS) で、使うモデルの選択と種類ごとの計測に使います。
         """
+        model = self.model_for(kind)
+        # 上限の空き待ちはレイテンシに含めない
+        with self.slots.hold():
+            start = time.monotonic()
+            completion = None
+            try:
+                completion = self._call_model(model, messages, response_format, max_tokens, temperature)
+                return completion
+            finally:
+                self._record_call(kind, model, completion, time.monotonic() - start)
+
+    def _call_model(self, model: str, messages: list, response_format: type, max_tokens: int, temperature: float):
+        if self.provider == "MOCK":
+            return self.mock.complete(messages, response_format, max_tokens, temperature, model)
+
+        # 各プロバイダの呼び出しはmessagesを書き換えるため、記録用のキーは先に作る
+        if self.recorder:
+            recorded_messages = copy.deepcopy(messages)
+            start = time.monotonic()
+
+        if self.router:
+            # 失敗時は別のエンドポイントで再試行するため、書き換えられないよう試行ごとに複製する
+            completion = self.router.call(
+                lambda client: self._call_provider(model, copy.deepcopy(messages), response_format, max_tokens, temperature, client)
+            )
+        else:
+            completion = self._call_provider(model, messages, response_format, max_tokens, temperature)
+
+        if self.recorder and completion is not None:
+            self.recorder.record(
+                cassette_key(recorded_messages, response_format, model, temperature),
+                recorded_messages,
+                response_format,
+                self._raw_content(completion),
+                time.monotonic() - start,
+                model,
+                temperature,
+            )
+        return completion
+
+    def _usage(self, completion) -> tuple:
+        """応答の (入力トークン数, 出力トークン数) を返します。取得できない場合は (0, 0) です。"""
+        if completion is None:
+            return 0, 0
+        if self.provider == "MOCK":
+            usage = completion.get("usage") or {}
+            return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        usage = getattr(completion, "usage", None)
+        if usage is None:
+            return 0, 0
+        if self.provider == "ANTHROPIC":
+            return usage.input_tokens or 0, usage.output_tokens or 0
+        return usage.prompt_tokens or 0, usage.completion_tokens or 0
+
+    def _record_call(self, kind: str, model: str, completion, seconds: float, price_factor: float = 1.0):
+        """呼び出し1回を計測に加えます。バッチAPIの結果は price_factor (割引) を掛けて費用を計算します。"""
+        input_tokens, output_tokens = self._usage(completion)
+        price = self.prices.get(model)
+        if price:
+            price = (price[0] * price_factor, price[1] * price_factor)
+        with self._stats_lock:
+            stats = self.tier_stats.setdefault((kind or "other", model), {
+                "calls": 0, "failures": 0, "seconds": 0.0, "max_seconds": 0.0,
+                "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0 if price else None,
+            })
+            stats["calls"] += 1
+            stats["failures"] += completion is None
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["input_tokens"] += input_tokens
+            stats["output_tokens"] += output_tokens
+            if price:
+                stats["cost_usd"] += (input_tokens * price[0] + output_tokens * price[1]) / 1e6
+
+    def tier_metrics(self) -> list:
+        """プロンプトの種類・モデルごとの呼び出し回数、レイテンシ、トークン数、費用(LLM_PRICES)を返します。"""
+        with self._stats_lock:
+            return [
+                {
+                    "kind": kind,
+                    "model": model,
+                    "calls": stats["calls"],
+                    "failures": stats["failures"],
+                    "seconds": round(stats["seconds"], 3),
+                    "mean_seconds": round(stats["seconds"] / stats["calls"], 3),
+                    "max_seconds": round(stats["max_seconds"], 3),
+                    "input_tokens": stats["input_tokens"],
+                    "output_tokens": stats["output_tokens"],
+                    "cost_usd": round(stats["cost_usd"], 6) if stats["cost_usd"] is not None else None,
+                }
+                for (kind, model), stats in self.tier_stats.items()
+            ]
+
+    def _call_provider(self, model: str, messages: list, response_format: type, max_tokens: int, temperature: float, client=None):
+        completion = None
         if self.provider == "OPENAI":
-            return self._call_openai_api(self.model, messages, response_format, temperature,max_tokens)
+            completion = self._call_openai_api(model, messages, response_format, temperature,max_tokens, client=client)
         elif self.provider == "ANTHROPIC":
-            return self._call_claude_api(self.model, messages, response_format,temperature,max_tokens )
+            completion = self._call_claude_api(model, messages, response_format,temperature,max_tokens, client=client)
         elif self.provider == "OLLAMA":
-            return self._call_ollama_api(self.model, messages, response_format,temperature,max_tokens=self.ollama_max_tokens )
+            completion = self._call_ollama_api(model, messages, response_format,temperature,max_tokens=self.ollama_max_tokens, client=client)
         elif self.provider == "GEMINI":
-            return self._call_gemini_api(self.model, messages, response_format,temperature)
+            completion = self._call_gemini_api(model, messages, response_format,temperature, client=client)
+        return completion
+
+    def _raw_content(self, completion) -> str:
+        """応答の本文を、応答形式によらずそのままの文字列で返します。"""
+        if self.provider == "ANTHROPIC":
+            return completion.content[0].text
+        return completion.choices[0].message.content
         
     def _reponse_api(self,completion: dict,response_format: str):
         result=""
@@ -157,8 +401,8 @@ class llms:
             result = completion.content[0].text
             if response_format=="parsed":
                 result = json.loads(result)
-        elif self.provider=="OLLAMA" or self.provider == "GEMINI":
-            result = completion.choices[0].message.content
+        elif self.provider=="OLLAMA" or self.provider == "GEMINI" or self.provider == "MOCK":
+            result = completion["content"] if self.provider == "MOCK" else completion.choices[0].message.content
             if response_format=="parsed":
                 result = json.loads(result)
             elif response_format=="json":
@@ -0,0 +1,178 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+from collections import Counter
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+# 本のディレクトリに置くファイル名
+PROFILE_FILES = {
+    "profile_wall": "profile.wall.collapsed",
+    "profile_cpu": "profile.cpu.collapsed",
+    "profile_summary": "profile_summary.json",
+}
+
+MAX_DEPTH = 128
+
+def _thread_cpu_time(ident: int):
+    """スレッドのCPU時間(秒)。取得できない環境や終了したスレッドでは None を返します。"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+def _frame_name(code) -> str:
+    # 折りたたみ形式では ; が区切り文字になるため、名前に含めない
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+class sampling_profiler:
+    """
+    start() を呼んだスレッドと、その後に起動されたスレッド(LLM呼び出しや音声合成のプールなど)のスタックを
+    一定間隔で記録する、サンプリング方式のプロファイラ。
+    start() の時点で既にあったスレッド(Webサーバーやハートビート、他のリクエストの処理中のスレッド)は記録しません。
+    Pythonはスレッドの起動元を記録しないため、同じプロセスで複数の本を並列に生成している場合(AutoGenBatch)は、
+    計測中に他の本が起動したスレッドも含まれます。
+    各サンプルはスレッドのCPU時間が進んでいれば「CPU」、進んでいなければ「待ち」(I/O・ロック・GIL待ち)に分類し、
+    経過時間(wall)とCPUのそれぞれについて、flamegraph.pl や speedscope で読める折りたたみ形式で書き出します。
+    """
+
+    def __init__(self, interval: float = None):
+        self.interval = interval or float(os.environ.get("PROFILE_INTERVAL_MS", "10")) / 1000
+        self.wall = Counter()
+        self.cpu = Counter()
+        self.threads = {}
+        self.ticks = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._cpu_times = {}
+        self._excluded = set()
+
+    def start(self):
+        self.started_at = time.monotonic()
+        # 呼び出し元のスレッド以外で、開始前から動いているスレッドは対象外にする
+        # (終了したスレッドの識別子は再利用されるため、識別子ではなくThreadオブジェクトで比べる)
+        self._excluded = set(threading.enumerate()) - {threading.current_thread()}
+        self._times = os.times()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.duration = time.monotonic() - self.started_at
+        times = os.times()
+        self.process_cpu_seconds = (times.user + times.system) - (self._times.user + self._times.system)
+        # LaTeXやffmpegなどの子プロセスのCPU時間 (終了済みのもの)
+        self.children_cpu_seconds = (times.children_user + times.children_system) - (self._times.children_user + self._times.children_system)
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        own = threading.get_ident()
+        last = time.monotonic()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            elapsed = now - last
+            last = now
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            self.ticks += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own or threads.get(ident) in self._excluded:
+                    continue
+                # プールのスレッド名の連番を除き、同じプールのスレッドをまとめる
+                thread = re.sub(r"_\d+$", "", threads[ident].name if ident in threads else f"thread-{ident}")
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                key = ";".join([thread] + stack[::-1])
+
+                cpu_time = _thread_cpu_time(ident)
+                previous = self._cpu_times.get(ident)
+                self._cpu_times[ident] = cpu_time
+                # サンプル間隔の半分以上CPUを使っていればCPUのサンプルとする
+                on_cpu = cpu_time is not None and previous is not None and cpu_time - previous >= elapsed / 2
+
+                self.wall[key] += 1
+                stats = self.threads.setdefault(thread, {"samples": 0, "cpu_samples": 0})
+                stats["samples"] += 1
+                if on_cpu:
+                    self.cpu[key] += 1
+                    stats["cpu_samples"] += 1
+
+    @staticmethod
+    def collapsed(counter: Counter) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(counter.items()))
+
+    @staticmethod
+    def top_frames(counter: Counter, top: int) -> dict:
+        """スタックの先頭(self)と、スタックに含まれる全ての関数(total)ごとにサンプル数を集計します。"""
+        total_samples = sum(counter.values()) or 1
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in counter.items():
+            frames = stack.split(";")[1:]
+            if not frames:
+                continue
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+        def rows(counts):
+            return [
+                {"frame": frame, "samples": count, "percent": round(100 * count / total_samples, 1)}
+                for frame, count in counts.most_common(top)
+            ]
+        return {"self": rows(self_counts), "total": rows(total_counts)}
+
+    def summary(self, top: int = 20) -> dict:
+        wall_samples = sum(self.wall.values())
+        cpu_samples = sum(self.cpu.values())
+        return {
+            "interval_ms": round(self.interval * 1000, 3),
+            "duration_seconds": round(self.duration, 3),
+            "ticks": self.ticks,
+            "wall_samples": wall_samples,
+            "cpu_samples": cpu_samples,
+            "process_cpu_seconds": round(self.process_cpu_seconds, 3),
+            "children_cpu_seconds": round(self.children_cpu_seconds, 3),
+            # 1.0を大きく下回る場合は、I/Oや子プロセス、GILの取り合いを待っている時間が長い
+            "cpu_utilization": round(self.process_cpu_seconds / self.duration, 3) if self.duration else None,
+            "threads": [
+                {"name": name, **stats, "cpu_ratio": round(stats["cpu_samples"] / stats["samples"], 3)}
+                for name, stats in sorted(self.threads.items(), key=lambda item: -item[1]["samples"])
+            ],
+            "cpu": self.top_frames(self.cpu, top),
+            "wall": self.top_frames(self.wall, top),
+        }
+
+    def write(self, home_dir: str) -> dict:
+        """折りたたみ形式のスタックと集計を本のディレクトリに書き出し、{名前: パス} を返します。"""
+        paths = {name: os.path.join(home_dir, filename) for name, filename in PROFILE_FILES.items()}
+        with open(paths["profile_wall"], "w", encoding="UTF-8") as f:
+            f.write(self.collapsed(self.wall))
+        with open(paths["profile_cpu"], "w", encoding="UTF-8") as f:
+            f.write(self.collapsed(self.cpu))
+        summary = self.summary()
+        with open(paths["profile_summary"], "w", encoding="UTF-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        logging.info(
+            f"profile: {summary['duration_seconds']}s wall, {summary['process_cpu_seconds']}s CPU "
+            f"(+{summary['children_cpu_seconds']}s in subprocesses), top CPU frames: "
+            + ", ".join(f"{row['frame']} {row['percent']}%" for row in summary["cpu"]["self"][:5])
+        )
+        return paths
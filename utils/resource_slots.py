@@ -0,0 +1,98 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+class resource_slots:
+    """
+    プロセス内の本で共有する同時実行数の上限 (LLMの呼び出し、LaTeXのコンパイルなど)。
+    待っている処理は到着順に通すため、先に多くの節を投げた本が他の本の呼び出しを追い越すことはありません。
+    capacity が0の場合は上限なしで、使用状況の記録だけを行います。
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, name: str, capacity: int = 0):
+        self.name = name
+        self.capacity = max(0, int(capacity))
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquired = 0
+        self.wait_seconds = 0.0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self._next_ticket = 0
+        self._serving = 0
+        # 待っている間に中断された番号 (順番が来たら飛ばす)
+        self._abandoned = set()
+        self._cond = threading.Condition()
+
+    @classmethod
+    def shared(cls, name: str, env_name: str, default: str = "0"):
+        """名前ごとにプロセス内で1つの上限を返します。上限は最初に作るときの環境変数 env_name から読みます。"""
+        with cls._shared_lock:
+            if name not in cls._shared:
+                cls._shared[name] = cls(name, int(os.environ.get(env_name, default)))
+            return cls._shared[name]
+
+    @contextmanager
+    def hold(self):
+        """空きが出るまで待ってから1つ使い、抜けるときに返します。"""
+        wait_start = time.monotonic()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            try:
+                while ticket != self._serving or (self.capacity and self.in_use >= self.capacity):
+                    self._cond.wait()
+            except BaseException:
+                # KeyboardInterrupt などで待つのをやめた場合も、後の処理が止まらないよう番号を手放す
+                self._abandoned.add(ticket)
+                self._advance()
+                self._cond.notify_all()
+                raise
+            self._serving += 1
+            self._advance()
+            self.in_use += 1
+            self.acquired += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_seconds += time.monotonic() - wait_start
+            # 次の番の処理も空きがあれば通す
+            self._cond.notify_all()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= 1
+                self.busy_seconds += time.monotonic() - start
+                self._cond.notify_all()
+
+    def _advance(self):
+        """中断された番号に順番が来ていれば、次の番号へ進めます。"""
+        while self._serving in self._abandoned:
+            self._abandoned.remove(self._serving)
+            self._serving += 1
+
+    def stats(self) -> dict:
+        """使用回数、待ち時間と利用率(上限×経過時間に対する使用時間の割合)を返します。"""
+        with self._cond:
+            uptime = max(time.monotonic() - self.started_at, 1e-9)
+            return {
+                "name": self.name,
+                "capacity": self.capacity,
+                "acquired": self.acquired,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "mean_wait_seconds": round(self.wait_seconds / self.acquired, 3) if self.acquired else 0.0,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "utilization": round(self.busy_seconds / (uptime * self.capacity), 3) if self.capacity else None,
+            }
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+# 書き出す形式と、本のディレクトリに置くファイル名
+TRACE_FORMATS = {
+    "chrome": "trace.json",
+    "otlp": "trace.otlp.json",
+}
+
+# 実行中のスパン (tracer, span) 。スレッドプールへはcontextvarsごと引き継ぐ
+_current = contextvars.ContextVar("current_span", default=None)
+
+class tracer:
+    """
+    本1冊分の処理の区間(スパン)を記録し、Chromeのトレース形式やOTLP(JSON)で書き出します。
+    スパンには task_id などの共通の属性と、節のID(node)などスパンごとの属性を付けられます。
+    """
+
+    def __init__(self, trace_id: str = None, **attributes):
+        self.trace_id = self._trace_id(trace_id)
+        self.attributes = attributes
+        self.spans = []
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    @staticmethod
+    def _trace_id(value: str = None) -> str:
+        # タスクIDがUUIDならそのままトレースIDにする
+        try:
+            return uuid.UUID(str(value)).hex
+        except ValueError:
+            return uuid.uuid4().hex
+
+    def set_attributes(self, **attributes):
+        if "task_id" in attributes:
+            self.trace_id = self._trace_id(attributes["task_id"])
+        self.attributes.update(attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """with の区間をスパンとして記録します。区間内で span() を呼ぶと子のスパンになります。"""
+        current = _current.get()
+        record = {
+            "name": name,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_id": current[1]["span_id"] if current and current[0] is self else None,
+            "start": time.time_ns(),
+            "end": None,
+            "thread": self._thread_index(),
+            "attributes": attributes,
+            "error": None,
+        }
+        token = _current.set((self, record))
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            record["end"] = time.time_ns()
+            with self._lock:
+                self.spans.append(record)
+
+    def add_span(self, name: str, start: float, end: float, **attributes):
+        """外部のプロセスなどで計測済みの区間(UNIX時刻の秒)を、実行中のスパンの子として追加します。"""
+        current = _current.get()
+        record = {
+            "name": name,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_id": current[1]["span_id"] if current and current[0] is self else None,
+            "start": int(start * 1e9),
+            "end": int(end * 1e9),
+            "thread": self._thread_index(),
+            "attributes": attributes,
+            "error": None,
+        }
+        with self._lock:
+            self.spans.append(record)
+
+    def _thread_index(self) -> int:
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads[thread.ident] = (len(self._threads) + 1, thread.name)
+            return self._threads[thread.ident][0]
+
+    def chrome_trace(self) -> dict:
+        """chrome://tracing や Perfetto で開ける形式 (Trace Event Format) に変換します。"""
+        pid = os.getpid()
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": index, "args": {"name": name}}
+            for index, name in self._threads.values()
+        ]
+        for span in sorted(self.spans, key=lambda s: s["start"]):
+            args = {**self.attributes, **span["attributes"]}
+            if span["error"]:
+                args["error"] = span["error"]
+            events.append({
+                "name": span["name"],
+                "cat": span["name"].split(".")[0],
+                "ph": "X",
+                "ts": span["start"] / 1000,
+                "dur": (span["end"] - span["start"]) / 1000,
+                "pid": pid,
+                "tid": span["thread"],
+                "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"trace_id": self.trace_id}}
+
+    def otlp(self) -> dict:
+        """OpenTelemetryのファイルエクスポーターと同じ、OTLP/JSON (ExportTraceServiceRequest) に変換します。"""
+        spans = []
+        for span in sorted(self.spans, key=lambda s: s["start"]):
+            otlp_span = {
+                "traceId": self.trace_id,
+                "spanId": span["span_id"],
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(span["start"]),
+                "endTimeUnixNano": str(span["end"]),
+                "attributes": [_otlp_attribute(key, value) for key, value in span["attributes"].items()],
+                "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+            }
+            if span["parent_id"]:
+                otlp_span["parentSpanId"] = span["parent_id"]
+            spans.append(otlp_span)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", "autogenbook")]
+                         + [_otlp_attribute(key, value) for key, value in self.attributes.items()]},
+            "scopeSpans": [{"scope": {"name": "autogenbook"}, "spans": spans}],
+        }]}
+
+    def export(self, home_dir: str, formats=None) -> dict:
+        """
+        指定した形式(既定は環境変数 TRACE_EXPORT のカンマ区切り)で本のディレクトリに書き出し、
+        {形式: パス} を返します。
+        """
+        if formats is None:
+            formats = [f.strip() for f in os.environ.get("TRACE_EXPORT", "").split(",") if f.strip()]
+        paths = {}
+        for name in formats:
+            if name not in TRACE_FORMATS:
+                raise ValueError(f"Unsupported trace format: {name}")
+            path = os.path.join(home_dir, TRACE_FORMATS[name])
+            data = self.chrome_trace() if name == "chrome" else self.otlp()
+            with open(path, "w", encoding="UTF-8") as f:
+                # OTLPのファイルエクスポーターは1行に1リクエストを書く
+                json.dump(data, f, ensure_ascii=False, indent=None if name == "otlp" else 1)
+                f.write("\n")
+            paths[name] = path
+        return paths
+
+def _otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+@contextmanager
+def span(name: str, **attributes):
+    """実行中のトレーサーがあればその子のスパンを記録します。なければ何もしません。"""
+    current = _current.get()
+    if current is None:
+        yield None
+        return
+    with current[0].span(name, **attributes) as record:
+        yield record
+
+def add_span(name: str, start: float, end: float, **attributes):
+    current = _current.get()
+    if current is not None:
+        current[0].add_span(name, start, end, **attributes)
+
+def traced(name: str = None):
+    """メソッドの実行を self.tracer のスパンとして記録するデコレーター。"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name or method.__name__):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def submit(executor, fn, *args, **kwargs):
+    """実行中のスパンを引き継いでスレッドプールに処理を投入します。"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,189 @@
+import os
+import time
+import zlib
+import struct
+import hashlib
+try:
+    from .artifact_manifest import file_digest
+except ImportError:
+    from artifact_manifest import file_digest
+
+# テキスト(COMPRESS_MAX_BYTES以下)はメモリ上で圧縮し、それ以外(画像・音声・PDF)は無圧縮で格納する
+COMPRESS_EXTENSIONS = {".tex", ".json", ".txt", ".m3u"}
+COMPRESS_MAX_BYTES = 16 * 1024 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+UTF8_FLAG = 0x0800
+
+def dos_datetime(timestamp: float):
+    t = time.localtime(timestamp)
+    year = max(1980, t.tm_year)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+class zip_stream:
+    """
+    ファイルを一時ファイルに書き出さずに、ZIPとして順に送出します。
+    全エントリのサイズとCRC-32を先に確定させてバイト配置を計算しておくため、
+    全体のサイズが事前に分かり、任意の範囲(Range)から送出できます。
+    4GBを超えるファイルやアーカイブはZIP64で表現します。
+    """
+
+    def __init__(self, entries: list):
+        """
+        entries は {"name", "path" または "data", "crc32", "size", "mtime"} の辞書のリストです。
+        path の場合は crc32・size を渡すと読み直しを省略します(ファイルのサイズと更新時刻が一致する場合)。
+        """
+        self.segments = []
+        self.size = 0
+        central = []
+        etag = hashlib.sha256()
+        for entry in entries:
+            name = entry["name"].encode("utf-8")
+            mtime = entry.get("mtime") or time.time()
+            if "data" in entry:
+                raw = entry["data"]
+                crc, size = zlib.crc32(raw), len(raw)
+                compress = os.path.splitext(entry["name"])[1] in COMPRESS_EXTENSIONS
+            else:
+                path = entry["path"]
+                stat = os.stat(path)
+                crc, size = entry.get("crc32"), entry.get("size")
+                if crc is None or size != stat.st_size or (entry.get("mtime") and entry["mtime"] != stat.st_mtime):
+                    size, _, crc = file_digest(path)
+                mtime = stat.st_mtime
+                compress = os.path.splitext(path)[1] in COMPRESS_EXTENSIONS and size <= COMPRESS_MAX_BYTES
+                raw = None
+                if compress:
+                    with open(path, "rb") as f:
+                        raw = f.read()
+            if compress:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                payload = compressor.compress(raw) + compressor.flush()
+                method = 8
+            else:
+                payload = raw
+                method = 0
+            compressed_size = len(payload) if payload is not None else size
+            offset = self.size
+            dos_time, dos_date = dos_datetime(mtime)
+            zip64 = size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT
+            version = 45 if zip64 or offset >= ZIP64_LIMIT else 20
+
+            extra = struct.pack("<HHQQ", 0x0001, 16, size, compressed_size) if zip64 else b""
+            header = struct.pack(
+                "<IHHHHHIIIHH", 0x04034B50, version, UTF8_FLAG, method, dos_time, dos_date, crc,
+                ZIP64_LIMIT if zip64 else compressed_size, ZIP64_LIMIT if zip64 else size, len(name), len(extra),
+            ) + name + extra
+            self._add(header)
+            if payload is not None:
+                self._add(payload)
+            else:
+                self._add_file(entry["path"], size)
+
+            # セントラルディレクトリでは、上限を超えた値だけをZIP64拡張に入れる
+            central_extra = b""
+            if size >= ZIP64_LIMIT:
+                central_extra += struct.pack("<Q", size)
+            if compressed_size >= ZIP64_LIMIT:
+                central_extra += struct.pack("<Q", compressed_size)
+            if offset >= ZIP64_LIMIT:
+                central_extra += struct.pack("<Q", offset)
+            if central_extra:
+                central_extra = struct.pack("<HH", 0x0001, len(central_extra)) + central_extra
+            central.append(struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | 45, version, UTF8_FLAG, method, dos_time, dos_date, crc,
+                min(compressed_size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(name), len(central_extra), 0, 0, 0,
+                0o100644 << 16, min(offset, ZIP64_LIMIT),
+            ) + name + central_extra)
+            etag.update(name + struct.pack("<IQd", crc, size, mtime))
+
+        central_offset = self.size
+        central_bytes = b"".join(central)
+        self._add(central_bytes)
+        count = len(central)
+        if count >= 0xFFFF or central_offset >= ZIP64_LIMIT or len(central_bytes) >= ZIP64_LIMIT:
+            eocd64_offset = self.size
+            self._add(struct.pack(
+                "<IQHHIIQQQQ", 0x06064B50, 44, (3 << 8) | 45, 45, 0, 0, count, count, len(central_bytes), central_offset,
+            ))
+            self._add(struct.pack("<IIQI", 0x07064B50, 0, eocd64_offset, 1))
+        self._add(struct.pack(
+            "<IHHHHIIH", 0x06054B50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(len(central_bytes), ZIP64_LIMIT), min(central_offset, ZIP64_LIMIT), 0,
+        ))
+        self.etag = etag.hexdigest()[:32]
+
+    def _add(self, data: bytes):
+        self.segments.append((self.size, len(data), data, None))
+        self.size += len(data)
+
+    def _add_file(self, path: str, size: int):
+        self.segments.append((self.size, size, None, path))
+        self.size += size
+
+    def iter_range(self, start: int = 0, end: int = None, chunk_size: int = 1 << 16):
+        """start から end (含む) までのバイトを送出します。"""
+        end = self.size - 1 if end is None else min(end, self.size - 1)
+        for offset, length, data, path in self.segments:
+            if offset + length <= start or offset > end:
+                continue
+            begin = max(start, offset) - offset
+            stop = min(end + 1, offset + length) - offset
+            if data is not None:
+                yield data[begin:stop]
+                continue
+            with open(path, "rb") as f:
+                f.seek(begin)
+                remaining = stop - begin
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        raise IOError(f"{path} was truncated while streaming")
+                    remaining -= len(chunk)
+                    yield chunk
+
+def parse_range(header: str, size: int):
+    """
+    Rangeヘッダ(単一範囲のみ)を (start, end) に変換します。
+    ヘッダがない・複数範囲の場合は None、満たせない範囲の場合は ValueError を送出します。
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    if first == "":
+        if not last.isdigit() or int(last) == 0:
+            raise ValueError(header)
+        return max(0, size - int(last)), size - 1
+    if not first.isdigit() or (last and not last.isdigit()):
+        raise ValueError(header)
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+# 一括ダウンロードに含める成果物 (tex/ で始まるものは全て含める)
+BUNDLE_ARTIFACTS = ("pdf", "cover_png", "audio", "outline", "trace_chrome", "trace_otlp",
+                    "profile_wall", "profile_cpu", "profile_summary")
+
+def bundle_entries(manifest: dict, home_dir: str) -> list:
+    """manifest.jsonの記録から、本のディレクトリ名をフォルダにしたZIPのエントリを作ります。"""
+    folder = os.path.basename(os.path.normpath(home_dir))
+    entries = []
+    names = [name for name in BUNDLE_ARTIFACTS if name in manifest["artifacts"]]
+    names += sorted(name for name in manifest["artifacts"] if name.startswith("tex/"))
+    for name in names:
+        artifact = manifest["artifacts"][name]
+        if not os.path.exists(artifact["path"]):
+            continue
+        entries.append({
+            "name": f"{folder}/{artifact['relpath']}",
+            "path": artifact["path"],
+            "crc32": artifact.get("crc32"),
+            "size": artifact.get("size"),
+            "mtime": artifact.get("mtime"),
+        })
+    manifest_path = os.path.join(home_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        entries.append({"name": f"{folder}/manifest.json", "path": manifest_path})
+    return entries
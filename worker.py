@@ -0,0 +1,187 @@
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+import multiprocessing
+from AutoGenBook import BookGenerator
+from utils.profiler import sampling_profiler
+from utils.job_queue import job_queue
+from utils.artifact_manifest import artifact_index
+
+def generate_book(request: dict, update, emit=None, task_id: str = None) -> dict:
+    """
+    BookRequestの内容(辞書)から本を生成し、タスクの結果を返します。
+    update(**fields) は途中経過(出力先など)をキューへ反映するための関数、
+    emit(event, data) は進捗イベントを受け取る関数です。
+    """
+    bookgenerator = BookGenerator(request.get("provider"), request.get("model"), request.get("models"))
+    if emit:
+        bookgenerator.set_event_callback(emit)
+    if task_id:
+        bookgenerator.tracer.set_attributes(task_id=task_id)
+    profiler = sampling_profiler().start() if request.get("profile") else None
+    try:
+        return _generate_book(bookgenerator, request, update)
+    finally:
+        # 失敗した場合も、そこまでの区間と計測を書き出す
+        bookgenerator.record_llm_metrics()
+        bookgenerator.export_trace()
+        if profiler:
+            bookgenerator.export_profile(profiler)
+        bookgenerator.llm.close()
+
+def _generate_book(bookgenerator: BookGenerator, request: dict, update) -> dict:
+    author = f"{bookgenerator.llm.get_provider_name()}:{bookgenerator.llm.get_model_name()}"
+    wav_output = request.get("wav_output") or 0
+    audio_format = request.get("audio_format") or "wav"
+
+    # 初期化
+    bookgenerator.initialize(request["book_content"], request["target_readers"], request["n_pages"])
+
+    if request.get("level"):
+        bookgenerator.set_equation_frequency_level(request["level"])
+
+    # 本の概要を生成
+    bookgenerator.generate_book_title_and_summary()
+    # 生成途中の音声を配信できるよう、出力先を先に公開する
+    update(output_dir=bookgenerator.home_dir)
+
+    # 本の中身を生成
+    bookgenerator.generate_book_detail()
+
+    # PDFを生成
+    filename = bookgenerator.create_pdf()
+    if not filename:
+        # PDFがない本は成功として扱わず、キューとバッチの集計で失敗にする
+        raise RuntimeError(f"PDF compilation failed: {bookgenerator.home_dir}")
+
+    # 音声ファイルを生成
+    wav_path = None
+    wav_filename = None
+    audio_metrics = None
+    if wav_output > 0:
+        wav_path = bookgenerator.create_wav(filename, wav_output, audio_format)
+        if wav_path and os.path.exists(wav_path):
+            wav_filename = os.path.basename(wav_path)
+            audio_metrics = bookgenerator.audio_metrics
+        else:
+            wav_path = None
+    # カバー画像のパスを取得
+    cover_path = getattr(bookgenerator, "cover_image_paths", {}).get("png")
+    cover_filename = os.path.basename(cover_path) if cover_path else None
+
+    return {
+        "output_dir": bookgenerator.home_dir,
+        "manifest_path": bookgenerator.manifest.path,
+        "title": bookgenerator.book_node["title"],
+        "cover_path": cover_path,
+        "cover_filename": cover_filename,
+        "wav_path": wav_path,
+        "wav_filename": wav_filename,
+        "wav_output": wav_output,
+        "audio_format": audio_format,
+        "audio_metrics": audio_metrics,
+        # 複数のLLMエンドポイントに振り分けている場合の、このワーカープロセスでの利用状況
+        "llm_endpoints": bookgenerator.llm.endpoint_stats(),
+        # プロンプトの種類・モデルごとのレイテンシと費用
+        "llm_tiers": bookgenerator.llm.tier_metrics(),
+        "author": author
+    }
+
+def run_job(queue: job_queue, job: dict, worker_id: str):
+    """ジョブを1件処理します。処理中はリースの1/3の間隔でハートビートを送ります。"""
+    job_id = job["id"]
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(queue.lease_seconds / 3):
+            if not queue.heartbeat(job_id, worker_id):
+                logging.error(f"job {job_id}: lease was lost")
+                return
+
+    def update(**fields):
+        # 出力先が決まった時点で、タスクIDから本を引けるよう索引に登録する
+        if fields.get("output_dir"):
+            artifact_index(queue.db_path).register(job_id, fields["output_dir"])
+        queue.update(job_id, worker_id, **fields)
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    start = time.monotonic()
+    try:
+        result = generate_book(
+            job["request"],
+            update,
+            lambda event, data: queue.add_event(job_id, event, data),
+            job_id,
+        )
+        queue.complete(job_id, worker_id, result)
+        logging.info(f"job {job_id} completed in {time.monotonic() - start:.1f}s")
+    except Exception as e:
+        logging.exception(f"job {job_id} failed")
+        queue.fail(job_id, worker_id, str(e))
+    finally:
+        stop.set()
+        thread.join()
+
+def work(poll_interval: float = 1.0):
+    """キューからジョブを取得して処理し続けます。"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    queue = job_queue()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    logging.info(f"worker {worker_id} started")
+    while True:
+        job = queue.claim(worker_id)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        logging.info(f"job {job['id']} claimed by {worker_id} (attempt {job['attempts']})")
+        run_job(queue, job, worker_id)
+
+def start_workers(n_workers: int, poll_interval: float = 1.0) -> list:
+    """
+    ワーカープロセスを起動します。
+    Webサーバーのスレッドを引き継がないよう、forkではなくspawnで起動します。
+    """
+    return [_spawn(poll_interval) for _ in range(n_workers)]
+
+def _spawn(poll_interval: float):
+    process = multiprocessing.get_context("spawn").Process(target=work, args=(poll_interval,), daemon=True)
+    process.start()
+    return process
+
+def supervise(processes: list, poll_interval: float = 1.0, stop: threading.Event = None, check_interval: float = 5.0):
+    """
+    終了したワーカープロセスを起動し直します。
+    処理中だったジョブはリースが切れた後に別のワーカーが再取得します。
+    """
+    stop = stop or threading.Event()
+    while not stop.wait(check_interval):
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                logging.error(f"worker process {process.pid} exited with {process.exitcode}, restarting")
+                processes[i] = _spawn(poll_interval)
+
+def stop_workers(processes: list, timeout: float = 10.0):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run book generation workers.")
+    parser.add_argument('--workers', type=int, help='number of worker processes', default=int(os.environ.get("JOB_WORKERS", "1")))
+    parser.add_argument('--poll-interval', type=float, help='seconds to wait when the queue is empty', default=1.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    processes = start_workers(args.workers, args.poll_interval)
+    try:
+        supervise(processes, args.poll_interval)
+    except KeyboardInterrupt:
+        stop_workers(processes)
+
+if __name__ == "__main__":
+    main()